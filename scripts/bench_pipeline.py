@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, Optional
+
+import numpy as np
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+from trpc import Controller, TRPCProcessor, TRPCStreamer
+from trpc.simulation import SimulatedADS1115, array_source, csv_source
+from trpc.utils.logger import get_logger
+from trpc.utils.tracing import Tracer
+
+logger = get_logger(__name__)
+
+DEFAULT_BASELINE = "benchmarks/pipeline_baseline.json"
+# Metrics compared against the baseline, and whether higher values are better
+BASELINE_METRICS = {
+    "samples_per_s": True,
+    "decisions_per_s": True,
+    "dropped": False,
+    "decision_p50_ms": False,
+    "decision_p95_ms": False,
+    "decision_p99_ms": False,
+    "cpu_total_pct": False,
+}
+# Seconds per class in the synthetic recording
+SEGMENT_SECONDS = 2.0
+
+
+def make_recording(sampling_rate: float, classes: int = 3, repetitions: int = 4, seed: int = 0):
+    """Creates a synthetic 4 channel recording in which each class has a different amplitude on each channel, so the
+    classifier produces varying decisions"""
+    rng = np.random.default_rng(seed)
+    segment = int(SEGMENT_SECONDS * sampling_rate)
+    labels = np.tile(np.repeat(np.arange(classes), segment), repetitions)
+    gains = rng.uniform(0.05, 0.5, size=(classes, 4))
+    return rng.normal(0.0, 1.0, size=(len(labels), 4)) * gains[labels], labels
+
+
+def train_classifier(data: np.ndarray, labels: np.ndarray, window_size: int, window_increment: int, channels: int,
+                     path: str):
+    """Trains an LDA on LS9 features of the recording and saves it as a compact artifact"""
+    from libemg.emg_classifier import EMGClassifier
+    from libemg.feature_extractor import FeatureExtractor
+    from libemg.utils import get_windows
+
+    from trpc.model import save_compact
+
+    fe = FeatureExtractor()
+    windows = get_windows(data[:, :channels], window_size, window_increment)
+    # Label each window with the class of its last sample
+    window_labels = labels[window_size - 1::window_increment][:len(windows)]
+    features = fe.extract_features(fe.get_feature_groups()["LS9"], windows)
+
+    emg = EMGClassifier()
+    emg.add_rejection(0.8)
+    emg.fit(model="LDA", feature_dictionary={"training_features": features, "training_labels": window_labels})
+    save_compact(emg, path)
+
+
+def cpu_time(pid: Optional[int]) -> float:
+    """Returns the user + system CPU time of a process in seconds, or NaN if it is not available (e.g. not on Linux)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return math.nan
+
+
+def run_config(source: Callable[[int, float], float], classifier_path: str, window_size: int, window_increment: int,
+               channels: int, duration: float, warmup: float, fast_inference: bool = False) -> Dict[str, float]:
+    """Runs the real streamer, processor, controller and driver with a simulated ADC and mock servo pins, and measures
+    the pipeline for `duration` seconds after `warmup` seconds"""
+    tracer = Tracer()
+    streamer = TRPCStreamer(wire_format="float32", channels=channels,
+                            adc_factory=lambda: SimulatedADS1115(source=source))
+    processor = TRPCProcessor(window_size=window_size, window_increment=window_increment,
+                              classifier_path=classifier_path, wire_format="float32", feature_cache_dir=None,
+                              trace=True, fast_inference=fast_inference)
+    controller = Controller(streamer=streamer, classifier=processor, tracer=tracer,
+                            pin_factory=MockFactory(pin_class=MockPWMPin))
+
+    processes = {
+        "streamer": lambda: controller._streamer_process.pid,
+        "receiver": lambda: processor.odh.listener.pid,
+        "classifier": lambda: processor.classifier.process.pid,
+        "controller": os.getpid,
+    }
+    snapshots = []
+
+    def snapshot():
+        stats = processor.odh.get_stream_stats()
+        snapshots.append({
+            "time": time.monotonic(),
+            "samples": stats["samples"],
+            "dropped": stats["dropped"],
+            "decisions": controller.decisions,
+            "cpu": {name: cpu_time(pid()) for name, pid in processes.items()},
+        })
+
+    async def measure():
+        loop = asyncio.get_running_loop()
+        loop.call_later(warmup, snapshot)
+        loop.call_later(warmup + duration, lambda: (snapshot(), controller.stop_async()))
+        await controller.listen_async()
+
+    controller.start()
+    asyncio.run(measure())
+
+    start, end = snapshots
+    elapsed = end["time"] - start["time"]
+    result = {
+        "samples_per_s": (end["samples"] - start["samples"]) / elapsed,
+        "decisions_per_s": (end["decisions"] - start["decisions"]) / elapsed,
+        "dropped": end["dropped"] - start["dropped"],
+    }
+    summary = tracer.summary()
+    for stage in ("decision", "transport", "buffering", "inference", "delivery", "actuation"):
+        for statistic in ("p50", "p95", "p99"):
+            result[f"{stage}_{statistic}_ms"] = summary.get(stage, {}).get(statistic, math.nan)
+    for name in processes:
+        result[f"cpu_{name}_pct"] = (end["cpu"][name] - start["cpu"][name]) / elapsed * 100
+    result["cpu_total_pct"] = sum(result[f"cpu_{name}_pct"] for name in processes)
+    return result
+
+
+def load_baseline(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: Dict[str, Dict[str, float]]):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"host": platform.node(), "machine": platform.machine(), "commit": commit, "results": results}, f,
+                  indent=2)
+
+
+def compare(baseline: Dict, results: Dict[str, Dict[str, float]], tolerance: float) -> int:
+    """Logs every metric that is worse than the baseline by more than the tolerance and returns how many there are"""
+    if not baseline:
+        return 0
+    if baseline.get("host") != platform.node():
+        logger.warning(f"The baseline was recorded on {baseline.get('host')}, so differences may be due to the host")
+
+    regressions = 0
+    for config, metrics in results.items():
+        reference = baseline.get("results", {}).get(config)
+        if reference is None:
+            continue
+        for metric, higher_is_better in BASELINE_METRICS.items():
+            old, new = reference.get(metric, math.nan), metrics.get(metric, math.nan)
+            if math.isnan(old) or math.isnan(new):
+                continue
+            worse = new < old * (1 - tolerance) if higher_is_better else new > old * (1 + tolerance) + 1e-9
+            if worse:
+                regressions += 1
+                logger.warning(f"Regression in {config} {metric}: {old:.3f} -> {new:.3f} "
+                               f"(baseline commit {baseline.get('commit')})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks the streamer -> processor -> controller pipeline without hardware")
+    parser.add_argument("--csv", type=str, default=None,
+                        help="Recording to replay (one column per channel, in volts). Defaults to synthetic data")
+    parser.add_argument("--recording-rate", type=float, default=215.0, help="Sampling rate of the recording")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=[250])
+    parser.add_argument("--window-increments", type=int, nargs="+", default=[10])
+    parser.add_argument("--channels", type=int, nargs="+", default=[4])
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to measure each configuration for")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds to run before measuring")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="Baseline file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative change in a metric that counts as a regression")
+    parser.add_argument("--output", type=str, help="Path of a JSON file to write the results to")
+    parser.add_argument("--fast-inference", action="store_true",
+                        help="Classify with the NumPy inference engine instead of scikit-learn")
+
+    args = parser.parse_args()
+
+    recording, labels = make_recording(args.recording_rate)
+    if args.csv:
+        source = csv_source(args.csv, args.recording_rate)
+    else:
+        source = array_source(recording, args.recording_rate)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for window_size, window_increment, channels in itertools.product(args.window_sizes, args.window_increments,
+                                                                          args.channels):
+            config = f"w{window_size}_i{window_increment}_c{channels}"
+            classifier_path = os.path.join(directory, f"{config}.npz")
+            train_classifier(recording, labels, window_size, window_increment, channels, classifier_path)
+
+            result = run_config(source, classifier_path, window_size, window_increment, channels, args.duration,
+                                args.warmup, args.fast_inference)
+            results[config] = result
+            logger.info(f"{config}: {result['samples_per_s']:.1f} samples/s, "
+                        f"{result['decisions_per_s']:.1f} decisions/s, {result['dropped']} dropped, "
+                        f"decision latency p50/p95/p99 {result['decision_p50_ms']:.2f}/"
+                        f"{result['decision_p95_ms']:.2f}/{result['decision_p99_ms']:.2f} ms, "
+                        f"CPU " + ", ".join(f"{name} {result[f'cpu_{name}_pct']:.1f}%"
+                                            for name in ("streamer", "receiver", "classifier", "controller")))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = compare(load_baseline(args.baseline), results, args.tolerance)
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        logger.info(f"Saved baseline to {args.baseline}")
+    exit(1 if regressions else 0)
@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Each phase runs in a fresh interpreter so that nothing is already imported. The snippet's setup is not timed, the
+# timed statements run right after it.
+#   name: (setup, timed statements)
+PHASES = {
+    "import trpc": ("", "import trpc"),
+    "import streamer": ("", "from trpc import TRPCStreamer"),
+    "import processor": ("", "from trpc import TRPCProcessor"),
+    "import libemg": ("", "import libemg.emg_classifier"),
+    "import online classifier": ("", "import trpc.online_classifier"),
+    "load pickle": ("from trpc.model import load_classifier", "load_classifier({pickle!r})"),
+    "load compact": ("from trpc.model import load_classifier", "load_classifier({compact!r})"),
+    # The processor imports libemg for its data handler and online classifier whichever artifact it loads, so the
+    # compact artifact only saves the unpickling. Deferring the setup is what takes libemg off the startup path.
+    "processor (eager, pickle)": ("from trpc import TRPCProcessor",
+                                  "p = TRPCProcessor(classifier_path={pickle!r}, feature_cache_dir=None)"),
+    "processor (eager, compact)": ("from trpc import TRPCProcessor",
+                                   "p = TRPCProcessor(classifier_path={compact!r}, feature_cache_dir=None)"),
+    "processor (deferred)": ("from trpc import TRPCProcessor",
+                             "p = TRPCProcessor(classifier_path={compact!r}, feature_cache_dir=None, "
+                             "defer_setup=True)"),
+    "processor (deferred, ready)": ("from trpc import TRPCProcessor",
+                                    "p = TRPCProcessor(classifier_path={compact!r}, feature_cache_dir=None, "
+                                    "defer_setup=True); p.wait_until_ready()"),
+}
+
+SNIPPET = """
+import time
+{setup}
+start = time.perf_counter()
+{timed}
+print("elapsed", time.perf_counter() - start, flush=True)
+if "p" in globals():
+    p.odh.stop_listening()
+"""
+
+
+def make_classifiers(directory: str, features: int = 36, classes: int = 3):
+    """Trains an LDA on random features and saves it both as a libemg pickle and as a compact artifact"""
+    from libemg.emg_classifier import EMGClassifier
+
+    from trpc.model import save_compact
+
+    rng = np.random.default_rng(0)
+    labels = np.repeat(np.arange(classes), 200)
+    data = rng.normal(labels[:, np.newaxis], 1.0, (len(labels), features))
+    emg = EMGClassifier()
+    emg.add_rejection(0.8)
+    emg.fit(model="LDA", feature_dictionary={"training_features": {"F": data}, "training_labels": labels})
+
+    paths = {"pickle": os.path.join(directory, "lda.pickle"), "compact": os.path.join(directory, "lda.npz")}
+    emg.save(paths["pickle"])
+    save_compact(emg, paths["compact"])
+    return paths
+
+
+def run_phase(setup: str, timed: str) -> float:
+    result = subprocess.run([sys.executable, "-c", SNIPPET.format(setup=setup, timed=timed)], capture_output=True,
+                            text=True, check=True)
+    # libemg prints to stdout on import, possibly from the setup thread
+    return next(float(line.split()[1]) for line in result.stdout.splitlines() if line.startswith("elapsed "))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measures import and initialization time of each startup phase")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs per phase. The median is reported")
+    parser.add_argument("--phases", nargs="+", choices=list(PHASES), default=list(PHASES))
+    parser.add_argument("--output", type=str, help="Path of a JSON file to write the results to")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_classifiers(directory)
+        results = {}
+        for name in args.phases:
+            setup, timed = PHASES[name]
+            times = [run_phase(setup, timed.format(**paths)) for _ in range(args.repeats)]
+            results[name] = float(np.median(times))
+            logger.info(f"{name}: {results[name] * 1000:.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,148 @@
+import pickle
+import socket
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from trpc.data_handler import create_raw_data
+from trpc.utils.logger import get_logger
+from trpc.wire import decode_frame, encode_frame
+
+logger = get_logger(__name__)
+
+# ADS1115 counts per volt at PGA_4_096V
+INT16_SCALE = 4.096 / 32767
+
+
+def make_encoder(wire_format: str):
+    if wire_format == "pickle":
+        return lambda sample, sequence: pickle.dumps(sample)
+    if wire_format == "int16":
+        return lambda sample, sequence: encode_frame([round(v / INT16_SCALE) for v in sample], sequence, time.time(),
+                                                     "int16", INT16_SCALE)
+    return lambda sample, sequence: encode_frame(sample, sequence, time.time(), wire_format)
+
+
+def make_decoder(wire_format: str):
+    if wire_format == "pickle":
+        return pickle.loads
+    return lambda data: decode_frame(data).to_voltage()
+
+
+def bench(wire_format: str, samples: list, sock: socket.socket | None, address: tuple):
+    encode = make_encoder(wire_format)
+    decode = make_decoder(wire_format)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    datagrams = [encode(sample, i) for i, sample in enumerate(samples)]
+    encode_wall, encode_cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    for datagram in datagrams:
+        decode(datagram)
+    decode_wall, decode_cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    send_cpu = 0.0
+    if sock is not None:
+        cpu = time.process_time()
+        for i, sample in enumerate(samples):
+            sock.sendto(encode(sample, i), address)
+        send_cpu = time.process_time() - cpu
+
+    n = len(samples)
+    return {
+        "format": wire_format,
+        "bytes/sample": len(datagrams[0]),
+        "encode us/sample": encode_wall / n * 1e6,
+        "decode us/sample": decode_wall / n * 1e6,
+        "encode cpu us/sample": encode_cpu / n * 1e6,
+        "decode cpu us/sample": decode_cpu / n * 1e6,
+        "encode+send cpu us/sample": send_cpu / n * 1e6,
+        "cpu % at 860 SPS": (encode_cpu + decode_cpu + send_cpu) / n * 860 * 100,
+    }
+
+
+def bench_receive(wire_format: str, samples: list, batch_size: int, raw_data):
+    """Measures the listener's side: decoding each datagram and appending its samples to the classifier's RawData,
+    which is a proxy of the manager process as in the OnlineDataHandler"""
+    if wire_format == "pickle":
+        datagrams = [pickle.dumps(sample) for sample in samples]
+    else:
+        scale = INT16_SCALE if wire_format == "int16" else 1.0
+        rows = np.round(np.array(samples) / INT16_SCALE) if wire_format == "int16" else np.array(samples)
+        datagrams = [encode_frame(rows[start:start + batch_size], i, time.time(), wire_format, scale)
+                     for i, start in enumerate(range(0, len(samples), batch_size))]
+
+    def receive(append):
+        raw_data.reset_emg()
+        wall, cpu = time.perf_counter(), time.process_time()
+        for datagram in datagrams:
+            append(datagram)
+        return time.perf_counter() - wall, time.process_time() - cpu
+
+    def per_frame(datagram):
+        raw_data.add_emg_block(decode_frame(datagram).to_voltage().tolist())
+
+    def per_sample(datagram):
+        for sample in decode_frame(datagram).to_voltage().tolist():
+            raw_data.add_emg(sample)
+
+    n = len(samples)
+    if wire_format == "pickle":
+        wall, cpu = receive(lambda datagram: raw_data.add_emg(pickle.loads(datagram)))
+        return {"format": wire_format, "samples/datagram": 1, "receive us/sample": wall / n * 1e6,
+                "receive cpu us/sample": cpu / n * 1e6}
+
+    block_wall, block_cpu = receive(per_frame)
+    assert len(raw_data.get_emg()) == n
+    sample_wall, sample_cpu = receive(per_sample)
+    return {
+        "format": wire_format,
+        "samples/datagram": batch_size,
+        "receive us/sample": block_wall / n * 1e6,
+        "receive cpu us/sample": block_cpu / n * 1e6,
+        "per-sample add_emg us/sample": sample_wall / n * 1e6,
+        "per-sample add_emg cpu us/sample": sample_cpu / n * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compares the per-sample cost of the pickle and binary wire formats")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--no-send", action="store_true", help="Skip the loopback sendto() measurement")
+    parser.add_argument("--receive-samples", type=int, default=20000,
+                        help="Samples for the receive measurement, which makes a round trip to a manager process per "
+                             "call. 0 skips it")
+    parser.add_argument("--batch-size", type=int, default=8, help="Samples per datagram for the receive measurement")
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = [list(row) for row in rng.uniform(-2.0, 2.0, size=(args.samples, args.channels)).tolist()]
+
+    receiver, sender, address = None, None, None
+    if not args.no_send:
+        # The receiver is never read; the kernel drops what does not fit in its buffer
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        address = receiver.getsockname()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    results = [bench(wire_format, data, sender, address) for wire_format in ("pickle", "float32", "int16")]
+
+    if args.receive_samples:
+        raw_data = create_raw_data()
+        received = data[:args.receive_samples]
+        results.append(bench_receive("pickle", received, 1, raw_data))
+        for wire_format in ("float32", "int16"):
+            results.extend(bench_receive(wire_format, received, batch_size, raw_data)
+                           for batch_size in sorted({1, args.batch_size}))
+
+    for result in results:
+        logger.info(", ".join(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()))
+
+    if sender is not None:
+        sender.close()
+        receiver.close()
@@ -0,0 +1,30 @@
+from argparse import ArgumentParser
+
+import numpy as np
+
+from trpc.dataset import convert_dataset
+from trpc.feature_cache import DATA_DIR
+from trpc.recorder import convert_session, is_session
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Packs the CSV training recordings, or a recorded session, into a "
+                                        "memory-mapped dataset store, which can be passed to the processor as its "
+                                        "data_path")
+    parser.add_argument("--folder", type=str, default=DATA_DIR,
+                        help="Folder containing the CSV recordings, or a session recorded with e2e.py --record")
+    parser.add_argument("--labels", type=str, default=None,
+                        help="For a session, a .npy file with the class of each recorded sample, -1 to leave it out")
+    parser.add_argument("--use-decisions", action="store_true",
+                        help="For a session without --labels, label the samples with the decisions made during it. "
+                             "The model then learns the classifier's own output, mistakes included")
+    parser.add_argument("--min-samples", type=int, default=250,
+                        help="Leave out runs of a session shorter than this, e.g. the window size")
+    parser.add_argument("--output", type=str, default="data/dataset", help="Directory to create the store in")
+
+    args = parser.parse_args()
+    if is_session(args.folder):
+        labels = np.load(args.labels) if args.labels is not None else None
+        convert_session(args.folder, args.output, labels, min_samples=args.min_samples,
+                        use_decisions=args.use_decisions)
+    else:
+        convert_dataset(args.folder, args.output)
@@ -1,14 +1,59 @@
+import asyncio
 import subprocess
 from argparse import ArgumentParser
 
 from trpc import Controller, TRPCStreamer, TRPCProcessor
-from trpc.utils.logger import get_logger
+from trpc.model import load_configuration
+from trpc.recorder import SessionRecorder
+from trpc.scheduling import PlacementPolicy
+from trpc.supervisor import StreamerSupervisor
+from trpc.utils.logger import get_logger, start_queue_logging
+from trpc.utils.metrics import get_registry
+from trpc.utils.tracing import Tracer
 
 logger = get_logger(__name__)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--classifier-file-path", type=str, help="Path to the classifier file")
+    parser.add_argument("--asyncio", action="store_true", help="Run the controller on an asyncio event loop")
+    parser.add_argument("--decision-timeout", type=float, default=None,
+                        help="Relax the hand if no decision arrives for this many seconds. Requires --asyncio")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Trace the latency of every decision and write the traces to this JSON Lines file")
+    parser.add_argument("--trace-summary", type=str, default=None,
+                        help="Write the p50/p95/p99 latency of each stage to this JSON file. Requires --trace")
+    parser.add_argument("--min-dwell", type=float, default=0.0,
+                        help="Minimum seconds a servo holds a position before moving again")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics")
+    parser.add_argument("--metrics-snapshot", type=str, default=None,
+                        help="Write a JSON snapshot of the metrics to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=60.0)
+    parser.add_argument("--fast-inference", action="store_true",
+                        help="Classify with the NumPy inference engine instead of scikit-learn. Requires a linear "
+                             "model")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Skip windows and decisions older than this many seconds, and adapt the window increment "
+                             "to the load")
+    parser.add_argument("--pin-cores", action="store_true",
+                        help="Pin the streamer, processor and controller to cores 1, 2 and 3 and report their "
+                             "scheduling jitter")
+    parser.add_argument("--realtime", action="store_true",
+                        help="Also run the streamer and controller under SCHED_FIFO, if permitted. Requires "
+                             "--pin-cores")
+    parser.add_argument("--supervise", action="store_true",
+                        help="Restart the streamer with backoff when it exits or stalls, instead of stopping")
+    parser.add_argument("--stall-timeout", type=float, default=2.0,
+                        help="Seconds without a sample after which the streamer is restarted. Requires --supervise")
+    parser.add_argument("--gap-log", type=str, default=None,
+                        help="Append every gap in acquisition to this JSON Lines file. Requires --supervise")
+    parser.add_argument("--record", type=str, default=None,
+                        help="Record the raw EMG and the decisions of the session to this directory")
+    parser.add_argument("--log-queue", action="store_true",
+                        help="Write logs from a background thread, so that slow output never stalls the pipeline")
+    parser.add_argument("--log-file", type=str, default=None, help="Write logs to this file. Implies --log-queue")
+    parser.add_argument("--log-json", action="store_true", help="Write logs as JSON Lines. Implies --log-queue")
 
     args = parser.parse_args()
     file_path = args.classifier_file_path
@@ -16,15 +61,48 @@ if __name__ == "__main__":
     if not file_path:
         raise ValueError("Please provide the path to the classifier file")
 
+    # Before the controller is created, so that every process it starts logs through the queue
+    if args.log_queue or args.log_file or args.log_json:
+        start_queue_logging(path=args.log_file, json_lines=args.log_json)
+
     subprocess.run(["sudo", "pigpiod"])
 
-    controller = Controller(streamer=TRPCStreamer(), classifier=TRPCProcessor(classifier_path=file_path))
+    # Binary frames carry the acquisition time of the samples, so tracing covers the whole pipeline
+    tracer = Tracer(args.trace) if args.trace else None
+    wire_format = "float32" if tracer is not None else "pickle"
+
+    # Windowing, features and model as the classifier was trained with, e.g. by scripts/sweep.py
+    configuration = load_configuration(file_path) or {}
+
+    # The classifier is set up while the streamer starts
+    controller = Controller(streamer=TRPCStreamer(wire_format=wire_format),
+                            classifier=TRPCProcessor(classifier_path=file_path, wire_format=wire_format,
+                                                     defer_setup=True, trace=tracer is not None,
+                                                     fast_inference=args.fast_inference, deadline=args.deadline,
+                                                     **configuration),
+                            decision_timeout=args.decision_timeout, tracer=tracer, min_dwell=args.min_dwell,
+                            recorder=SessionRecorder(args.record) if args.record else None, deadline=args.deadline,
+                            placement=PlacementPolicy.four_core(args.realtime) if args.pin_cores else None,
+                            supervisor=StreamerSupervisor(stall_timeout=args.stall_timeout, gap_path=args.gap_log)
+                            if args.supervise else None)
+
+    if args.metrics_port is not None:
+        get_registry().serve(args.metrics_port)
+    if args.metrics_snapshot:
+        get_registry().start_snapshots(args.metrics_snapshot, args.metrics_interval)
 
     try:
         controller.start()
-        controller.listen()
+        if args.asyncio:
+            # listen_async() handles SIGINT itself and stops the controller on its way out
+            asyncio.run(controller.listen_async())
+        else:
+            controller.listen()
     except KeyboardInterrupt:
         controller.stop()
-        subprocess.run(["sudo", "killall", "pigpiod"])
-        logger.info("Controller stopped")
-        exit(0)
+
+    if tracer is not None and args.trace_summary:
+        tracer.export_summary(args.trace_summary)
+    subprocess.run(["sudo", "killall", "pigpiod"])
+    logger.info("Controller stopped")
+    exit(0)
@@ -0,0 +1,39 @@
+import json
+from argparse import ArgumentParser
+
+from trpc.evaluation import evaluate_recordings
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Replays recordings through the online decision logic faster than real time, "
+                                        "and reports accuracy, rejections and servo actuations")
+    parser.add_argument("--recordings", type=str, nargs="+", required=True,
+                        help="Dataset stores (labeled), recorded sessions, or .npy or CSV recordings")
+    parser.add_argument("--classifiers", type=str, nargs="+", required=True, help="Paths of the classifiers")
+    parser.add_argument("--sampling-rate", type=float, default=860,
+                        help="Sampling rate of recordings that do not store theirs")
+    parser.add_argument("--window-size", type=int, default=250)
+    parser.add_argument("--window-increments", type=int, nargs="+", default=[10])
+    parser.add_argument("--feature-set", type=str, default="LS9")
+    parser.add_argument("--reps", type=int, nargs="+", default=None, help="Reps of dataset stores to replay")
+    parser.add_argument("--min-dwells", type=float, nargs="+", default=[0.0])
+    parser.add_argument("--queue-size", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--output", type=str, default=None, help="Path of a JSON file to write the results to")
+
+    args = parser.parse_args()
+
+    results = evaluate_recordings(args.recordings, args.classifiers, args.sampling_rate, args.window_size,
+                                  args.window_increments, args.feature_set, args.reps, args.min_dwells,
+                                  args.queue_size, args.processes)
+    for result in results:
+        logger.info(f"{result['recording']} with {result['classifier']}, increment {result['window_increment']}, "
+                    f"dwell {result['min_dwell']}: accuracy {result.get('accuracy', float('nan')):.3f}, "
+                    f"rejection rate {result['rejection_rate']:.3f}, {result['actuations']} actuations, "
+                    f"{result['speedup']:.0f}x real time")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,32 +1,46 @@
-import numpy as np
-import pickle
-import socket
-import time
-
-from alive_progress import alive_bar
 from argparse import ArgumentParser
 
+from trpc.recorder import is_session
+from trpc.replay import AS_FAST_AS_POSSIBLE, ReplayStreamer, convert_recording, start_replays
+
+
+def parse_speed(value: str) -> float:
+    return AS_FAST_AS_POSSIBLE if value == "max" else float(value)
+
 
 if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument('--file-path', type=str, default='data/OneSubjectMyoDataset/stream/raw_emg.csv')
+    parser = ArgumentParser(description="Replays a recording as one or more simulated devices")
+    parser.add_argument('--file-path', type=str, default='data/OneSubjectMyoDataset/stream/raw_emg.csv',
+                        help="Recording to replay, as .npy, CSV (converted to .npy next to it on first use) or a "
+                             "recorded session")
     parser.add_argument('--num-channels', type=int, default=8)
     parser.add_argument('--sampling-rate', type=int, default=200)
+    parser.add_argument('--wire-format', type=str, default='pickle', choices=['pickle', 'float32'])
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help="Replay speed relative to real time, or 'max' to replay as fast as possible")
+    parser.add_argument('--devices', type=int, default=1,
+                        help="Number of devices to replay concurrently, on consecutive ports starting at --port")
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--repeat', action='store_true', help="Replay the recording in a loop, e.g. for soak tests")
+    parser.add_argument('--duration', type=float, default=None, help="Stop after this many seconds")
 
     args = parser.parse_args()
-    file_path = args.file_path
-    sampling_rate = args.sampling_rate
-    num_channels = args.num_channels
 
-    # the following code is from libemg.streamers
-    data = np.loadtxt(file_path, delimiter=",")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    with alive_bar(len(data)) as bar:
-        for index in range(len(data)):
-            val = time.time() + (1000 / sampling_rate) / 1000
-            while time.time() < val:
-                pass
-            data_arr = pickle.dumps(list(data[index][:num_channels]))
-            sock.sendto(data_arr, ('127.0.0.1', 12345))
-            bar()
-    sock.close()
+    # Convert once in this process, rather than once per device
+    if args.file_path.endswith(".npy") or is_session(args.file_path):
+        recording = args.file_path
+    else:
+        recording = convert_recording(args.file_path)
+    streamers = [ReplayStreamer(recording, args.sampling_rate, speed=args.speed, channels=args.num_channels,
+                                repeat=args.repeat, duration=args.duration, port=args.port + device,
+                                wire_format=args.wire_format, batch_size=args.batch_size)
+                 for device in range(args.devices)]
+    processes = start_replays(streamers)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            # Each replayer also receives the interrupt, and reports and closes its socket
+            process.join(timeout=5)
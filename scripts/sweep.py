@@ -0,0 +1,34 @@
+import json
+from argparse import ArgumentParser
+
+from trpc.feature_cache import DATA_DIR
+from trpc.sweep import ADC_DATA_RATE, SWEEP_PARAMETERS, format_report, sweep
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Trains and ranks classifier configurations by held-out accuracy and "
+                                        "per-decision CPU cost")
+    parser.add_argument("--models", type=str, nargs="+", default=SWEEP_PARAMETERS["model"])
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=SWEEP_PARAMETERS["window_size"])
+    parser.add_argument("--window-increments", type=int, nargs="+", default=SWEEP_PARAMETERS["window_increment"])
+    parser.add_argument("--feature-sets", type=str, nargs="+", default=SWEEP_PARAMETERS["feature_set"])
+    parser.add_argument("--data", type=str, default=DATA_DIR, help="Folder of CSV recordings or a dataset store")
+    parser.add_argument("--classifier-path", type=str, default=None, help="Path to save the best classifier to")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--max-load", type=float, default=None,
+                        help="Fraction of a CPU that decisions may use, e.g. 0.5. Configurations over it rank last")
+    parser.add_argument("--sampling-rate", type=float, default=None,
+                        help=f"Samples per second the streamer delivers. Defaults to {ADC_DATA_RATE} divided by the "
+                             "number of channels")
+    parser.add_argument("--output", type=str, default=None, help="Path of a JSON file to write the results to")
+
+    args = parser.parse_args()
+
+    grid = {"model": args.models, "window_size": args.window_sizes, "window_increment": args.window_increments,
+            "feature_set": args.feature_sets}
+    results = sweep(grid, data_path=args.data, classifier_path=args.classifier_path, processes=args.processes,
+                    max_load=args.max_load, sampling_rate=args.sampling_rate)
+    print(format_report(results, args.max_load))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
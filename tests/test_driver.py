@@ -0,0 +1,118 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+from trpc.driver import ServoQueue
+
+
+class Servo:
+    """Records the commands it executes. While blocked, execute() waits until release() is called."""
+
+    def __init__(self, blocked: bool = False):
+        self.executed = []
+        self.times = []
+        self.started = threading.Event()
+        self._released = threading.Event()
+        if not blocked:
+            self._released.set()
+
+    def execute(self, command):
+        self.started.set()
+        self._released.wait()
+        self.executed.append(command["gesture"])
+        self.times.append(time.monotonic())
+        return True
+
+    def release(self):
+        self._released.set()
+
+
+def make_queue(servo: Servo, **kwargs) -> ServoQueue:
+    return ServoQueue(f"test-{uuid.uuid4().hex[:8]}", servo.execute, **kwargs)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_redundant_commands_are_dropped():
+    servo = Servo(blocked=True)
+    queue = make_queue(servo, queue_size=4)
+    results = []
+    try:
+        assert queue.submit("open", {"gesture": "open"})
+        servo.started.wait(5)
+        # The same gesture as the one running, then as the one last in line
+        assert not queue.submit("open", {"gesture": "open"}, lambda actuated, _: results.append(actuated))
+        assert queue.submit("close", {"gesture": "close"})
+        assert not queue.submit("close", {"gesture": "close"})
+        servo.release()
+        wait_for(lambda: queue.actuated == 2)
+        # And as the position the servo holds
+        assert not queue.submit("close", {"gesture": "close"})
+    finally:
+        queue.close(timeout=5)
+    assert servo.executed == ["open", "close"]
+    assert results == [False]
+    assert queue.coalesced == 3
+
+
+def test_full_queue_keeps_the_latest_targets():
+    servo = Servo(blocked=True)
+    queue = make_queue(servo, queue_size=2)
+    results = {}
+    try:
+        queue.submit("rest", {"gesture": "rest"})
+        servo.started.wait(5)
+        for gesture in ("open", "close", "point", "pinch"):
+            queue.submit(gesture, {"gesture": gesture},
+                         lambda actuated, _, gesture=gesture: results.__setitem__(gesture, actuated))
+        assert queue.depth == 2
+        servo.release()
+        wait_for(lambda: len(results) == 4)
+    finally:
+        queue.close(timeout=5)
+    assert servo.executed == ["rest", "point", "pinch"]
+    assert results == {"open": False, "close": False, "point": True, "pinch": True}
+
+
+def test_servo_holds_each_position_for_the_dwell_time():
+    servo = Servo()
+    queue = make_queue(servo, queue_size=1, min_dwell=0.2)
+    try:
+        queue.submit("open", {"gesture": "open"})
+        wait_for(lambda: queue.actuated == 1)
+        # Flickering decisions during the dwell only leave the newest one
+        for gesture in ("close", "open", "close", "point"):
+            queue.submit(gesture, {"gesture": gesture})
+            time.sleep(0.01)
+        wait_for(lambda: queue.actuated == 2)
+    finally:
+        queue.close(timeout=5)
+    assert servo.executed == ["open", "point"]
+    assert servo.times[1] - servo.times[0] >= 0.2
+
+
+def test_close_drops_pending_commands():
+    servo = Servo(blocked=True)
+    queue = make_queue(servo, queue_size=2)
+    results = []
+    queue.submit("open", {"gesture": "open"})
+    servo.started.wait(5)
+    queue.submit("close", {"gesture": "close"}, lambda actuated, _: results.append(actuated))
+    threading.Timer(0.05, servo.release).start()
+    queue.close(timeout=5)
+    assert results == [False]
+    assert servo.executed == ["open"]
+    assert not queue.submit("point", {"gesture": "point"})
+
+
+@pytest.mark.parametrize("kwargs", [{"queue_size": 0}, {"min_dwell": -1.0}])
+def test_invalid_parameters_are_rejected(kwargs):
+    with pytest.raises(ValueError):
+        make_queue(Servo(), **kwargs)
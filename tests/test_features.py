@@ -0,0 +1,69 @@
+import numpy as np
+from libemg.feature_extractor import FeatureExtractor
+
+from trpc.features import INCREMENTAL_FEATURES, StreamingFeatureExtractor
+
+WINDOW_SIZE = 250
+# Every incremental feature, a whole-window feature and one that falls back to libemg
+FEATURES = list(INCREMENTAL_FEATURES) + ["LS", "SKEW"]
+FEATURE_PARAMS = {"WAMP_threshold": 0.01}
+
+
+def make_emg(samples: int = 3000, channels: int = 4, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.normal(scale=0.05, size=(samples, channels)) + 0.1 * np.sin(np.arange(samples) / 20)[:, np.newaxis]
+
+
+def assert_matches_batch(features, window: np.ndarray):
+    expected = FeatureExtractor().extract_features(FEATURES, window.T[np.newaxis], FEATURE_PARAMS)
+    assert list(features) == FEATURES
+    for name in FEATURES:
+        np.testing.assert_allclose(features[name], expected[name], rtol=1e-7, atol=1e-10, err_msg=name)
+
+
+def stream(extractor: StreamingFeatureExtractor, emg: np.ndarray, shifts, reported=None):
+    """Slides the window over the recording by each shift in turn, reporting `reported` as the shift if it is set"""
+    end = WINDOW_SIZE
+    extractor.extract(emg[:end])
+    for step, shift in enumerate(shifts):
+        end += shift
+        window = emg[end - WINDOW_SIZE:end]
+        features = extractor.extract(window, shift if reported is None else reported[step])
+        assert_matches_batch(features, window)
+
+
+def test_consecutive_shifts_match_batch_extraction():
+    extractor = StreamingFeatureExtractor(FEATURES, WINDOW_SIZE, FEATURE_PARAMS)
+    stream(extractor, make_emg(), [10] * 100 + [1, 7, 33, 249, 3])
+    assert extractor.incremental_features == list(INCREMENTAL_FEATURES)
+    assert extractor.fallback_features == ["SKEW"]
+
+
+def test_resync_matches_batch_extraction():
+    extractor = StreamingFeatureExtractor(FEATURES, WINDOW_SIZE, FEATURE_PARAMS, resync_interval=4)
+    stream(extractor, make_emg(), [10] * 30)
+
+
+def test_misaligned_shift_is_recomputed():
+    # Shifts that do not match how far the window actually moved, or that are unknown, must not corrupt the sums
+    extractor = StreamingFeatureExtractor(FEATURES, WINDOW_SIZE, FEATURE_PARAMS)
+    shifts = [10, 10, 13, 10, 10, 260, 10, 10]
+    stream(extractor, make_emg(), shifts, reported=[10, 10, 10, 7, None, 10, 10, 10])
+
+
+def test_wrong_shift_on_flat_signal_is_recomputed():
+    # Clipped stretches where the first and last samples of the overlap line up for the wrong shift as well
+    emg = make_emg()
+    emg[7:11] = 1.0
+    emg[249:253] = -1.0
+    extractor = StreamingFeatureExtractor(FEATURES, WINDOW_SIZE, FEATURE_PARAMS)
+    stream(extractor, emg, [10, 10], reported=[7, 10])
+
+
+def test_reset_recomputes_from_scratch():
+    extractor = StreamingFeatureExtractor(FEATURES, WINDOW_SIZE, FEATURE_PARAMS)
+    emg = make_emg()
+    extractor.extract(emg[:WINDOW_SIZE])
+    extractor.reset()
+    window = emg[10:WINDOW_SIZE + 10]
+    assert_matches_batch(extractor.extract(window, 10), window)
@@ -0,0 +1,58 @@
+import numpy as np
+from libemg.feature_extractor import FeatureExtractor
+from libemg.utils import get_windows
+
+from trpc.inference import MAX_BATCH, LinearInferenceEngine
+from trpc.training import fit_classifier, format_features
+
+
+def make_features(classes: int, seed: int = 0):
+    """Windows of synthetic recordings whose classes overlap, so that some decisions fall under the rejection
+    threshold"""
+    rng = np.random.default_rng(seed)
+    windows, labels = [], []
+    for label in range(classes):
+        emg = rng.normal(scale=0.05 * (1 + 0.02 * label), size=(3000, 4))
+        recording = get_windows(emg, 250, 50)
+        windows.append(recording)
+        labels.append(np.full(len(recording), label))
+    features = FeatureExtractor().extract_feature_group("LS4", np.concatenate(windows))
+    return features, np.concatenate(labels)
+
+
+def libemg_decisions(emg, features: np.ndarray):
+    """Decides as libemg's OnlineEMGClassifier does, one window at a time"""
+    probabilities = emg.classifier.predict_proba(features)
+    predictions, confidence = emg._prediction_helper(probabilities)
+    return np.array([emg._rejection_helper(p, c) for p, c in zip(predictions, confidence)]), probabilities
+
+
+def assert_matches_libemg(classes: int):
+    features, labels = make_features(classes)
+    emg = fit_classifier(features, labels, "LDA")
+    engine = LinearInferenceEngine.from_classifier(emg)
+    formatted = format_features(features)
+
+    expected_predictions, expected_probabilities = libemg_decisions(emg, formatted)
+    assert -1 in expected_predictions and (expected_predictions >= 0).any()
+
+    # One window at a time, as the classification loop does while it keeps up
+    for row in range(len(formatted)):
+        predictions, probabilities = engine.classify(formatted[row:row + 1])
+        np.testing.assert_array_equal(probabilities, emg.classifier.predict_proba(formatted[row:row + 1]))
+        assert predictions[0] == expected_predictions[row]
+
+    # Full batches, as when it catches up on a backlog
+    for start in range(0, len(formatted), MAX_BATCH):
+        batch = formatted[start:start + MAX_BATCH]
+        predictions, probabilities = engine.classify(batch)
+        np.testing.assert_array_equal(probabilities, emg.classifier.predict_proba(batch))
+        np.testing.assert_array_equal(predictions, expected_predictions[start:start + MAX_BATCH])
+
+
+def test_matches_libemg_lda():
+    assert_matches_libemg(3)
+
+
+def test_matches_libemg_two_class_lda():
+    assert_matches_libemg(2)
@@ -0,0 +1,100 @@
+import json
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from trpc.utils.metrics import Counter, Histogram, MetricsRegistry
+
+UPDATES = 20000
+
+
+def observe_many(histogram: Histogram, counter: Counter):
+    for _ in range(UPDATES):
+        histogram.observe(0.003)
+        counter.inc()
+
+
+def test_concurrent_updates_are_not_lost():
+    # As the decision latency histogram, updated from every servo worker and the event loop, and from another process
+    histogram = Histogram("latency_seconds", "Latency")
+    counter = Counter("decisions_total", "Decisions")
+    threads = [threading.Thread(target=observe_many, args=(histogram, counter)) for _ in range(4)]
+    process = multiprocessing.Process(target=observe_many, args=(histogram, counter))
+    process.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    process.join()
+
+    assert counter.value == 5 * UPDATES
+    assert histogram.count == 5 * UPDATES
+    assert histogram.sum == pytest.approx(5 * UPDATES * 0.003)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.01, 0.1), labels={"stage": "classify"})
+    for value in (0.005, 0.01, 0.05, 2.0):
+        histogram.observe(value)
+    samples = {(name, labels.get("le")): value for name, labels, value in histogram.samples()}
+    assert samples == {
+        ("latency_seconds_bucket", "0.01"): 2,
+        ("latency_seconds_bucket", "0.1"): 3,
+        ("latency_seconds_bucket", "+Inf"): 4,
+        ("latency_seconds_sum", None): pytest.approx(2.065),
+        ("latency_seconds_count", None): 4,
+    }
+
+
+def test_invalid_buckets_are_rejected():
+    with pytest.raises(ValueError):
+        Histogram("latency_seconds", "Latency", buckets=(0.1, 0.01))
+
+
+def test_registry_returns_the_same_metric():
+    registry = MetricsRegistry()
+    counter = registry.counter("samples_total", "Samples", labels={"stream": "a"})
+    assert registry.counter("samples_total", "Samples", labels={"stream": "a"}) is counter
+    assert registry.counter("samples_total", "Samples", labels={"stream": "b"}) is not counter
+    with pytest.raises(ValueError):
+        registry.gauge("samples_total", "Samples", labels={"stream": "a"})
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("samples_total", "Samples", labels={"stream": 'a"b'}).inc(3)
+    registry.gauge("queue_depth", "Depth").set(2)
+    registry.gauge("computed", "Computed").set_function(lambda: 1.5)
+    assert registry.render().splitlines() == [
+        "# HELP computed Computed",
+        "# TYPE computed gauge",
+        "computed 1.5",
+        "# HELP queue_depth Depth",
+        "# TYPE queue_depth gauge",
+        "queue_depth 2.0",
+        "# HELP samples_total Samples",
+        "# TYPE samples_total counter",
+        'samples_total{stream="a\\"b"} 3.0',
+    ]
+
+
+def test_snapshots_include_counter_rates(tmp_path):
+    registry = MetricsRegistry()
+    counter = registry.counter("samples_total", "Samples")
+    path = tmp_path / "metrics.json"
+    registry.start_snapshots(str(path), interval=0.05)
+    deadline = time.monotonic() + 5
+    try:
+        while time.monotonic() < deadline:
+            counter.inc(10)
+            time.sleep(0.01)
+            if path.exists():
+                snapshot = json.loads(path.read_text())
+                if "rates" in snapshot:
+                    break
+    finally:
+        registry.stop()
+    assert snapshot["rates"]["samples_total"] > 0
+    assert snapshot["metrics"]["samples_total"] > 0
@@ -0,0 +1,104 @@
+import json
+import math
+
+import numpy as np
+import pytest
+
+from trpc.dataset import EMGDataset
+from trpc.recorder import DECISION_DTYPE, Session, SessionRecorder, SegmentWriter, convert_session, emg_dtype
+
+FLUSH_INTERVAL = 0.01
+
+
+def record(path: str, emg: np.ndarray, decisions=(), segment_rows: int = 64) -> Session:
+    recorder = SessionRecorder(path, emg_segment_rows=segment_rows, decision_segment_rows=4,
+                               flush_interval=FLUSH_INTERVAL)
+    for row, sample in enumerate(emg):
+        recorder.record_emg(sample.tolist(), float(row))
+    for gesture, sample_time in decisions:
+        recorder.record_decision(gesture, {"sample": sample_time, "classified": sample_time + 0.5})
+    recorder.close()
+    return Session(path)
+
+
+def test_segments_rotate_and_are_indexed(tmp_path):
+    emg = np.arange(200 * 4, dtype=np.float32).reshape(200, 4)
+    session = record(str(tmp_path / "session"), emg)
+
+    with open(tmp_path / "session" / "emg.json") as f:
+        segments = json.load(f)["segments"]
+    assert [segment["file"] for segment in segments] == [f"emg-{i:05d}.npy" for i in range(4)]
+    assert [segment["rows"] for segment in segments] == [64, 64, 64, 8]
+    assert [(segment["start"], segment["stop"]) for segment in segments] == [(0, 63), (64, 127), (128, 191),
+                                                                             (192, 199)]
+    np.testing.assert_array_equal(session.emg(), emg)
+    np.testing.assert_array_equal(session.timestamps(), np.arange(200))
+    assert session.streams == ["emg"]
+
+
+def test_decisions_keep_missing_trace_points_as_nan(tmp_path):
+    session = record(str(tmp_path / "session"), np.zeros((10, 2)), [(1, 3.0), (0, 7.0), (2, 9.0), (1, 9.5), (0, 20.0)])
+    decisions = session.decisions()
+    assert decisions.dtype == DECISION_DTYPE
+    assert decisions["gesture"].tolist() == [1, 0, 2, 1, 0]
+    assert decisions["sample"].tolist() == [3.0, 7.0, 9.0, 9.5, 20.0]
+    assert all(math.isnan(value) for value in decisions["decided"])
+
+
+def test_writer_resumes_an_existing_stream(tmp_path):
+    dtype = emg_dtype(1)
+    for rows in (50, 30):
+        writer = SegmentWriter(str(tmp_path), "emg", dtype, 64, flush_interval=FLUSH_INTERVAL)
+        for row in range(rows):
+            writer.append((float(row), [float(row)]))
+        writer.close()
+    assert writer.rows == 80
+
+    with open(tmp_path / "emg.json") as f:
+        assert [segment["rows"] for segment in json.load(f)["segments"]] == [64, 16]
+    session_rows = np.concatenate([np.load(tmp_path / f"emg-{i:05d}.npy")[:rows] for i, rows in enumerate((64, 16))])
+    assert session_rows["time"].tolist() == list(range(50)) + list(range(30))
+
+
+def test_writer_rejects_another_row_type(tmp_path):
+    with open(tmp_path / "emg.json", "w") as f:
+        json.dump({"dtype": np.lib.format.dtype_to_descr(emg_dtype(2)), "segments": []}, f)
+    with pytest.raises(ValueError):
+        SegmentWriter(str(tmp_path), "emg", emg_dtype(3), 8, flush_interval=FLUSH_INTERVAL)
+
+
+def test_dropped_rows_are_counted(tmp_path):
+    writer = SegmentWriter(str(tmp_path), "emg", emg_dtype(1), 8, flush_interval=60, max_pending=5)
+    for row in range(8):
+        writer.append((float(row), [0.0]))
+    writer.close()
+    assert (writer.rows, writer.dropped) == (5, 3)
+
+
+def test_session_path_is_not_reused(tmp_path):
+    record(str(tmp_path / "session"), np.zeros((1, 1)))
+    with pytest.raises(ValueError):
+        SessionRecorder(str(tmp_path / "session"))
+
+
+def test_labels_follow_the_decisions(tmp_path):
+    session = record(str(tmp_path / "session"), np.zeros((12, 1)), [(1, 3.0), (-1, 6.0), (2, 9.0)])
+    assert session.labels().tolist() == [1] * 4 + [-1] * 3 + [2] * 3 + [-1] * 2
+
+
+def test_convert_session_requires_labels(tmp_path):
+    emg = np.random.default_rng(0).normal(size=(40, 2)).astype(np.float32)
+    record(str(tmp_path / "session"), emg, [(0, 19.0), (1, 39.0)])
+    with pytest.raises(ValueError):
+        convert_session(str(tmp_path / "session"), str(tmp_path / "dataset"))
+
+    labels = np.repeat([1, 0, -1, 1], 10)
+    convert_session(str(tmp_path / "session"), str(tmp_path / "dataset"), labels)
+    dataset = EMGDataset(str(tmp_path / "dataset"))
+    assert sorted(dataset.metadata()["classes"].tolist()) == [0, 1, 1]
+    assert sorted(len(recording) for recording in dataset.recordings()) == [10, 10, 10]
+    assert sorted(map(tuple, np.concatenate(dataset.recordings()).tolist())) == \
+        sorted(map(tuple, np.concatenate([emg[:20], emg[30:]]).tolist()))
+
+    convert_session(str(tmp_path / "session"), str(tmp_path / "decisions"), use_decisions=True)
+    assert sorted(EMGDataset(str(tmp_path / "decisions")).metadata()["classes"].tolist()) == [0, 1]
@@ -0,0 +1,81 @@
+import multiprocessing
+import uuid
+
+import numpy as np
+import pytest
+
+from trpc.ring_buffer import SharedRingBuffer
+
+
+@pytest.fixture
+def ring_buffer():
+    buffer = SharedRingBuffer(name=f"trpc_test_{uuid.uuid4().hex[:8]}", channels=2, capacity=16, max_window=6)
+    yield buffer
+    buffer.close()
+
+
+def rows(start: int, stop: int) -> np.ndarray:
+    return np.repeat(np.arange(start, stop, dtype=np.float32)[:, np.newaxis], 2, axis=1)
+
+
+def test_windows_wrap_around(ring_buffer):
+    writer = SharedRingBuffer(name=ring_buffer.name, create=False)
+    try:
+        writer.write(rows(0, 3))
+        for start in range(3, 40, 3):
+            writer.write(rows(start, start + 3))
+            # Every window is contiguous, including those across the end of the buffer
+            np.testing.assert_array_equal(ring_buffer.read(6, increment=3, timeout=0), rows(start - 3, start + 3))
+        assert (ring_buffer.overruns, writer.overwritten) == (0, 0)
+        np.testing.assert_array_equal(ring_buffer.latest(6), rows(36, 42))
+        np.testing.assert_array_equal(ring_buffer.window(30, 36), rows(30, 36))
+    finally:
+        writer.close()
+
+
+def test_copies_are_not_changed_by_later_writes(ring_buffer):
+    ring_buffer.write(rows(0, 6))
+    window = ring_buffer.read(6, timeout=0)
+    ring_buffer.write(rows(6, 30))
+    np.testing.assert_array_equal(window, rows(0, 6))
+
+
+def test_overrun_is_counted_on_both_sides(ring_buffer):
+    ring_buffer.write(rows(0, 10))
+    ring_buffer.write(rows(10, 20))
+    assert ring_buffer.overwritten == 4
+    # The reader skips to the newest window
+    np.testing.assert_array_equal(ring_buffer.read(6, increment=6, timeout=0), rows(14, 20))
+    assert ring_buffer.overruns == 1
+    assert ring_buffer.read(6, timeout=0) is None
+
+
+def test_overwritten_window_is_rejected(ring_buffer):
+    for start in range(0, 30, 10):
+        ring_buffer.write(rows(start, start + 10))
+    with pytest.raises(ValueError):
+        ring_buffer.window(10, 16)
+    with pytest.raises(ValueError):
+        ring_buffer.window(28, 32)
+
+
+def write_sequence(name: str, count: int):
+    writer = SharedRingBuffer(name=name, create=False)
+    for start in range(0, count, 5):
+        writer.write(rows(start, start + 5))
+    writer.close()
+
+
+def test_windows_from_another_process_are_consistent():
+    reader = SharedRingBuffer(name=f"trpc_test_{uuid.uuid4().hex[:8]}", channels=2, capacity=64, max_window=32)
+    process = multiprocessing.Process(target=write_sequence, args=(reader.name, 100000))
+    process.start()
+    try:
+        while process.is_alive() or reader.available() >= 32:
+            window = reader.read(32, increment=8, timeout=0.1)
+            if window is not None:
+                # A window that was overwritten or published before its samples would break the sequence
+                np.testing.assert_array_equal(window[:, 0], np.arange(window[0, 0], window[0, 0] + 32))
+    finally:
+        process.join()
+        reader.close()
@@ -0,0 +1,29 @@
+import os
+
+from trpc.scheduling import PlacementPolicy, StagePolicy
+
+
+def test_vanished_threads_do_not_stop_the_placement():
+    policy = PlacementPolicy(processor=StagePolicy(nice=0), interval=None)
+    placed = []
+
+    def place(tid: int):
+        if tid == 2:
+            raise ProcessLookupError(tid)
+        placed.append(tid)
+
+    assert policy._apply("processor", "nice", place, [1, 2, 3])
+    assert placed == [1, 3]
+
+
+def test_processor_stage_includes_the_raw_data_manager():
+    from trpc.data_handler import TRPCDataHandler
+
+    handler = TRPCDataHandler(port=0, wire_format="float32")
+    handler.start_listening()
+    try:
+        pids = [process.pid for process in handler.processes]
+        assert len(set(pids)) == 2 and os.getpid() not in pids
+        assert all(os.path.exists(f"/proc/{pid}") for pid in pids)
+    finally:
+        handler.stop_listening()
@@ -0,0 +1,94 @@
+import multiprocessing
+import socket
+import time
+
+import pytest
+
+from trpc.recorder import Session, SessionRecorder
+from trpc.streamer import Streamer
+from trpc.supervisor import StreamerSupervisor
+
+FLUSH_INTERVAL = 0.05
+
+
+class CrashingStreamer(Streamer):
+    """Writes 500 samples and exits with an error in its first process, then writes 100 samples and idles"""
+
+    def __init__(self, port: int):
+        super().__init__(port=port)
+        self._runs = multiprocessing.Value("i", 0)
+
+    def read_emg(self):
+        with self._runs.get_lock():
+            self._runs.value += 1
+            run = self._runs.value
+        for sample in range(500 if run == 1 else 100):
+            self.write_emg([float(sample)] * 4, time.time())
+        # Leaves the recorder time to index the samples
+        time.sleep(5 * FLUSH_INTERVAL)
+        if run == 1:
+            raise RuntimeError("I2C error")
+        time.sleep(60)
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    yield sock
+    sock.close()
+
+
+def test_restart_keeps_recorded_samples(tmp_path, receiver):
+    streamer = CrashingStreamer(receiver.getsockname()[1])
+    recorder = SessionRecorder(str(tmp_path / "session"), flush_interval=FLUSH_INTERVAL)
+    streamer.set_recorder(recorder)
+    supervisor = StreamerSupervisor(stall_timeout=1.0, interval=0.05, backoff=0.0)
+
+    def respawn():
+        process = multiprocessing.Process(target=streamer.read_emg, daemon=True)
+        process.start()
+        return process
+
+    supervisor.start(streamer, respawn(), respawn)
+    deadline = time.monotonic() + 10
+    try:
+        while not supervisor.gaps and time.monotonic() < deadline:
+            # The new process is forked here, on the main thread
+            supervisor.poll()
+            time.sleep(0.01)
+        time.sleep(5 * FLUSH_INTERVAL)
+    finally:
+        supervisor.stop()
+        supervisor.process.terminate()
+        supervisor.process.join()
+
+    assert supervisor.restarts == 1
+    assert [(gap.reason, gap.restarts) for gap in supervisor.gaps] == [("exited", 1)]
+    assert streamer.samples_written == 600
+    emg = Session(recorder.path).emg()
+    assert len(emg) == 600
+    assert emg[:500, 0].tolist() == list(range(500))
+    assert emg[500:, 0].tolist() == list(range(100))
+
+
+def test_no_restart_without_poll(receiver):
+    # The background thread only asks for a restart; the process is started by poll()
+    streamer = CrashingStreamer(receiver.getsockname()[1])
+    supervisor = StreamerSupervisor(stall_timeout=1.0, interval=0.05, backoff=0.0)
+    spawned = []
+
+    def respawn():
+        spawned.append(multiprocessing.Process(target=streamer.read_emg, daemon=True))
+        spawned[-1].start()
+        return spawned[-1]
+
+    supervisor.start(streamer, respawn(), respawn)
+    time.sleep(1.0)
+    assert len(spawned) == 1 and supervisor.restarts == 0
+    assert supervisor.poll()
+    supervisor.stop()
+    assert len(spawned) == 2 and supervisor.restarts == 1
+    for process in spawned:
+        process.terminate()
+        process.join()
@@ -0,0 +1,85 @@
+import socket
+import time
+
+import numpy as np
+import pytest
+
+from trpc.data_handler import TRPCDataHandler
+from trpc.wire import FRAME_HEADER_SIZE, SEQUENCE_MODULUS, SequenceTracker, decode_frame, encode_frame, is_frame
+
+
+def test_float32_round_trip():
+    samples = np.arange(24, dtype=np.float32).reshape(6, 4) / 10
+    frame = decode_frame(encode_frame(samples, 7, 12.5))
+    assert (frame.sequence, frame.timestamp, frame.channels) == (7, 12.5, 4)
+    np.testing.assert_array_equal(frame.to_voltage(), samples)
+
+
+def test_int16_round_trip_scales_counts():
+    frame = decode_frame(encode_frame([100, -200, 300], 1, 0.0, "int16", 0.5))
+    assert frame.samples.dtype == np.int16 and frame.samples.shape == (1, 3)
+    np.testing.assert_array_equal(frame.to_voltage(), [[50, -100, 150]])
+
+
+def test_sequence_wraps_around():
+    assert decode_frame(encode_frame([0.0], SEQUENCE_MODULUS + 3, 0.0)).sequence == 3
+
+
+@pytest.mark.parametrize("data", [b"TR", b"XX" + bytes(FRAME_HEADER_SIZE), encode_frame([1.0, 2.0], 0, 0.0)[:-1]])
+def test_malformed_frames_are_rejected(data):
+    with pytest.raises(ValueError):
+        decode_frame(data)
+
+
+def test_pickle_is_not_a_frame():
+    assert not is_frame(b"\x80\x04\x95" + bytes(FRAME_HEADER_SIZE))
+
+
+def test_tracker_counts_dropped_frames():
+    tracker = SequenceTracker()
+    for sequence in (0, 1, 4, 5, 9):
+        tracker.update(sequence)
+    assert (tracker.received, tracker.dropped, tracker.reordered) == (5, 5, 0)
+
+
+def test_tracker_counts_late_frames_as_reordered():
+    tracker = SequenceTracker()
+    for sequence in (0, 2, 1, 3):
+        tracker.update(sequence)
+    assert (tracker.received, tracker.dropped, tracker.reordered) == (4, 0, 1)
+
+
+def test_tracker_follows_the_wraparound():
+    tracker = SequenceTracker()
+    for sequence in (SEQUENCE_MODULUS - 2, SEQUENCE_MODULUS - 1, 1):
+        tracker.update(sequence)
+    assert (tracker.dropped, tracker.reordered) == (1, 0)
+
+
+def test_handler_appends_whole_frames():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    port = receiver.getsockname()[1]
+    receiver.close()
+
+    handler = TRPCDataHandler(port=port, wire_format="float32")
+    handler.start_listening()
+    try:
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        samples = np.arange(80, dtype=np.float32).reshape(20, 4)
+        deadline = time.monotonic() + 5
+        # The listener may not have bound its socket yet
+        while not handler.get_stream_stats()["frames"] and time.monotonic() < deadline:
+            sender.sendto(encode_frame(samples[:0], 0, 0.0), ("127.0.0.1", port))
+            time.sleep(0.05)
+        time.sleep(0.1)
+        handler.raw_data.reset_emg()
+        frames = handler.get_stream_stats()["frames"]
+        for sequence, start in enumerate(range(0, 20, 5), frames):
+            sender.sendto(encode_frame(samples[start:start + 5], sequence, time.time()), ("127.0.0.1", port))
+        while handler.get_stream_stats()["frames"] < frames + 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        sender.close()
+        np.testing.assert_array_equal(np.array(handler.raw_data.get_emg()), samples)
+    finally:
+        handler.stop_listening()
@@ -1,4 +1,42 @@
-from .streamer import Streamer, TRPCStreamer
-from .processor import Processor, TRPCProcessor
-from .controller import Controller
-from .driver import Driver, TRPCDriver
+import importlib
+from typing import TYPE_CHECKING
+
+# Submodules are imported on first access, so that `import trpc` does not pull in libemg, pigpio, gpiozero or ADS1x15
+# until they are needed
+_LAZY_ATTRIBUTES = {
+    "Streamer": ".streamer",
+    "TRPCStreamer": ".streamer",
+    "MultiBoardStreamer": ".streamer",
+    "ReplayStreamer": ".replay",
+    "SessionRecorder": ".recorder",
+    "TRPCDataHandler": ".data_handler",
+    "Processor": ".processor",
+    "TRPCProcessor": ".processor",
+    "Controller": ".controller",
+    "Driver": ".driver",
+    "TRPCDriver": ".driver",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+if TYPE_CHECKING:
+    from .streamer import MultiBoardStreamer, Streamer, TRPCStreamer
+    from .replay import ReplayStreamer
+    from .recorder import SessionRecorder
+    from .data_handler import TRPCDataHandler
+    from .processor import Processor, TRPCProcessor
+    from .controller import Controller
+    from .driver import Driver, TRPCDriver
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    # Cache the attribute so that __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
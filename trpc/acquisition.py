@@ -0,0 +1,275 @@
+import collections
+import threading
+import time
+from typing import Deque, List, NamedTuple, Optional, Sequence, Tuple
+
+from gpiozero import DigitalInputDevice
+from gpiozero.pins import Factory
+
+from trpc.utils.logger import get_hot_logger, get_logger
+
+logger = get_logger(__name__)
+hot_logger = get_hot_logger(__name__)
+
+ACQUISITION_MODES = ("single", "continuous")
+WAIT_STRATEGIES = ("poll", "sleep", "alert")
+
+# Samples per second for each ADS111x data rate register value
+ADS111X_DATA_RATES = {0: 8, 1: 16, 2: 32, 3: 64, 4: 128, 5: 250, 6: 475, 7: 860}
+# The internal oscillator of the ADS111x is specified to be within 10% of its nominal rate, so a conversion is
+# guaranteed to be done after 1.1 times its nominal duration and can not be done before 0.9 times of it
+CONVERSION_TOLERANCE = 0.1
+# How long to sleep between polls of the conversion register once the expected conversion time has passed
+POLL_INTERVAL = 50e-6
+# time.sleep() tends to overshoot by this much on a Pi, so wake up early and poll the rest of the way
+SLEEP_MARGIN = 200e-6
+
+
+class Reading(NamedTuple):
+    """One conversion result per channel, with the time (time.time()) at which each conversion completed."""
+    values: List[int]
+    timestamps: List[float]
+
+
+class ConversionScheduler:
+    """Schedules ADS1115 conversions across channels. The conversion of the next channel is always started as soon as
+    the result of the previous one has been read, so the device converts while the caller handles the previous result
+    (e.g. while a frame is sent) instead of sitting idle.
+
+    Instead of busy-polling isReady() over I2C, the scheduler can sleep for the expected conversion time ("sleep") or
+    block on the ALERT/RDY pin ("alert"). "poll" keeps the original tight polling loop.
+
+        Args:
+            adc: An ADS1115, or a SimulatedADS1115 for off-device use
+            channels: The single-ended inputs to convert, in order
+            mode: "single" for pipelined single-shot conversions, or "continuous" to leave the device converting and
+                  switch the input multiplexer between channels
+            wait: How to wait for a conversion to complete. One of "poll", "sleep" or "alert"
+            data_rate: The data rate register value, e.g. ADS1115.DR_ADS111X_860
+            gain: The gain register value, e.g. ADS1115.PGA_4_096V
+            alert_pin: GPIO pin connected to ALERT/RDY. Required for the "alert" wait strategy
+            pin_factory: gpiozero pin factory for the ALERT/RDY pin. Defaults to gpiozero's default factory
+    """
+
+    def __init__(self, adc, channels: Sequence[int] = (0, 1, 2, 3), mode: str = "single", wait: str = "sleep",
+                 data_rate: int = 7, gain: int = 1, alert_pin: Optional[int] = None,
+                 pin_factory: Optional[Factory] = None):
+        if mode not in ACQUISITION_MODES:
+            raise ValueError(f"Invalid mode: {mode}")
+        if wait not in WAIT_STRATEGIES:
+            raise ValueError(f"Invalid wait strategy: {wait}")
+        if wait == "alert" and alert_pin is None:
+            raise ValueError("The alert wait strategy requires an alert_pin")
+        if not channels:
+            raise ValueError("At least one channel is required")
+
+        self._adc = adc
+        self._channels = list(channels)
+        self._mode = mode
+        self._wait = wait
+        self._data_rate = data_rate
+        self._gain = gain
+        self._alert_pin = alert_pin
+        self._pin_factory = pin_factory
+
+        nominal = 1 / ADS111X_DATA_RATES.get(data_rate, 128)
+        self._min_conversion_time = nominal * (1 - CONVERSION_TOLERANCE)
+        self._conversion_time = nominal * (1 + CONVERSION_TOLERANCE)
+        self._ready = threading.Event()
+        self._ready_device: Optional[DigitalInputDevice] = None
+        self._requested_at = 0.0
+        self._next = 0
+        self._running = False
+
+        # Number of times the conversion register had to be re-checked, and number of timed out waits
+        self._polls = 0
+        self._timeouts = 0
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def wait(self):
+        return self._wait
+
+    @property
+    def polls(self):
+        return self._polls
+
+    @property
+    def timeouts(self):
+        return self._timeouts
+
+    def start(self):
+        """Configures the device and starts the first conversion"""
+        self._adc.setDataRate(self._data_rate)
+        self._adc.setGain(self._gain)
+
+        if self._wait == "alert":
+            # ALERT/RDY acts as a conversion ready pin when the high threshold MSB is 1 and the low threshold MSB is 0
+            self._adc.setComparatorThresholdHigh(0x8000)
+            self._adc.setComparatorThresholdLow(0x0000)
+            self._adc.setComparatorQueue(self._adc.COMP_QUE_1_CONV)
+            # The pin is active low, so pull it up and treat low as active
+            self._ready_device = DigitalInputDevice(self._alert_pin, pull_up=True, pin_factory=self._pin_factory)
+            self._ready_device.when_activated = self._ready.set
+
+        self._next = 0
+        if self._mode == "continuous":
+            self._adc.setInput(self._adc.INPUT_SINGLE_0 + self._channels[0])
+            self._requested_at = time.monotonic()
+            self._adc.setMode(self._adc.MODE_CONTINUOUS)
+            self._ready.clear()
+        else:
+            self._adc.setMode(self._adc.MODE_SINGLE)
+            self._request(self._channels[0])
+        self._running = True
+
+    def read(self) -> Reading:
+        """Reads one conversion per channel. The conversion of the first channel of the next reading is started before
+        this returns."""
+        if not self._running:
+            self.start()
+
+        values = [0] * len(self._channels)
+        timestamps = [0.0] * len(self._channels)
+        for i in range(len(self._channels)):
+            self._wait_for_conversion()
+            values[i] = self._adc.getValue()
+            timestamps[i] = time.time()
+
+            # Start converting the next channel before handing off this result
+            self._next = (self._next + 1) % len(self._channels)
+            self._request(self._channels[self._next])
+
+        return Reading(values, timestamps)
+
+    def stop(self):
+        """Stops scheduling conversions and releases the ALERT/RDY pin"""
+        self._running = False
+        if self._mode == "continuous":
+            self._adc.setMode(self._adc.MODE_SINGLE)
+        if self._ready_device is not None:
+            self._ready_device.close()
+            self._ready_device = None
+
+    def _request(self, channel: int):
+        self._requested_at = time.monotonic()
+        if self._mode == "continuous":
+            # Switching the multiplexer restarts the conversion in continuous mode
+            if len(self._channels) > 1:
+                self._adc.setInput(self._adc.INPUT_SINGLE_0 + channel)
+        else:
+            self._adc.requestADC(channel)
+        # Cleared after the request so that a ready signal from the previous conversion is not mistaken for this one
+        self._ready.clear()
+
+    def _wait_for_conversion(self):
+        if self._wait == "alert":
+            if not self._ready.wait(timeout=self._conversion_time * 4):
+                self._timeouts += 1
+                hot_logger.warning("Timed out waiting for ALERT/RDY. Falling back to polling.")
+                self._poll_until_ready()
+            return
+
+        if self._wait == "sleep":
+            # The OS bit is not updated in continuous mode, so sleep until the conversion is surely done. In single-shot
+            # mode, sleep until it could be done and poll from there.
+            duration = self._conversion_time if self._mode == "continuous" else self._min_conversion_time - SLEEP_MARGIN
+            remaining = self._requested_at + duration - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            if self._mode == "continuous":
+                return
+
+        if self._mode == "continuous":
+            # Busy-wait for the conversion time, since isReady() is not meaningful in continuous mode
+            while time.monotonic() - self._requested_at < self._conversion_time:
+                self._polls += 1
+            return
+
+        self._poll_until_ready()
+
+    def _poll_until_ready(self):
+        if self._mode == "continuous":
+            time.sleep(max(self._requested_at + self._conversion_time - time.monotonic(), 0))
+            return
+
+        deadline = time.monotonic() + self._conversion_time * 4
+        while not self._adc.isReady():
+            self._polls += 1
+            if time.monotonic() > deadline:
+                self._timeouts += 1
+                hot_logger.warning("Timed out waiting for a conversion to complete")
+                return
+            if self._wait != "poll":
+                time.sleep(POLL_INTERVAL)
+
+
+class Board(NamedTuple):
+    """An ADS1115 on an I2C bus and the inputs to read from it"""
+    bus: int = 1
+    address: int = 0x48
+    channels: Sequence[int] = (0, 1, 2, 3)
+    alert_pin: Optional[int] = None
+
+
+class FrameAligner:
+    """Merges the readings of several boards, each converting on its own clock, into frames that hold one reading of
+    every board. Readings are paired by their timestamps: a reading is only merged with readings of the other boards
+    taken within `tolerance` seconds of it, and a reading that has no such partner (e.g. because another board missed
+    a conversion) is dropped.
+
+        Args:
+            boards: Number of boards
+            tolerance: Maximum difference in seconds between the timestamps of the readings in a frame, usually half
+                       the time a board takes for one reading
+            max_pending: Maximum number of readings kept per board while waiting for the other boards
+    """
+
+    def __init__(self, boards: int, tolerance: float, max_pending: int = 64):
+        if boards < 1:
+            raise ValueError(f"Invalid number of boards: {boards}")
+        if tolerance <= 0:
+            raise ValueError(f"Invalid tolerance: {tolerance}")
+
+        self._tolerance = tolerance
+        self._pending: List[Deque[Reading]] = [collections.deque(maxlen=max_pending) for _ in range(boards)]
+        self._dropped = [0] * boards
+
+    @property
+    def dropped(self):
+        """Number of readings of each board that were dropped without a partner"""
+        return list(self._dropped)
+
+    def add(self, board: int, reading: Reading) -> List[Tuple[List[int], float]]:
+        """Adds a reading of a board
+
+            Returns:
+                The frames that are complete, in order, as the values of every board concatenated and the timestamp of
+                the earliest reading in the frame
+        """
+        pending = self._pending[board]
+        if len(pending) == pending.maxlen:
+            self._dropped[board] += 1
+        pending.append(reading)
+
+        frames = []
+        while all(self._pending):
+            heads = [queue[0].timestamps[0] for queue in self._pending]
+            newest = max(heads)
+            stale = [i for i, timestamp in enumerate(heads) if newest - timestamp > self._tolerance]
+            if stale:
+                # The newest head can not have a partner older than these, so they never will
+                for i in stale:
+                    self._pending[i].popleft()
+                    self._dropped[i] += 1
+                continue
+            readings = [queue.popleft() for queue in self._pending]
+            frames.append(([value for reading in readings for value in reading.values], min(heads)))
+        return frames
@@ -0,0 +1,136 @@
+from typing import Optional
+
+import numpy as np
+
+from trpc.model import LinearModel
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+ADAPTATION_SUFFIX = ".lda.npz"
+ADAPTATION_VERSION = 1
+
+
+class LDAStatistics:
+    """Sufficient statistics of a linear discriminant analysis: the number of windows and the mean feature vector of
+    each class, and the within-class scatter matrix. New labeled windows are folded in with update() at a cost
+    proportional to their number, and to_model() solves for the same classifier scikit-learn's
+    LinearDiscriminantAnalysis fits on all windows seen so far, so a model can be recalibrated on the device without
+    retraining from the full dataset.
+
+        Args:
+            classes: The class labels, in the order of the model outputs
+            counts: The number of windows of each class, which may be fractional after forgetting
+            means: The mean feature vector of each class, shaped (classes, features)
+            scatter: The sum over all windows of the outer product of their deviation from their class mean, shaped
+                     (features, features)
+    """
+
+    def __init__(self, classes: np.ndarray, counts: np.ndarray, means: np.ndarray, scatter: np.ndarray):
+        self._classes = np.asarray(classes)
+        self._counts = np.asarray(counts, dtype=np.float64).copy()
+        self._means = np.asarray(means, dtype=np.float64).copy()
+        self._scatter = np.asarray(scatter, dtype=np.float64).copy()
+        if self._counts.shape != (len(self._classes),) or self._means.shape[0] != len(self._classes):
+            raise ValueError(f"Invalid statistics for {len(self._classes)} classes")
+        if self._scatter.shape != (self.features, self.features):
+            raise ValueError(f"Invalid scatter shape: {self._scatter.shape}")
+
+    @classmethod
+    def from_features(cls, features: np.ndarray, labels: np.ndarray,
+                      classes: Optional[np.ndarray] = None) -> "LDAStatistics":
+        """Computes the statistics of labeled feature vectors, shaped (windows, features), e.g. the training set
+
+            Args:
+                features: The feature vectors, as format_features() stacks them
+                labels: The class of each window
+                classes: The class labels. Defaults to the labels present
+        """
+        features = np.asarray(features, dtype=np.float64)
+        if classes is None:
+            classes = np.unique(labels)
+        statistics = cls(classes, np.zeros(len(classes)), np.zeros((len(classes), features.shape[1])),
+                         np.zeros((features.shape[1], features.shape[1])))
+        statistics.update(features, labels)
+        return statistics
+
+    @classmethod
+    def load(cls, path: str) -> "LDAStatistics":
+        """Loads statistics written by save()"""
+        with np.load(path, allow_pickle=False) as artifact:
+            version = int(artifact["version"])
+            if version != ADAPTATION_VERSION:
+                raise ValueError(f"Invalid adaptation statistics version: {version}")
+            return cls(artifact["classes"], artifact["counts"], artifact["means"], artifact["scatter"])
+
+    @property
+    def classes(self):
+        return self._classes
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def means(self):
+        return self._means
+
+    @property
+    def features(self):
+        return self._means.shape[1]
+
+    def update(self, features: np.ndarray, labels: np.ndarray, decay: float = 1.0):
+        """Folds labeled feature vectors into the statistics, merging the mean and scatter of each class with those of
+        the new windows (Chan et al.'s parallel update), which is exact and numerically stable.
+
+            Args:
+                features: The feature vectors, shaped (windows, features)
+                labels: The class of each window, one of classes
+                decay: Weight of the windows seen so far relative to the new ones. Below 1, the statistics forget older
+                       data, e.g. from before an electrode shift, at the rate it is replaced
+        """
+        if not 0 < decay <= 1:
+            raise ValueError(f"Invalid decay: {decay}")
+        features = np.asarray(features, dtype=np.float64)
+        labels = np.asarray(labels)
+        if features.ndim != 2 or features.shape[1] != self.features or len(features) != len(labels):
+            raise ValueError(f"Invalid features shape: {features.shape}")
+        unknown = np.setdiff1d(labels, self._classes)
+        if len(unknown):
+            raise ValueError(f"Invalid labels, not among the classes: {unknown.tolist()}")
+
+        self._counts *= decay
+        self._scatter *= decay
+        for index, label in enumerate(self._classes):
+            batch = features[labels == label]
+            if not len(batch):
+                continue
+            mean = batch.mean(axis=0)
+            deviations = batch - mean
+            count = self._counts[index] + len(batch)
+            delta = mean - self._means[index]
+            self._scatter += deviations.T @ deviations
+            self._scatter += np.outer(delta, delta) * (self._counts[index] * len(batch) / count)
+            self._means[index] += delta * (len(batch) / count)
+            self._counts[index] = count
+
+    def to_model(self) -> LinearModel:
+        """Solves for the linear discriminant of the statistics, with the class priors estimated from the counts and
+        the covariance shared by all classes, as LinearDiscriminantAnalysis does. With two classes, the model has one
+        output, like scikit-learn's."""
+        total = self._counts.sum()
+        if not np.all(self._counts > 0):
+            raise ValueError("Invalid statistics, every class needs at least one window")
+        covariance = self._scatter / total
+        # A least-squares solution, which also holds if a feature is constant and the covariance singular
+        coef = np.linalg.lstsq(covariance, self._means.T, rcond=None)[0].T
+        intercept = -0.5 * np.sum(coef * self._means, axis=1) + np.log(self._counts / total)
+        if len(self._classes) == 2:
+            coef = coef[1:] - coef[:1]
+            intercept = intercept[1:] - intercept[:1]
+        return LinearModel(coef, intercept, self._classes)
+
+    def save(self, path: str):
+        """Saves the statistics to an .npz file"""
+        np.savez(path, version=ADAPTATION_VERSION, classes=self._classes, counts=self._counts, means=self._means,
+                 scatter=self._scatter)
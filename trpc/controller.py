@@ -1,15 +1,87 @@
+import asyncio
+import math
 import multiprocessing
+import os
+import select
+import signal
 import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 import pigpio
 from gpiozero import Servo
+from gpiozero.pins import Factory
 
 from trpc import Streamer, Processor
-from trpc.utils.logger import get_logger
+from trpc.recorder import SessionRecorder
+from trpc.scheduling import PlacementPolicy
+from trpc.supervisor import Gap, StreamerSupervisor
+from trpc.utils.logger import get_hot_logger, get_log_queue, get_logger, run_with_log_queue
+from trpc.utils.metrics import get_registry
+from trpc.utils.tracing import TRACE_STAGES, Tracer
 
 logger = get_logger(__name__)
+hot_logger = get_hot_logger(__name__)
 
 SERVO_1_PIN = 23
+# Gesture sent to the driver when no decision arrives within the decision timeout
+RELAX_GESTURE = 2
+# How often the streamer process is checked by the asyncio event loop, in seconds
+HEALTH_CHECK_INTERVAL = 1.0
+MALFORMED_METRIC = "trpc_controller_malformed_total"
+# Reasons for skipping a decision: it was older than the deadline, or a newer one was already waiting
+SKIP_REASONS = ("stale", "superseded")
+
+
+def parse_decision(data: bytes) -> Tuple[int, Dict[str, float]]:
+    """Parses a decision from the classifier output stream, i.e. "<gesture class> <timestamp>", optionally followed by
+    the sample, received and window times of a tracing classifier.
+
+        Args:
+            data: The datagram
+
+        Returns:
+            The gesture class, and the trace points of the decision (see trpc.utils.tracing.TRACE_POINTS)
+    """
+    decided = time.time()
+    fields = data.decode().split()
+    if len(fields) not in (2, 5):
+        raise ValueError(f"Invalid decision: {data!r}")
+
+    trace = {"classified": float(fields[1]), "decided": decided}
+    if len(fields) == 5:
+        trace.update(sample=float(fields[2]), received=float(fields[3]), window=float(fields[4]))
+    return int(fields[0]), trace
+
+
+class DecisionProtocol(asyncio.DatagramProtocol):
+    """Receives the classifier output stream on an asyncio event loop and hands each decision to a callback
+
+        Args:
+            on_decision: Called with the gesture class and trace points of each decision (see parse_decision())
+    """
+
+    def __init__(self, on_decision: Callable[[int, Dict[str, float]], None]):
+        self._on_decision = on_decision
+        self._malformed = 0
+        self._malformed_metric = get_registry().counter(MALFORMED_METRIC, "Malformed decisions received")
+
+    @property
+    def malformed(self):
+        return self._malformed
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        try:
+            gesture_class, trace = parse_decision(data)
+        except ValueError:
+            self._malformed += 1
+            self._malformed_metric.inc()
+            hot_logger.debug("Ignoring malformed decision: %r", data)
+            return
+        self._on_decision(gesture_class, trace)
+
+    def error_received(self, exc: Exception):
+        logger.error(f"Error receiving decisions: {exc}")
 
 
 class Controller:
@@ -22,10 +94,35 @@ class Controller:
             ip_address: The ip address of the processor output stream
             gestures: Dictionary of gesture number and corresponding command
             pins: Dictionary of servo number and corresponding pins
+            decision_timeout: Used by listen_async(). If no decision arrives for this many seconds, the timeout gesture
+                              is executed once, e.g. to relax the hand. None disables the timeout.
+            timeout_gesture: The gesture to execute when the decision timeout expires
+            tracer: If set, the latency of every decision is recorded. The classifier must be set up with trace=True
+                    for the stages before the controller to be included.
+            pin_factory: gpiozero pin factory for the servos. Defaults to pigpio. Pass gpiozero's MockFactory (with
+                         MockPWMPin) to run without a Pi.
+            queue_size: Maximum number of pending commands per servo. When a backlog builds, the oldest are dropped
+            min_dwell: Minimum time in seconds a servo holds a position before it is moved again, so that flickering
+                       decisions do not make it thrash
+            recorder: If set, the samples written by the streamer and the decisions received are recorded to it
+            deadline: If set, decisions are only acted on while they are fresh: a decision is skipped if its newest
+                      sample (or, without tracing, its classification) is older than this many seconds on arrival, and
+                      listen() skips a decision when a newer one is already waiting. See skipped_decisions
+            placement: If set, the streamer, processor and controller are pinned to cores and prioritized as it
+                       specifies once they are started, and their scheduling jitter is measured (see
+                       scheduling_jitter)
+            supervisor: If set, it watches the streamer and restarts it in a new process, which initializes the ADC
+                        again, when it exits or stops writing samples, while the processor keeps running. The gaps in
+                        acquisition are recorded (see streamer_gaps). Without it, the controller stops when the
+                        streamer exits
     """
 
     def __init__(self, streamer: Streamer, classifier: Processor, port: int = 12346, ip_address: str = "127.0.0.1",
-                 gestures=None, pins=None):
+                 gestures=None, pins=None, decision_timeout: Optional[float] = None,
+                 timeout_gesture: int = RELAX_GESTURE, tracer: Optional[Tracer] = None,
+                 pin_factory: Optional[Factory] = None, queue_size: int = 1, min_dwell: float = 0.0,
+                 recorder: Optional[SessionRecorder] = None, deadline: Optional[float] = None,
+                 placement: Optional[PlacementPolicy] = None, supervisor: Optional[StreamerSupervisor] = None):
         from trpc import TRPCDriver  # This import is here to avoid circular imports
 
         if gestures is None:
@@ -53,7 +150,8 @@ class Controller:
             # These are arbitrary pin values. They should be replaced with the actual pin values
             pins = {"Servo 1": SERVO_1_PIN}
 
-        pigpio.pi()
+        if pin_factory is None:
+            pigpio.pi()
         self._port = port
         self._ip_address = ip_address
         self._classifier_output_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -61,8 +159,45 @@ class Controller:
         self._gestures = gestures
         self._streamer = streamer
         self._classifier = classifier
-        self._driver = TRPCDriver(servo_pins=pins)
-        self._streamer_process = multiprocessing.Process(target=self._streamer.read_emg)
+        self._recorder = recorder
+        if recorder is not None:
+            # Before the streamer process is created, so that it records the samples it writes
+            streamer.set_recorder(recorder)
+        self._driver = TRPCDriver(servo_pins=pins, pin_factory=pin_factory, queue_size=queue_size, min_dwell=min_dwell)
+        self._streamer_process = self._create_streamer_process()
+
+        if decision_timeout is not None and decision_timeout <= 0:
+            raise ValueError(f"Invalid decision_timeout: {decision_timeout}")
+        if timeout_gesture not in self._gestures:
+            raise ValueError(f"Invalid timeout_gesture: {timeout_gesture}")
+        if deadline is not None and deadline <= 0:
+            raise ValueError(f"Invalid deadline: {deadline}")
+        self._decision_timeout = decision_timeout
+        self._deadline = deadline
+        self._timeout_gesture = timeout_gesture
+        self._tracer = tracer
+        self._placement = placement
+        self._supervisor = supervisor
+
+        # State of the asyncio event loop, see listen_async()
+        self._periodic_tasks: List[Tuple[float, Callable[[], Optional[Awaitable]]]] = []
+        self._stopping: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_decision = 0.0
+        self._timed_out = False
+        self._decisions = 0
+
+        registry = get_registry()
+        self._decisions_metric = registry.counter("trpc_controller_decisions_total", "Decisions received")
+        self._malformed_metric = registry.counter(MALFORMED_METRIC, "Malformed decisions received")
+        self._skipped_metrics = {reason: registry.counter("trpc_controller_skipped_decisions_total",
+                                                          "Decisions received but not acted on, by reason",
+                                                          labels={"reason": reason})
+                                 for reason in SKIP_REASONS}
+        self._stage_metrics = {stage: registry.histogram("trpc_decision_stage_seconds",
+                                                         "Latency of each stage of a decision (see TRACE_STAGES)",
+                                                         labels={"stage": stage})
+                               for stage in TRACE_STAGES}
 
     @property
     def port(self):
@@ -88,28 +223,311 @@ class Controller:
     def driver(self):
         return self._driver
 
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @property
+    def recorder(self):
+        return self._recorder
+
+    @property
+    def placement(self):
+        return self._placement
+
+    @property
+    def supervisor(self):
+        return self._supervisor
+
+    @property
+    def streamer_gaps(self) -> List[Gap]:
+        """The gaps in acquisition that ended so far (see StreamerSupervisor.gaps), if a supervisor is set"""
+        return self._supervisor.gaps if self._supervisor is not None else []
+
+    @property
+    def scheduling_jitter(self) -> Dict[str, Dict[str, float]]:
+        """The run-queue delay of each stage in milliseconds (see PlacementPolicy.jitter()), if a placement is set"""
+        return self._placement.jitter() if self._placement is not None else {}
+
+    @property
+    def decision_timeout(self):
+        return self._decision_timeout
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    @property
+    def decisions(self):
+        return self._decisions
+
+    @property
+    def skipped_decisions(self) -> Dict[str, int]:
+        """Number of decisions that were older than the deadline ("stale"), or that a newer decision was waiting behind
+        ("superseded")"""
+        return {reason: int(metric.value) for reason, metric in self._skipped_metrics.items()}
+
+    @property
+    def coalesced(self):
+        return self._driver.coalesced
+
     def start(self):
         """Runs the startup process for the controller. This includes starting the streamer and the classifier."""
         self._streamer_process.start()
         self._classifier.run()
+        if self._placement is not None:
+            self._place_stages()
+        if self._supervisor is not None:
+            self._supervisor.start(self._streamer, self._streamer_process, self._restart_streamer)
         logger.info("Controller started")
 
     def listen(self):
-        """Runs the controller and sends the appropriate commands to the robot arm based on the classification."""
+        """Runs the controller and sends the appropriate commands to the robot arm based on the classification. Commands
+        are queued for the driver's servo workers, so receiving the next decision never waits for the hardware."""
         while True:
             try:
+                if self._supervisor is not None:
+                    if not self._poll_supervisor():
+                        break
+                    # Wakes up regularly even without decisions, so that a stopped streamer is restarted
+                    readable, _, _ = select.select([self._classifier_output_socket], [], [], self._supervisor.interval)
+                    if not readable:
+                        continue
                 data, addr = self._classifier_output_socket.recvfrom(1024)  # Receive up to 1024 bytes
-                gesture_class, timestamp = data.decode().split()  # Decode the received bytes
-                if int(gesture_class) in self._gestures.keys():
-                    self._driver.execute_command({gesture_class: self._gestures[int(gesture_class)]})
+                if self._deadline is not None:
+                    data = self._newest_waiting(data)
+                try:
+                    gesture_class, trace = parse_decision(data)
+                except ValueError:
+                    self._malformed_metric.inc()
+                    hot_logger.debug("Ignoring malformed decision: %r", data)
+                    continue
+                self._decisions += 1
+                self._decisions_metric.inc()
+                if self._recorder is not None:
+                    self._recorder.record_decision(gesture_class, trace)
+                if self._is_stale(trace):
+                    continue
+                if gesture_class in self._gestures.keys():
+                    self._dispatch({str(gesture_class): self._gestures[gesture_class]}, trace)
+                else:
+                    self._record(gesture_class, trace)
             except KeyboardInterrupt:
                 logger.info("Detected keyboard interrupt. Stopping controller and subordinates...")
                 break
 
         self.stop()
 
+    def add_periodic_task(self, interval: float, callback: Callable[[], Optional[Awaitable]]):
+        """Registers a callback that listen_async() runs every `interval` seconds on its event loop. The callback may be
+        a plain function or a coroutine function. It must not block, since it shares the loop with the receive path.
+
+            Args:
+                interval: Seconds between calls
+                callback: The function to call
+        """
+        if interval <= 0:
+            raise ValueError(f"Invalid interval: {interval}")
+        self._periodic_tasks.append((interval, callback))
+
+    async def listen_async(self):
+        """Asyncio version of listen(). Decisions are received by a DatagramProtocol, and driver commands are queued
+        for the driver's servo workers (see ServoQueue) so that they never delay the receive path. The decision
+        timeout, the streamer health check and any periodic tasks run on the same loop.
+
+        Returns once stop_async() is called, on SIGINT or SIGTERM, or when the streamer process dies, after cancelling
+        all tasks and stopping the controller and its subordinates.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._last_decision = self._loop.time()
+        self._timed_out = False
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self.stop_async)
+            except (NotImplementedError, RuntimeError):
+                # Not supported on this platform, or not running in the main thread
+                pass
+
+        self._classifier_output_socket.setblocking(False)
+        transport, _ = await self._loop.create_datagram_endpoint(lambda: DecisionProtocol(self._on_decision),
+                                                                 sock=self._classifier_output_socket)
+
+        tasks = [asyncio.create_task(self._run_periodically(interval, callback))
+                 for interval, callback in self._periodic_tasks]
+        health_check_interval = HEALTH_CHECK_INTERVAL
+        if self._supervisor is not None:
+            health_check_interval = min(health_check_interval, self._supervisor.interval)
+        tasks.append(asyncio.create_task(self._run_periodically(health_check_interval, self._check_streamer)))
+        if self._decision_timeout is not None:
+            # Checking four times per timeout keeps the reaction within 25% of it
+            tasks.append(asyncio.create_task(self._run_periodically(self._decision_timeout / 4,
+                                                                    self._check_decision_timeout)))
+
+        try:
+            await self._stopping.wait()
+        finally:
+            logger.info("Stopping controller and subordinates...")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            transport.close()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self._loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
+            self.stop()
+
+    def stop_async(self):
+        """Makes listen_async() return. Safe to call from any thread."""
+        if self._loop is None or self._stopping is None:
+            return
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def _record(self, gesture_class: int, trace: Optional[Dict]):
+        if trace is not None:
+            for stage, (start, end) in TRACE_STAGES.items():
+                latency = trace.get(end, math.nan) - trace.get(start, math.nan)
+                if not math.isnan(latency):
+                    self._stage_metrics[stage].observe(latency)
+        if self._tracer is not None and trace is not None:
+            trace["gesture"] = gesture_class
+            self._tracer.record(trace)
+
+    def _on_decision(self, gesture_class: int, trace: Dict[str, float]):
+        self._decisions += 1
+        self._decisions_metric.inc()
+        self._last_decision = self._loop.time()
+        self._timed_out = False
+        if self._recorder is not None:
+            self._recorder.record_decision(gesture_class, trace)
+        if self._is_stale(trace):
+            return
+        if gesture_class in self._gestures:
+            self._dispatch({str(gesture_class): self._gestures[gesture_class]}, trace)
+        else:
+            self._record(gesture_class, trace)
+
+    def _newest_waiting(self, data: bytes) -> bytes:
+        # Takes any decisions that arrived meanwhile off the socket, keeping the newest
+        while True:
+            try:
+                newer = self._classifier_output_socket.recv(1024, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return data
+            self._skipped_metrics["superseded"].inc()
+            data = newer
+
+    def _is_stale(self, trace: Dict[str, float]) -> bool:
+        if self._deadline is None:
+            return False
+        produced = trace.get("sample", math.nan)
+        if math.isnan(produced):
+            produced = trace["classified"]
+        if trace["decided"] - produced <= self._deadline:
+            return False
+        self._skipped_metrics["stale"].inc()
+        hot_logger.debug("Skipping a decision %.3f s old", trace["decided"] - produced)
+        return True
+
+    def _dispatch(self, command: Dict, trace: Optional[Dict] = None):
+        gesture_class = int(next(iter(command)))
+
+        def on_done(actuated: bool, finished: float):
+            # Called from the servo's worker thread, also for commands that were dropped without actuation
+            if actuated and trace is not None:
+                trace["actuated"] = finished
+            self._record(gesture_class, trace)
+
+        self._driver.submit(command, on_done)
+
+    async def _run_periodically(self, interval: float, callback: Callable[[], Optional[Awaitable]]):
+        next_run = self._loop.time() + interval
+        while True:
+            await asyncio.sleep(max(next_run - self._loop.time(), 0))
+            next_run += interval
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in periodic task {getattr(callback, '__name__', callback)}: {e}")
+
+    def _check_decision_timeout(self):
+        if self._timed_out or self._loop.time() - self._last_decision < self._decision_timeout:
+            return
+        logger.warning(f"No decision for {self._decision_timeout} s. Executing gesture {self._timeout_gesture}")
+        self._timed_out = True
+        self._dispatch({str(self._timeout_gesture): self._gestures[self._timeout_gesture]})
+
+    def _check_streamer(self):
+        if self._supervisor is not None:
+            if not self._poll_supervisor():
+                self._stopping.set()
+            return
+        if self._streamer_process.pid is not None and not self._streamer_process.is_alive():
+            logger.error(f"Streamer process exited with code {self._streamer_process.exitcode}")
+            self._stopping.set()
+
+    def _poll_supervisor(self) -> bool:
+        # The supervisor decides when to restart the streamer in its own thread, but the new process is forked here,
+        # from the thread that receives the decisions. Returns False once the supervisor gave up
+        self._supervisor.poll()
+        return not self._supervisor.failed
+
+    def _create_streamer_process(self) -> multiprocessing.Process:
+        # The streamer logs through the log queue of start_queue_logging(), if it is used, like the other processes
+        return multiprocessing.Process(target=run_with_log_queue, args=(get_log_queue(), self._run_streamer))
+
+    def _run_streamer(self):
+        # A restarted streamer is forked while listen_async() handles SIGINT and SIGTERM, and would inherit its handlers
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._streamer.read_emg()
+
+    def _restart_streamer(self) -> multiprocessing.Process:
+        self._streamer_process = self._create_streamer_process()
+        self._streamer_process.start()
+        if self._placement is not None:
+            self._placement.apply("streamer", [self._streamer_process.pid])
+        return self._streamer_process
+
+    def _place_stages(self):
+        stages = {
+            "streamer": lambda: [self._streamer_process.pid] if self._streamer_process.is_alive() else [],
+            "processor": lambda: self._classifier.pids,
+            "controller": lambda: [os.getpid()],
+        }
+        for stage, pids in stages.items():
+            self._placement.apply(stage, pids())
+        self._placement.start_monitor(stages)
+
     def stop(self):
+        if self._supervisor is not None:
+            # Before the streamer is terminated, so that it is not restarted
+            self._supervisor.stop()
+            gaps = self._supervisor.gaps
+            if gaps:
+                logger.info(f"{len(gaps)} acquisition gaps, {self._supervisor.downtime():.2f} s in total, "
+                            f"{self._supervisor.restarts} streamer restarts")
+        if self._placement is not None:
+            self._placement.stop_monitor()
+            for stage, summary in self._placement.jitter().items():
+                logger.info(f"Run-queue delay of the {stage}: " + ", ".join(f"{k} {v:.3f}" for k, v in summary.items()))
         if self._streamer_process.is_alive():
             self._streamer_process.terminate()
         self._classifier.close()
+        for servo, summary in self._driver.actuation_latency().items():
+            logger.info(f"Actuation latency of {servo}: " + ", ".join(f"{k} {v:.2f}" for k, v in summary.items()))
         self._driver.disconnect_pins()
+        if self._recorder is not None:
+            self._recorder.close()
+        if self._tracer is not None:
+            for stage, summary in self._tracer.summary().items():
+                logger.info(f"Latency of {stage}: " + ", ".join(f"{k} {v:.2f}" for k, v in summary.items()))
+            self._tracer.close()
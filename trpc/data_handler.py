@@ -0,0 +1,252 @@
+import csv
+import multiprocessing
+import socket
+import time
+from multiprocessing.managers import BaseManager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from libemg.data_handler import OnlineDataHandler
+from libemg.raw_data import RawData
+
+from trpc.ring_buffer import DEFAULT_RING_BUFFER_NAME, SharedRingBuffer
+from trpc.utils.logger import get_hot_logger, get_logger
+from trpc.wire import WIRE_FORMATS, SequenceTracker, decode_frame, is_frame
+
+logger = get_logger(__name__)
+hot_logger = get_hot_logger(__name__)
+
+STREAM_STATS = ("frames", "samples", "dropped", "reordered", "malformed")
+
+
+class TRPCRawData(RawData):
+    """libemg's RawData, with a method that appends a whole block of samples at once. RawData lives in a manager
+    process, so each call is a round trip to it, and a frame of samples costs one instead of one per sample."""
+
+    def add_emg_block(self, samples: List[List[float]]):
+        """Appends several samples, each in the form add_emg() takes, e.g. the rows of a frame as a list"""
+        with self.emg_lock:
+            self.emg_data.extend(samples)
+
+
+class RawDataManager(BaseManager):
+    pass
+
+
+RawDataManager.register("RawData", TRPCRawData)
+
+
+def create_raw_data() -> TRPCRawData:
+    """Starts a manager process holding a TRPCRawData, and returns a proxy of it that can be passed to other
+    processes. The manager stops once the proxy is garbage-collected."""
+    manager = RawDataManager()
+    manager.start()
+    return manager.RawData()
+
+
+class TRPCDataHandler(OnlineDataHandler):
+    """OnlineDataHandler that understands the binary frames sent by a Streamer (see trpc.wire). Frames are decoded
+    straight into NumPy views of the datagram, so no Python objects are deserialized on the receiving side, and the
+    samples of a frame are handed to the classifier's RawData in a single call (see TRPCRawData). The frame sequence
+    numbers are tracked to count dropped and reordered datagrams (see get_stream_stats()).
+
+        Args:
+            port: The UDP port to listen for data on
+            ip_address: The UDP ip address to listen for data on
+            wire_format: The wire format of the streamer. With "pickle", this behaves exactly like libemg's
+                         OnlineDataHandler. With "float32" or "int16", only binary frames are accepted and any other
+                         datagram is dropped, so untrusted data is never unpickled.
+            kwargs: Any other arguments of libemg's OnlineDataHandler
+    """
+
+    def __init__(self, port: int = 12345, ip_address: str = "127.0.0.1", wire_format: str = "pickle", **kwargs):
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"Invalid wire_format: {wire_format}")
+
+        super().__init__(port=port, ip=ip_address, **kwargs)
+        # Replaces the RawData of libemg's manager, which has no block append. Its manager stops with the old proxy
+        self._manager = RawDataManager()
+        self._manager.start()
+        self.raw_data = self._manager.RawData()
+        self.listener = multiprocessing.Process(target=self._listen_for_data_thread, args=[self.raw_data], daemon=True)
+        self._wire_format = wire_format
+        # Written by the listener process, read by the owner of the handler
+        self._stream_stats = multiprocessing.Array("q", len(STREAM_STATS))
+        # Acquisition and receipt time of the newest frame, for latency tracing
+        self._sample_times = multiprocessing.Array("d", [float("nan")] * 2)
+
+    @property
+    def wire_format(self):
+        return self._wire_format
+
+    @property
+    def processes(self) -> List[multiprocessing.Process]:
+        """The listener process, and the manager process that serves every get_emg() and add_emg() of raw_data"""
+        return [self.listener, self._manager._process]
+
+    def get_sample_times(self) -> Tuple[float, float]:
+        """Returns the acquisition time of the newest received samples and the time they were received. The
+        acquisition time is that of the first sample in their frame. Both are NaN in pickle mode, since pickled samples
+        carry no timestamp."""
+        with self._sample_times.get_lock():
+            return self._sample_times[0], self._sample_times[1]
+
+    def get_stream_stats(self) -> Dict[str, int]:
+        """Returns the number of received frames and samples, and the number of dropped, reordered and malformed
+        frames seen so far. All counts are zero in pickle mode."""
+        with self._stream_stats.get_lock():
+            return dict(zip(STREAM_STATS, self._stream_stats[:]))
+
+    def _listen_for_data_thread(self, raw_data):
+        if self._wire_format == "pickle":
+            return super()._listen_for_data_thread(raw_data)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.ip, self.port))
+        file = None
+        if self.options['file']:
+            file = open(self.options['file_path'] + 'EMG.csv', "a", newline='')
+        writer = csv.writer(file) if file is not None else None
+        tracker = SequenceTracker()
+        malformed = 0
+
+        while True:
+            data = sock.recv(65535)
+            try:
+                if not is_frame(data):
+                    raise ValueError(f"datagram of {len(data)} bytes is not a binary frame")
+                frame = decode_frame(data)
+            except ValueError as e:
+                malformed += 1
+                hot_logger.warning(f"Dropped a malformed datagram; {str(e)}")
+                continue
+
+            tracker.update(frame.sequence)
+            with self._stream_stats.get_lock():
+                self._stream_stats[:] = [tracker.received, self._stream_stats[1] + len(frame.samples),
+                                         tracker.dropped, tracker.reordered, malformed]
+
+            samples = frame.to_voltage()
+            timestamp = time.time()
+            with self._sample_times.get_lock():
+                self._sample_times[:] = [frame.timestamp, timestamp]
+            rows = samples.tolist()
+            if self.options['std_out'] or writer is not None:
+                for sample in rows:
+                    if self.options['std_out']:
+                        print("EMG: " + str(sample) + " " + str(timestamp))
+                    if writer is not None:
+                        writer.writerow(np.hstack([timestamp, sample]) if self.timestamps else sample)
+            if self.options['emg_arr']:
+                raw_data.add_emg_block(rows)
+
+
+class RingBufferRawData:
+    """Adapter that exposes a SharedRingBuffer through the parts of libemg's RawData interface used by
+    OnlineEMGClassifier. get_emg() blocks until a full window is available (or the timeout expires), so the classifier
+    loop waits instead of spinning.
+
+    Like RawData, get_emg() also returns the samples that arrived since the previous window beyond the increment, so
+    that a classifier that fell behind sees its backlog, as far as the ring buffer's max_window allows. read() jumps to
+    the newest samples, so anything older is left out of the window and counted in skipped instead.
+
+        Args:
+            ring_buffer: The ring buffer to read from
+            window_size: Number of samples in a window
+            timeout: Maximum time in seconds that get_emg() blocks for
+    """
+
+    def __init__(self, ring_buffer: SharedRingBuffer, window_size: int, timeout: float = 0.1):
+        self._ring_buffer = ring_buffer
+        self._window_size = window_size
+        self._timeout = timeout
+        # Write position at the end of the previous window, and the increment the classifier moved on by after it
+        self._end: Optional[int] = None
+        self._increment = 0
+        self._skipped = 0
+
+    @property
+    def skipped(self) -> int:
+        """Number of samples that arrived between the previous window and the one get_emg() last returned, but are in
+        neither of them"""
+        return self._skipped
+
+    def get_emg(self) -> np.ndarray:
+        window = self._ring_buffer.read(self._window_size, timeout=self._timeout)
+        if window is None:
+            return np.empty((0, self._ring_buffer.channels), dtype=np.float32)
+        # read() leaves the read position at the start of the window it returned
+        end = self._ring_buffer.read_index + self._window_size
+        backlog = end - self._end - self._increment if self._end is not None else 0
+        extra = min(max(backlog, 0), self._ring_buffer.max_window - self._window_size)
+        self._skipped = max(backlog - extra, 0)
+        self._end = end
+        if extra:
+            window = self._ring_buffer.window(end - self._window_size - extra, end)
+        return window
+
+    def adjust_increment(self, window: int, increment: int):
+        self._ring_buffer.advance(increment)
+        self._increment = increment
+
+    def reset_emg(self):
+        self._ring_buffer.reset()
+        self._end = None
+        self._skipped = 0
+
+
+class SharedMemoryDataHandler:
+    """Data handler that receives samples through a SharedRingBuffer written by a Streamer running on the same
+    machine, instead of over UDP. It can be passed to libemg's OnlineEMGClassifier in place of an OnlineDataHandler.
+
+        Args:
+            window_size: Number of samples in a classifier window
+            channels: Number of channels per sample
+            name: Name of the shared memory block. Must match the streamer's ring_buffer_name
+            capacity: Number of samples the ring buffer holds
+            timeout: Maximum time in seconds that a read blocks for
+            max_backlog: Number of samples beyond a window that a read may return, so that a classifier that fell
+                         behind can classify the windows it missed (see RingBufferRawData)
+    """
+
+    def __init__(self, window_size: int, channels: int = 4, name: str = DEFAULT_RING_BUFFER_NAME,
+                 capacity: int = 8192, timeout: float = 0.1, max_backlog: int = 0):
+        if max_backlog < 0:
+            raise ValueError(f"Invalid max_backlog: {max_backlog}")
+        max_window = window_size + max_backlog
+        self._ring_buffer = SharedRingBuffer(name=name, channels=channels, capacity=max(capacity, max_window),
+                                             max_window=max_window, create=True)
+        self.raw_data = RingBufferRawData(self._ring_buffer, window_size, timeout)
+        self.fi = None
+
+    @property
+    def ring_buffer(self):
+        return self._ring_buffer
+
+    def start_listening(self):
+        """Discards anything written before the handler started listening"""
+        self._ring_buffer.reset()
+
+    def stop_listening(self):
+        """Releases the shared memory block"""
+        self._ring_buffer.close()
+
+    def install_filter(self, fi):
+        self.fi = fi
+
+    def get_data(self, num_samples: Optional[int] = None) -> np.ndarray:
+        """Returns a copy of the newest samples, filtered if a filter is installed"""
+        data = np.array(self._ring_buffer.latest(num_samples or self._ring_buffer.max_window))
+        if self.fi is not None:
+            data = self.fi.filter(data)
+        return data
+
+    def get_sample_times(self) -> Tuple[float, float]:
+        """Returns the acquisition time of the newest samples in the ring buffer and the time they were written"""
+        return self._ring_buffer.sample_times
+
+    def get_stream_stats(self) -> Dict[str, int]:
+        """Returns the number of samples written to the ring buffer, the number of overruns, and the number of samples
+        that were overwritten before they were read"""
+        return {"samples": self._ring_buffer.write_index, "overruns": self._ring_buffer.overruns,
+                "overwritten": self._ring_buffer.overwritten}
@@ -0,0 +1,186 @@
+import copy
+import json
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+from trpc.windowing import StridedWindows
+
+logger = get_logger(__name__)
+
+DATASET_VERSION = 1
+DATASET_MANIFEST = "dataset.json"
+SAMPLES_FILE = "samples.npy"
+INDEX_FILE = "index.npy"
+# Metadata keys of the recordings, in the order of the index columns
+METADATA_KEYS = ("classes", "reps")
+# Columns of the index. Each row describes one recording: its class and rep (as indices into the values stored in the
+# manifest) and the range of rows it occupies in the samples array
+INDEX_COLUMNS = METADATA_KEYS + ("start", "stop")
+
+
+def is_dataset(path: str) -> bool:
+    """Returns True if the path is a dataset store created by convert_dataset()"""
+    return os.path.isfile(os.path.join(path, DATASET_MANIFEST))
+
+
+def convert_dataset(folder: str, path: str, filename_dic: Optional[Dict] = None, delimiter: str = ","):
+    """Packs the recordings in a folder of CSV files into a dataset store. The samples of every recording are stored as
+    one float32 array, ordered by rep and then class, so that any range of consecutive reps is a single slice of it.
+
+    Args:
+        folder: The folder containing the recorded data
+        path: Directory to create the dataset store in. An existing store is replaced
+        filename_dic: libemg filename dictionary with the values and regexes of the classes and reps. Defaults to the
+                      layout of the recorded training data (see trpc.feature_cache.get_filename_dic())
+        delimiter: Column delimiter of the CSV files
+    """
+    from trpc.feature_cache import get_filename_dic, list_data_files
+
+    if filename_dic is None:
+        filename_dic = get_filename_dic()
+
+    recordings = []
+    for file in list_data_files(folder, filename_dic):
+        labels = tuple(filename_dic[key].index(re.findall(filename_dic[f"{key}_regex"], file)[0])
+                       for key in METADATA_KEYS)
+        recordings.append((labels, np.loadtxt(file, delimiter=delimiter, ndmin=2, dtype=np.float32),
+                           os.path.relpath(file, folder)))
+    if not recordings:
+        raise ValueError(f"Invalid dataset folder, no recordings found: {folder}")
+
+    write_dataset(path, recordings, {key: list(filename_dic[key]) for key in METADATA_KEYS})
+    logger.info(f"Converted {len(recordings)} recordings from {folder} to {path}")
+
+
+def write_dataset(path: str, recordings: List[Tuple[Tuple[int, ...], np.ndarray, str]], values: Dict[str, List[str]]):
+    """Writes recordings to a dataset store, ordered by rep and then class. Recordings with the same rep and class keep
+    their order.
+
+    Args:
+        path: Directory to create the dataset store in. An existing store is replaced
+        recordings: The class and rep (as indices into values) of each recording, its samples, shaped (samples,
+                    channels), and the name of its source
+        values: The values of each metadata key, e.g. {"classes": ["0", "1", "2"], "reps": [...]}
+    """
+    recordings = sorted(recordings, key=lambda recording: recording[0][::-1])
+    channels = {array.shape[1] for _, array, _ in recordings}
+    if len(channels) != 1:
+        raise ValueError(f"Invalid dataset, recordings have different numbers of channels: {sorted(channels)}")
+
+    stops = np.cumsum([len(array) for _, array, _ in recordings])
+    index = np.array([tuple(labels) + (stop - len(array), stop)
+                      for (labels, array, _), stop in zip(recordings, stops)], dtype=np.int64)
+
+    # Written to a staging directory first, so that a partially written store is never loaded
+    staging = f"{path.rstrip(os.sep)}.tmp-{os.getpid()}"
+    os.makedirs(staging, exist_ok=True)
+    np.save(os.path.join(staging, SAMPLES_FILE), np.concatenate([array for _, array, _ in recordings]))
+    np.save(os.path.join(staging, INDEX_FILE), index)
+    with open(os.path.join(staging, DATASET_MANIFEST), "w") as f:
+        json.dump({
+            "version": DATASET_VERSION,
+            "channels": channels.pop(),
+            "values": values,
+            "files": [name for _, _, name in recordings],
+        }, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(staging, path)
+
+
+class EMGDataset:
+    """Recordings of a dataset store (see convert_dataset()), memory-mapped so that opening a store is instant and only
+    the samples that are used are read from disk. Selecting recordings with isolate_data() returns views of the same
+    memory map, and a selection of consecutive reps is a single slice of it.
+
+        Args:
+            path: Directory of the dataset store
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, DATASET_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != DATASET_VERSION:
+            raise ValueError(f"Invalid dataset version: {manifest.get('version')}")
+
+        self._path = path
+        self._manifest = manifest
+        self._samples = np.load(os.path.join(path, SAMPLES_FILE), mmap_mode="r")
+        self._index = np.load(os.path.join(path, INDEX_FILE))
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def channels(self):
+        return self._manifest["channels"]
+
+    @property
+    def values(self) -> Dict[str, List[str]]:
+        """The values of each metadata key, e.g. {"classes": ["0", "1", "2"], "reps": [...]}"""
+        return self._manifest["values"]
+
+    @property
+    def index(self):
+        """One row per recording, with the columns in INDEX_COLUMNS"""
+        return self._index
+
+    @property
+    def files(self) -> List[str]:
+        """Paths of the files that were converted, relative to their folder"""
+        return self._manifest["files"]
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def samples(self) -> np.ndarray:
+        """The samples of all selected recordings. This is a view of the memory map if they are stored consecutively,
+        and a copy otherwise."""
+        if not len(self._index):
+            return self._samples[:0]
+        starts, stops = self._index[:, -2], self._index[:, -1]
+        if np.array_equal(starts[1:], stops[:-1]):
+            return self._samples[starts[0]:stops[-1]]
+        return np.concatenate(self.recordings())
+
+    def recordings(self) -> List[np.ndarray]:
+        """Returns the samples of each selected recording, as views of the memory map"""
+        return [self._samples[start:stop] for start, stop in self._index[:, -2:]]
+
+    def metadata(self) -> Dict[str, np.ndarray]:
+        """Returns the class and rep of each selected recording"""
+        return {key: self._index[:, column] for column, key in enumerate(METADATA_KEYS)}
+
+    def isolate_data(self, key: str, values: List[int]) -> "EMGDataset":
+        """Selects the recordings whose metadata is one of the values, like libemg's OfflineDataHandler.isolate_data()
+
+        Args:
+            key: "classes" or "reps"
+            values: Indices of the values to keep
+        """
+        if key not in METADATA_KEYS:
+            raise ValueError(f"Invalid key: {key}")
+        selection = copy.copy(self)
+        selection._index = self._index[np.isin(self._index[:, METADATA_KEYS.index(key)], values)]
+        return selection
+
+    def windows(self, window_size: int, window_increment: int) -> StridedWindows:
+        """Windows each selected recording without copying any samples, see trpc.windowing.StridedWindows. Windows do
+        not span recordings, and carry the class and rep of their recording as metadata."""
+        return StridedWindows(self.recordings(), window_size, window_increment, self.metadata())
+
+    def parse_windows(self, window_size: int, window_increment: int) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Windows each selected recording, like libemg's OfflineDataHandler.parse_windows(). Windows do not span
+        recordings. This copies every window, so prefer windows() for large datasets or small increments.
+
+        Returns:
+            The windows, shaped (windows, channels, samples), and the class and rep of each window
+        """
+        windows = self.windows(window_size, window_increment)
+        return windows.materialize(), windows.metadata()
@@ -1,41 +1,265 @@
+import collections
+import math
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Callable, Dict
+from typing import Callable, Deque, Dict, Optional, Tuple
 
 from gpiozero import Servo
+from gpiozero.pins import Factory
 from gpiozero.pins.pigpio import PiGPIOFactory
 
-from trpc.utils.logger import get_logger
+from trpc.utils.logger import get_hot_logger, get_logger
+from trpc.utils.metrics import get_registry
+from trpc.utils.tracing import LatencyHistogram
 
 logger = get_logger(__name__)
+hot_logger = get_hot_logger(__name__)
+
+# Called once per submitted command with whether the servo was actuated, and the time.time() at which the command
+# finished or was dropped
+CommandCallback = Callable[[bool, float], None]
+
+
+class ServoQueue:
+    """Bounded queue of commands for one servo, executed in order by a worker thread so that submitting never waits for
+    the hardware. A command for the gesture that is already last in line (or running, or held) is dropped as redundant.
+    When the queue is full the oldest command is dropped, so under a backlog only the latest targets survive. After
+    each actuation the servo holds its position for at least min_dwell seconds, and commands that are superseded in
+    the meantime are dropped, so flickering decisions do not make the servo thrash.
+
+        Args:
+            name: Name of the servo, used to name the worker thread
+            execute: Executes a command and returns True if the servo was actuated
+            queue_size: Maximum number of pending commands
+            min_dwell: Minimum time in seconds between two actuations
+    """
+
+    def __init__(self, name: str, execute: Callable[[Dict], bool], queue_size: int = 1, min_dwell: float = 0.0):
+        if queue_size < 1:
+            raise ValueError(f"Invalid queue_size: {queue_size}")
+        if min_dwell < 0:
+            raise ValueError(f"Invalid min_dwell: {min_dwell}")
+
+        self._execute = execute
+        self._min_dwell = min_dwell
+        self._commands: Deque[Tuple[str, Dict, Optional[CommandCallback], float]] = collections.deque()
+        self._queue_size = queue_size
+        self._condition = threading.Condition()
+        self._running = True
+        # Gesture of the command being executed, and of the last one that actuated the servo
+        self._executing: Optional[str] = None
+        self._position: Optional[str] = None
+        self._last_actuation = -math.inf
+
+        self._latency = LatencyHistogram()
+        self._actuated = 0
+        self._coalesced = 0
+
+        registry = get_registry()
+        labels = {"servo": name}
+        self._depth_metric = registry.gauge("trpc_driver_queue_depth", "Commands waiting for the servo", labels)
+        self._actuated_metric = registry.counter("trpc_driver_actuations_total", "Commands that moved the servo",
+                                                 labels)
+        self._coalesced_metric = registry.counter("trpc_driver_coalesced_total",
+                                                  "Commands dropped as redundant or superseded", labels)
+        self._latency_metric = registry.histogram("trpc_driver_actuation_seconds",
+                                                  "Time from submitting a command to the end of its actuation",
+                                                  labels=labels)
+        self._thread = threading.Thread(target=self._run, name=f"servo-{name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Number of commands waiting to be executed"""
+        return len(self._commands)
+
+    @property
+    def latency(self):
+        """Histogram of the time from submitting a command to the end of its actuation"""
+        return self._latency
+
+    @property
+    def actuated(self):
+        return self._actuated
+
+    @property
+    def coalesced(self):
+        """Number of commands dropped as redundant or superseded"""
+        return self._coalesced
+
+    def submit(self, gesture: str, command: Dict, on_done: Optional[CommandCallback] = None) -> bool:
+        """Queues a command without blocking
+
+            Returns:
+                False if the command was dropped as redundant
+        """
+        dropped = []
+        with self._condition:
+            if not self._running:
+                return False
+            last = self._commands[-1][0] if self._commands else self._executing or self._position
+            if gesture == last:
+                dropped.append(on_done)
+                queued = False
+            else:
+                if len(self._commands) >= self._queue_size:
+                    dropped.append(self._commands.popleft()[2])
+                self._commands.append((gesture, command, on_done, time.monotonic()))
+                self._condition.notify()
+                queued = True
+            self._coalesced += len(dropped)
+            self._depth_metric.set(len(self._commands))
+        self._coalesced_metric.inc(len(dropped))
+        self._finish(dropped, False)
+        return queued
+
+    def close(self, timeout: Optional[float] = None):
+        """Drops the pending commands and stops the worker once the running command, if any, is done"""
+        with self._condition:
+            self._running = False
+            dropped = [command[2] for command in self._commands]
+            self._commands.clear()
+            self._condition.notify()
+        self._finish(dropped, False)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._commands:
+                    self._condition.wait()
+                # Hold the current position for the dwell time. Commands that arrive meanwhile may replace the pending
+                # ones, so the newest targets are the ones executed once it ends
+                while self._running and time.monotonic() < self._last_actuation + self._min_dwell:
+                    self._condition.wait(self._last_actuation + self._min_dwell - time.monotonic())
+                if not self._running:
+                    return
+                gesture, command, on_done, submitted = self._commands.popleft()
+                self._executing = gesture
+                self._depth_metric.set(len(self._commands))
+
+            try:
+                actuated = gesture != self._position and self._execute(command)
+            except Exception as e:
+                hot_logger.error(f"Error executing command: {command}; {str(e)}")
+                actuated = False
+
+            with self._condition:
+                self._executing = None
+                if actuated:
+                    self._position = gesture
+                    self._last_actuation = time.monotonic()
+                    self._latency.record(self._last_actuation - submitted)
+                    self._latency_metric.observe(self._last_actuation - submitted)
+                    self._actuated += 1
+                    self._actuated_metric.inc()
+            self._finish([on_done], actuated)
+
+    @staticmethod
+    def _finish(callbacks, actuated: bool):
+        now = time.time()
+        for callback in callbacks:
+            if callback is not None:
+                try:
+                    callback(actuated, now)
+                except Exception as e:
+                    hot_logger.error(f"Error in command callback: {e}")
 
 
 class Driver(ABC):
     """Abstract Driver class for sending commands to the servos. This class takes in the servo pins and the port and
         ip address of the processor output stream as parameters.
 
+        Commands can be executed synchronously with execute_command(), or handed to submit(), which queues them for a
+        worker thread per servo (see ServoQueue) and returns immediately.
+
         Args:
             servo_pins: Dictionary of servo number and corresponding pins
+            pin_factory: gpiozero pin factory for the servos. Defaults to a PiGPIOFactory. Pass gpiozero's MockFactory
+                         (with MockPWMPin) to run without a Pi.
+            queue_size: Maximum number of pending commands per servo for submit()
+            min_dwell: Minimum time in seconds a servo holds a position before submit() moves it again
     """
 
-    def __init__(self, servo_pins: Dict[str, int]):
+    def __init__(self, servo_pins: Dict[str, int], pin_factory: Optional[Factory] = None, queue_size: int = 1,
+                 min_dwell: float = 0.0):
         if not isinstance(servo_pins, dict):
             raise ValueError(f"Invalid servo_pins: {servo_pins}")
+        if queue_size < 1:
+            raise ValueError(f"Invalid queue_size: {queue_size}")
+        if min_dwell < 0:
+            raise ValueError(f"Invalid min_dwell: {min_dwell}")
 
         self._servo_pins = servo_pins
 
-        pin_factory = PiGPIOFactory()
+        if pin_factory is None:
+            pin_factory = PiGPIOFactory()
         self._servos = {servo: Servo(pin=pin, pin_factory=pin_factory) for servo, pin in self._servo_pins.items()}
-        self._state = "No Movement"
+        # The last gesture executed on each servo
+        self._state = {servo: "No Movement" for servo in self._servos}
+
+        self._queue_size = queue_size
+        self._min_dwell = min_dwell
+        # Started on the first command submitted for each servo
+        self._queues: Dict[str, ServoQueue] = {}
+        self._queues_lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> Dict[str, int]:
+        """Number of pending commands of each servo"""
+        return {servo: queue.depth for servo, queue in self._queues.items()}
+
+    @property
+    def coalesced(self) -> int:
+        """Number of submitted commands dropped as redundant or superseded"""
+        return sum(queue.coalesced for queue in self._queues.values())
+
+    def actuation_latency(self) -> Dict[str, Dict[str, float]]:
+        """Returns the summary (see LatencyHistogram.summary()) of the time from submit() to the end of the actuation,
+        for each servo that has been actuated"""
+        return {servo: queue.latency.summary() for servo, queue in self._queues.items() if queue.latency.count}
 
     @abstractmethod
-    def execute_command(self, command: Dict[str, str | Callable[[Servo], None]]):
+    def execute_command(self, command: Dict[str, str | Callable[[Servo], None]]) -> bool:
         """Sends the command to the given servo
 
             Args:
                 command: The command to be sent to the servo
+
+            Returns:
+                True if the servo was actuated, False if the command was skipped or failed
         """
         pass
 
+    def submit(self, command: Dict[str, Dict[str, str | Callable[[Servo], None]]],
+               on_done: Optional[CommandCallback] = None) -> bool:
+        """Queues the command for its servo's worker thread and returns without waiting for the hardware
+
+            Args:
+                command: The command to be sent to the servo
+                on_done: Called from the worker thread once the command has been executed or dropped, with whether
+                         the servo was actuated and the time at which it finished
+
+            Returns:
+                False if the command was dropped as redundant
+        """
+        gesture = next(iter(command))
+        servo = command[gesture].get("servo")
+        with self._queues_lock:
+            queue = self._queues.get(servo)
+            if queue is None:
+                queue = self._queues[servo] = ServoQueue(str(servo), self.execute_command, self._queue_size,
+                                                         self._min_dwell)
+        return queue.submit(gesture, command, on_done)
+
+    def close_queues(self, timeout: Optional[float] = None):
+        """Drops any pending commands and stops the worker threads"""
+        with self._queues_lock:
+            queues, self._queues = list(self._queues.values()), {}
+        for queue in queues:
+            queue.close(timeout)
+
     @abstractmethod
     def disconnect_pins(self):
         """Disconnects the pins and the servos"""
@@ -48,27 +272,36 @@ class TRPCDriver(Driver):
 
         Args:
             servo_pins: Dictionary of servo number and corresponding pins
+            pin_factory: gpiozero pin factory for the servos. Defaults to a PiGPIOFactory. Pass gpiozero's MockFactory
+                         (with MockPWMPin) to run without a Pi.
+            queue_size: Maximum number of pending commands per servo for submit()
+            min_dwell: Minimum time in seconds a servo holds a position before submit() moves it again
     """
 
-    def __init__(self, servo_pins: Dict[str, int]):
-        super().__init__(servo_pins)
+    def __init__(self, servo_pins: Dict[str, int], pin_factory: Optional[Factory] = None, queue_size: int = 1,
+                 min_dwell: float = 0.0):
+        super().__init__(servo_pins, pin_factory, queue_size, min_dwell)
 
-    def execute_command(self, command: Dict[int, Dict[str, str | Callable[[Servo], None]]]):
+    def execute_command(self, command: Dict[int, Dict[str, str | Callable[[Servo], None]]]) -> bool:
         gesture = list(command.keys())[0]
 
-        servo: Servo = self._servos.get(command.get(gesture).get('servo'))
+        servo_name = command.get(gesture).get('servo')
+        servo: Servo = self._servos.get(servo_name)
         action: Callable[[Servo], None] = command.get(gesture).get("action")
 
-        if gesture == self._state:
-            return
+        if gesture == self._state.get(servo_name):
+            return False
 
         try:
             action(servo)
-            self._state = gesture
+            self._state[servo_name] = gesture
+            return True
         except Exception as e:
             logger.error(f"Error executing command: {command}; {str(e)}")
+            return False
 
     def disconnect_pins(self):
+        self.close_queues()
         for servo in self._servos.values():
             servo.close()
         logger.info("Disconnected pins")
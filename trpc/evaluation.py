@@ -0,0 +1,290 @@
+import itertools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from trpc.training import format_features
+from trpc.utils.logger import get_logger
+from trpc.windowing import FEATURE_BATCH, StridedWindows, extract_features_chunked
+
+logger = get_logger(__name__)
+
+# Servo moved by each gesture class, as in the default gestures of the Controller
+DEFAULT_SERVOS = {0: "Servo 1", 1: "Servo 1", 2: "Servo 1"}
+
+
+class Actuation(NamedTuple):
+    """A command that the driver would have executed"""
+    time: float
+    servo: str
+    gesture: int
+
+
+class ReplayResult:
+    """The outcome of replaying a recording through the online pipeline on a virtual clock, see replay_evaluate().
+    Times are in seconds from the start of the recording.
+
+        Args:
+            times: The time of each decision, i.e. of the newest sample of its window
+            predictions: The prediction for each window after rejection (-1 if rejected), before the majority vote
+            confidence: The probability of the most probable class of each window
+            decisions: The decisions sent to the controller, after the majority vote
+            labels: The true class of each window, i.e. of its newest sample, or None if the recording is unlabeled
+            actuations: The commands the driver would have executed, in order
+            duration: The length of the recording in seconds
+            elapsed: The wall time the replay took in seconds
+    """
+
+    def __init__(self, times: np.ndarray, predictions: np.ndarray, confidence: np.ndarray, decisions: np.ndarray,
+                 labels: Optional[np.ndarray], actuations: List[Actuation], duration: float, elapsed: float):
+        self.times = times
+        self.predictions = predictions
+        self.confidence = confidence
+        self.decisions = decisions
+        self.labels = labels
+        self.actuations = actuations
+        self.duration = duration
+        self.elapsed = elapsed
+
+    def summary(self) -> Dict:
+        """Returns the number of decisions and actuations, the rejection rate and the speed of the replay relative to
+        real time, and with labels the accuracy over all windows (a rejection counts as an error), the accuracy of the
+        windows that were not rejected, and both of them and the rejection rate per class"""
+        rejected = self.decisions == -1
+        summary = {
+            "decisions": len(self.decisions),
+            "actuations": len(self.actuations),
+            "rejection_rate": float(np.mean(rejected)) if len(rejected) else float("nan"),
+            "speedup": self.duration / self.elapsed if self.elapsed > 0 else float("inf"),
+        }
+        if self.labels is None:
+            return summary
+        summary.update(_scores(self.decisions, self.labels))
+        summary["per_class"] = {}
+        for label in np.unique(self.labels):
+            selected = self.labels == label
+            summary["per_class"][str(label)] = _scores(self.decisions[selected], self.labels[selected])
+        return summary
+
+    def write_timeline(self, path: str):
+        """Writes each decision, and each actuation, as one JSON object per line"""
+        events = [{"time": float(t), "prediction": int(p), "confidence": float(c), "decision": int(d)}
+                  for t, p, c, d in zip(self.times, self.predictions, self.confidence, self.decisions)]
+        if self.labels is not None:
+            for event, label in zip(events, self.labels):
+                event["label"] = int(label)
+        events.extend({"time": a.time, "servo": a.servo, "gesture": a.gesture} for a in self.actuations)
+        events.sort(key=lambda event: event["time"])
+        with open(path, "w") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+
+def _scores(decisions: np.ndarray, labels: np.ndarray) -> Dict[str, float]:
+    accepted = decisions != -1
+    correct = decisions == labels
+    return {
+        "windows": int(len(labels)),
+        "accuracy": float(np.mean(correct)) if len(labels) else float("nan"),
+        "rejection_rate": float(1 - np.mean(accepted)) if len(labels) else float("nan"),
+        "accepted_accuracy": float(np.mean(correct[accepted])) if accepted.any() else float("nan"),
+    }
+
+
+def majority_vote(predictions: np.ndarray, votes: int) -> np.ndarray:
+    """Applies the majority vote of the online classifier to a sequence of predictions: each decision is the most
+    common of the last `votes` predictions (fewer at the start), with ties going to the smallest class, as np.unique()
+    orders them"""
+    offset = 1 if predictions.min(initial=0) < 0 else 0
+    one_hot = np.zeros((len(predictions) + 1, predictions.max(initial=0) + 1 + offset), dtype=np.int32)
+    one_hot[np.arange(1, len(predictions) + 1), predictions + offset] = 1
+    counts = np.cumsum(one_hot, axis=0)
+    counts = counts[1:] - counts[np.maximum(np.arange(1, len(predictions) + 1) - votes, 0)]
+    return np.argmax(counts, axis=1) - offset
+
+
+def simulate_driver(times: np.ndarray, decisions: np.ndarray, servos: Dict[int, str], queue_size: int = 1,
+                    min_dwell: float = 0.0) -> List[Actuation]:
+    """Replays decisions through the controller and the servo queues of the driver (see ServoQueue) on a virtual clock,
+    assuming that actuating a servo takes no time. Decisions for gestures without a servo, e.g. rejections, are
+    ignored, commands for the gesture already last in line are dropped, and commands that arrive while a servo holds
+    its position for min_dwell replace the oldest pending one once the queue is full.
+
+        Args:
+            times: The time of each decision
+            decisions: The gesture class of each decision
+            servos: The servo moved by each gesture class
+            queue_size: Maximum number of pending commands per servo
+            min_dwell: Minimum time in seconds a servo holds a position
+
+        Returns:
+            The actuations, in order
+    """
+    mapped = np.isin(decisions, list(servos))
+    times, decisions = times[mapped], decisions[mapped]
+    # A decision equal to the one before it is always dropped as redundant, so only the changes need to be simulated
+    changes = np.flatnonzero(np.concatenate(([True], decisions[1:] != decisions[:-1]))[:len(decisions)])
+
+    actuations = []
+    state = {servo: {"pending": [], "position": None, "last": -np.inf} for servo in set(servos.values())}
+
+    def run_until(servo_state: Dict, servo: str, now: float):
+        # Executes the pending commands the worker would have reached by now
+        pending = servo_state["pending"]
+        while pending and servo_state["last"] + min_dwell <= now:
+            gesture, submitted = pending.pop(0)
+            if gesture == servo_state["position"]:
+                continue
+            servo_state["position"] = gesture
+            servo_state["last"] = max(servo_state["last"] + min_dwell, submitted)
+            actuations.append(Actuation(float(servo_state["last"]), servo, gesture))
+
+    for index in changes:
+        now, gesture = float(times[index]), int(decisions[index])
+        servo = servos[gesture]
+        servo_state = state[servo]
+        run_until(servo_state, servo, now)
+        pending = servo_state["pending"]
+        last = pending[-1][0] if pending else servo_state["position"]
+        if gesture == last:
+            continue
+        if len(pending) >= queue_size:
+            pending.pop(0)
+        pending.append((gesture, now))
+        run_until(servo_state, servo, now)
+
+    for servo, servo_state in state.items():
+        run_until(servo_state, servo, np.inf)
+    actuations.sort(key=lambda actuation: actuation.time)
+    return actuations
+
+
+def replay_evaluate(emg, recording: np.ndarray, sampling_rate: float, window_size: int, window_increment: int,
+                    feature_list: List[str], labels: Optional[np.ndarray] = None,
+                    servos: Optional[Dict[int, str]] = None, queue_size: int = 1, min_dwell: float = 0.0,
+                    batch_size: int = FEATURE_BATCH) -> ReplayResult:
+    """Replays a recording through the decision logic of the online pipeline on a virtual clock, as fast as the CPU
+    allows: the windows TRPCOnlineClassifier would classify if it kept up with the stream, the same features, the
+    classifier with its rejection and majority vote, and the commands the controller would hand to the driver. Every
+    step runs vectorized over all windows, using strided windows and batched feature extraction, so memory use stays
+    proportional to the recording.
+
+    Args:
+        emg: The trained EMGClassifier, or a CompactClassifier
+        recording: The samples, shaped (samples, channels), e.g. from trpc.replay.load_recording()
+        sampling_rate: The sampling rate of the recording in samples per second
+        window_size: Number of samples in a window
+        window_increment: Number of samples between windows
+        feature_list: The features the classifier was trained on
+        labels: The true class of each sample, to score the decisions. None for an unlabeled recording
+        servos: The servo moved by each gesture class. Defaults to DEFAULT_SERVOS
+        queue_size: Maximum number of pending commands per servo, as in the driver
+        min_dwell: Minimum time in seconds a servo holds a position, as in the driver
+        batch_size: Number of windows whose features are extracted at once
+
+    Returns:
+        The decisions, scores and actuations of the replay
+    """
+    if getattr(emg, "velocity", False):
+        raise ValueError("Replay evaluation does not support velocity control")
+    if labels is not None and len(labels) != len(recording):
+        raise ValueError(f"Invalid labels: {len(labels)} labels for {len(recording)} samples")
+    started = time.perf_counter()
+
+    windows = StridedWindows([recording], window_size, window_increment)
+    features = format_features(extract_features_chunked(feature_list, windows, emg.feature_params, batch_size))
+    probabilities = emg.classifier.predict_proba(features) if len(features) else np.empty((0, 0))
+    predictions = np.argmax(probabilities, axis=1) if len(features) else np.empty(0, dtype=int)
+    confidence = np.max(probabilities, axis=1) if len(features) else np.empty(0)
+    if emg.rejection:
+        predictions = np.where(confidence > emg.rejection_threshold, predictions, -1)
+    decisions = majority_vote(predictions, emg.majority_vote) if emg.majority_vote else predictions
+
+    # Index of the newest sample of each window
+    newest = window_size - 1 + np.arange(len(windows)) * window_increment
+    times = (newest + 1) / sampling_rate
+    actuations = simulate_driver(times, decisions, servos if servos is not None else DEFAULT_SERVOS, queue_size,
+                                 min_dwell)
+    return ReplayResult(times, predictions, confidence, decisions,
+                        np.asarray(labels)[newest] if labels is not None else None, actuations,
+                        len(recording) / sampling_rate, time.perf_counter() - started)
+
+
+def load_labeled_recording(path: str, reps: Optional[List[int]] = None) -> Tuple[np.ndarray, Optional[np.ndarray],
+                                                                                 Optional[float]]:
+    """Loads a recording to replay, with the true class of each sample if it is known
+
+    Args:
+        path: A dataset store, whose recordings are replayed back to back as one labeled stream, a recorded session, or
+              a .npy or CSV recording (see trpc.replay.load_recording())
+        reps: The reps of a dataset store to replay. Defaults to all of them
+
+    Returns:
+        The samples, their classes or None, and the sampling rate if the recording stores it (sessions do)
+    """
+    from trpc.dataset import EMGDataset, is_dataset
+    from trpc.recorder import Session, is_session
+    from trpc.replay import load_recording
+
+    if is_dataset(path):
+        dataset = EMGDataset(path)
+        if reps is not None:
+            dataset = dataset.isolate_data("reps", reps)
+        lengths = [len(recording) for recording in dataset.recordings()]
+        return dataset.samples, np.repeat(dataset.metadata()["classes"], lengths), None
+    if is_session(path):
+        session = Session(path)
+        return session.emg(), None, session.sampling_rate()
+    return load_recording(path), None, None
+
+
+def _evaluate_job(recording_path: str, classifier_path: str, reps: Optional[List[int]], sampling_rate: float,
+                  window_size: int, window_increment: int, feature_set: str, min_dwell: float,
+                  queue_size: int) -> Dict:
+    from trpc.features import get_feature_list
+    from trpc.model import load_classifier
+
+    recording, labels, recorded_rate = load_labeled_recording(recording_path, reps)
+    result = replay_evaluate(load_classifier(classifier_path), recording, recorded_rate or sampling_rate, window_size,
+                             window_increment, get_feature_list(feature_set), labels, queue_size=queue_size,
+                             min_dwell=min_dwell)
+    summary = {"recording": recording_path, "classifier": classifier_path, "window_size": window_size,
+               "window_increment": window_increment, "min_dwell": min_dwell}
+    summary.update(result.summary())
+    return summary
+
+
+def evaluate_recordings(recordings: List[str], classifiers: List[str], sampling_rate: float, window_size: int,
+                        window_increments: List[int], feature_set: str = "LS9", reps: Optional[List[int]] = None,
+                        min_dwells: Optional[List[float]] = None, queue_size: int = 1,
+                        processes: Optional[int] = None) -> List[Dict]:
+    """Replays every recording with every classifier, window increment and dwell time (see replay_evaluate()), in
+    parallel worker processes
+
+    Args:
+        recordings: Paths of the recordings, see load_labeled_recording()
+        classifiers: Paths of the classifiers, all trained on windows of window_size samples
+        sampling_rate: The sampling rate of recordings that do not store theirs
+        window_size: Number of samples in a window
+        window_increments: The window increments to evaluate
+        feature_set: The feature set the classifiers were trained on
+        reps: The reps of dataset stores to replay. Defaults to all of them
+        min_dwells: The dwell times of the driver to evaluate. Defaults to [0.0]
+        queue_size: Maximum number of pending commands per servo
+        processes: Number of worker processes. Defaults to the number of CPUs
+
+    Returns:
+        The configuration and summary (see ReplayResult.summary()) of each replay
+    """
+    if min_dwells is None:
+        min_dwells = [0.0]
+    configurations = list(itertools.product(recordings, classifiers, window_increments, min_dwells))
+    logger.info(f"Replaying {len(configurations)} configurations...")
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        jobs = [executor.submit(_evaluate_job, recording, classifier, reps, sampling_rate, window_size,
+                                window_increment, feature_set, min_dwell, queue_size)
+                for recording, classifier, window_increment, min_dwell in configurations]
+        return [job.result() for job in jobs]
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from glob import glob
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+FEATURE_CACHE_DIR = "data/.feature_cache"
+FEATURE_CACHE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+# libemg's OfflineDataHandler loads these file types
+DATA_FILE_PATTERNS = ("*.csv", "*.txt", "*.hea")
+
+# Layout of the recorded training data, e.g. data/R_0_C_1_EMG.csv
+DATA_DIR = "data/"
+CLASSES_VALUES = ["0", "1", "2"]
+REPS_VALUES = ["0", "1", "2", "3", "4", "5", "6", "7"]
+TRAIN_REPS = [0, 1, 2, 3, 4]
+TEST_REPS = [5, 6, 7]
+
+
+def get_filename_dic() -> Dict:
+    """Returns the libemg filename dictionary of the recorded training data"""
+    from libemg.utils import make_regex
+
+    return {
+        "reps": REPS_VALUES,
+        "reps_regex": make_regex(left_bound="R_", right_bound="_C_", values=REPS_VALUES),
+        "classes": CLASSES_VALUES,
+        "classes_regex": make_regex(left_bound="_C_", right_bound="_EMG.csv", values=CLASSES_VALUES),
+    }
+
+
+def list_data_files(folder: str, filename_dic: Dict) -> List[str]:
+    """Returns the sorted data files in a folder that libemg's OfflineDataHandler would load with this filename_dic"""
+    regexes = [v for k, v in filename_dic.items() if k.endswith("_regex")]
+    files = [Path(f).as_posix() for pattern in DATA_FILE_PATTERNS
+             for f in glob(os.path.join(folder, "**", pattern), recursive=True)]
+    return sorted(f for f in files if all(re.search(regex, f) for regex in regexes))
+
+
+class FeatureCache:
+    """Persistent cache of extracted features. Each entry holds the features and window metadata of one dataset split,
+    stored as .npy files that are memory-mapped when loaded.
+
+    An entry is keyed by the data files it was computed from and every parameter that affects the features, so it is
+    invalidated automatically when a data file is added, removed or modified, or when the windowing or feature set
+    changes. Files are identified by size and modification time, or by a hash of their contents if hash_contents is
+    True.
+
+        Args:
+            cache_dir: Directory to store the cache entries in
+            hash_contents: If True, data files are identified by a hash of their contents instead of their mtime
+    """
+
+    def __init__(self, cache_dir: str = FEATURE_CACHE_DIR, hash_contents: bool = False):
+        self._cache_dir = cache_dir
+        self._hash_contents = hash_contents
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def key(self, files: List[str], **params) -> str:
+        """Computes the cache key of an entry.
+
+        Args:
+            files: The data files the features are computed from
+            params: Anything else the features depend on, e.g. window size, increment and feature list. Values must be
+                    JSON serializable.
+        """
+        description = {
+            "version": FEATURE_CACHE_VERSION,
+            "files": [self._identify(f) for f in sorted(files)],
+            "params": params,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]]:
+        """Loads an entry as memory-mapped arrays.
+
+        Returns:
+            The features and metadata dictionaries, or None if there is no valid entry for the key
+        """
+        entry = os.path.join(self._cache_dir, key)
+        try:
+            with open(os.path.join(entry, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            features = {name: np.load(os.path.join(entry, f"feature_{name}.npy"), mmap_mode="r")
+                        for name in manifest["features"]}
+            meta = {name: np.load(os.path.join(entry, f"meta_{name}.npy"), mmap_mode="r")
+                    for name in manifest["meta"]}
+        except (OSError, ValueError, KeyError):
+            return None
+        return features, meta
+
+    def save(self, key: str, features: Dict[str, np.ndarray], meta: Dict[str, np.ndarray]):
+        """Stores an entry. The entry is written to a temporary directory first, so a partially written entry is never
+        loaded."""
+        entry = os.path.join(self._cache_dir, key)
+        staging = f"{entry}.tmp-{os.getpid()}"
+        os.makedirs(staging, exist_ok=True)
+        for name, values in features.items():
+            np.save(os.path.join(staging, f"feature_{name}.npy"), np.ascontiguousarray(values))
+        for name, values in meta.items():
+            np.save(os.path.join(staging, f"meta_{name}.npy"), np.ascontiguousarray(values))
+        # The manifest keeps the feature order, which the classifier input depends on
+        with open(os.path.join(staging, MANIFEST_FILE), "w") as f:
+            json.dump({"features": list(features.keys()), "meta": list(meta.keys())}, f)
+
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def clear(self):
+        """Removes all entries"""
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+
+    def _identify(self, file: str) -> List:
+        if self._hash_contents:
+            digest = hashlib.sha256()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            return [file, digest.hexdigest()]
+        stat = os.stat(file)
+        return [file, stat.st_size, stat.st_mtime_ns]
+
+
+def load_features(window_size: int, window_increment: int, feature_list: List[str],
+                  splits: Optional[Dict[str, List[int]]] = None, folder: str = DATA_DIR,
+                  feature_params: Optional[Dict] = None, cache: Optional[FeatureCache] = None) -> Dict[str, Tuple]:
+    """Windows the recorded training data and extracts its features, split by repetition. Splits found in the cache
+    are loaded from it, and the data is only parsed if at least one of them is missing.
+
+    Args:
+        window_size: Number of samples in a window
+        window_increment: Number of samples between windows
+        feature_list: The features to extract, in order
+        splits: The repetitions in each split. Defaults to {"train": TRAIN_REPS, "test": TEST_REPS}
+        folder: The folder containing the recorded data, or a dataset store (see trpc.dataset.convert_dataset())
+        feature_params: Feature parameters, as accepted by libemg's FeatureExtractor
+        cache: The cache to use. If None, features are always extracted from scratch
+
+    Returns:
+        The features and window metadata of each split
+    """
+    from trpc.dataset import DATASET_MANIFEST, INDEX_FILE, SAMPLES_FILE, EMGDataset, is_dataset
+
+    if splits is None:
+        splits = {"train": TRAIN_REPS, "test": TEST_REPS}
+    dataset = is_dataset(folder)
+
+    results = {}
+    keys = {}
+    if cache is not None:
+        if dataset:
+            files = [os.path.join(folder, f) for f in (DATASET_MANIFEST, SAMPLES_FILE, INDEX_FILE)]
+        else:
+            files = list_data_files(folder, get_filename_dic())
+        for name, reps in splits.items():
+            keys[name] = cache.key(files, window_size=window_size, window_increment=window_increment,
+                                   features=list(feature_list), feature_params=feature_params or {}, reps=list(reps))
+            cached = cache.load(keys[name])
+            if cached is not None:
+                logger.info(f"Loaded {name} features from cache")
+                results[name] = cached
+
+    missing = [name for name in splits if name not in results]
+    if missing:
+        from trpc.windowing import StridedWindows, extract_features_chunked
+
+        if dataset:
+            odh = EMGDataset(folder)
+        else:
+            from libemg.data_handler import OfflineDataHandler
+
+            odh = OfflineDataHandler()
+            odh.get_data(folder_location=folder, filename_dic=get_filename_dic(), delimiter=",")
+        for name in missing:
+            # The windows are views of the recordings, and only one batch of them is copied at a time, so memory use
+            # does not grow with the overlap of the windows
+            selection = odh.isolate_data("reps", splits[name])
+            if dataset:
+                windows = selection.windows(window_size, window_increment)
+            else:
+                # The class and rep come from the file name, so they are the same for every sample of a recording
+                windows = StridedWindows(selection.data, window_size, window_increment,
+                                         {key: [int(np.ravel(values)[0]) for values in getattr(selection, key)]
+                                          for key in ("classes", "reps")})
+            features = extract_features_chunked(feature_list, windows, feature_params)
+            meta = windows.metadata()
+            if cache is not None:
+                cache.save(keys[name], features, meta)
+            results[name] = features, meta
+
+    return {name: results[name] for name in splits}
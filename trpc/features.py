@@ -0,0 +1,190 @@
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from libemg.feature_extractor import FeatureExtractor
+
+# Per-sample quantities whose sums over a window are kept as running state. Each term is computed from `order`
+# consecutive samples, so a window of W samples has W - order + 1 of them.
+#   name: (order, term function of a (samples x channels) segment and the feature parameters)
+TERMS: Dict[str, tuple] = {
+    "x": (1, lambda x, p: x),
+    "abs": (1, lambda x, p: np.abs(x)),
+    "sq": (1, lambda x, p: x * x),
+    "csqrt": (1, lambda x, p: np.sqrt(x.astype(complex))),
+    "abs_diff": (2, lambda x, p: np.abs(np.diff(x, axis=0))),
+    "sq_diff": (2, lambda x, p: np.diff(x, axis=0) ** 2),
+    "wamp": (2, lambda x, p: np.abs(np.diff(x, axis=0)) > p.get("WAMP_threshold", 2e-3)),
+    "zc": (2, lambda x, p: np.abs(np.diff(np.sign(x), axis=0)) == 2),
+    "ssc": (3, lambda x, p: ((x[1:-1] - x[:-2]) * (x[1:-1] - x[2:])) >= p.get("SSC_threshold", 0.0)),
+}
+
+# Features that can be computed from the running term sums, matching libemg's FeatureExtractor definitions.
+#   name: (terms, function of the term sums and the window size)
+INCREMENTAL_FEATURES: Dict[str, tuple] = {
+    "MAV": (("abs",), lambda s, w: s["abs"] / w),
+    "MEAN": (("x",), lambda s, w: s["x"] / w),
+    "ZC": (("zc",), lambda s, w: s["zc"]),
+    "SSC": (("ssc",), lambda s, w: s["ssc"]),
+    "WL": (("abs_diff",), lambda s, w: s["abs_diff"]),
+    "MFL": (("abs_diff",), lambda s, w: np.log10(s["abs_diff"])),
+    "MSR": (("csqrt",), lambda s, w: np.abs(s["csqrt"] / w)),
+    "WAMP": (("wamp",), lambda s, w: s["wamp"]),
+    "RMS": (("sq",), lambda s, w: np.sqrt(s["sq"] / w)),
+    "IAV": (("abs",), lambda s, w: s["abs"]),
+    "DASDV": (("sq_diff",), lambda s, w: np.sqrt(s["sq_diff"] / (w - 1))),
+    "VAR": (("x", "sq"), lambda s, w: np.maximum(s["sq"] / w - (s["x"] / w) ** 2, 0)),
+}
+
+
+def _l_score(window: np.ndarray) -> np.ndarray:
+    # Second sample L-moment, l2 = 2 * b1 - b0, with b1 = 1/n * sum(j / (n - 1) * x_(j)) over the sorted samples
+    n = window.shape[0]
+    weights = np.arange(n) / (n - 1)
+    b1 = weights @ np.sort(window, axis=0) / n
+    return 2 * b1 - np.mean(window, axis=0)
+
+
+# Features that need the whole window, vectorized across channels.
+#   name: function of a (samples x channels) window
+WINDOW_FEATURES: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    "LS": _l_score,
+}
+
+
+class StreamingFeatureExtractor:
+    """Computes features over a sliding window incrementally. For features that are sums over the window (see
+    INCREMENTAL_FEATURES), running sums are kept and updated with only the samples that entered and left the window. The
+    samples are kept in a history buffer that only the entering samples are appended to, so updating the sums costs
+    O(increment) instead of O(window_size). A shift is only trusted if the whole overlap of the two windows matches the
+    history, which is a single vectorized comparison. Features in WINDOW_FEATURES (e.g. LS) need the whole window and
+    are recomputed on every step, vectorized across channels. Any other feature falls back to libemg's FeatureExtractor.
+
+    Running sums of floating point terms slowly accumulate rounding error, so all sums are recomputed from scratch every
+    `resync_interval` steps.
+
+        Args:
+            feature_list: The features to extract, in order
+            window_size: Number of samples in a window
+            feature_params: Feature parameters, as accepted by libemg's FeatureExtractor (e.g. {"WAMP_threshold": 0.01})
+            resync_interval: Number of incremental updates between full recomputations
+    """
+
+    def __init__(self, feature_list: List[str], window_size: int, feature_params: Optional[Dict] = None,
+                 resync_interval: int = 1000):
+        self._feature_list = list(feature_list)
+        self._window_size = window_size
+        self._feature_params = feature_params if feature_params is not None else {}
+        self._resync_interval = resync_interval
+
+        self._incremental = [f for f in self._feature_list if f in INCREMENTAL_FEATURES]
+        self._windowed = [f for f in self._feature_list if f in WINDOW_FEATURES]
+        self._fallback = [f for f in self._feature_list if f not in INCREMENTAL_FEATURES and f not in WINDOW_FEATURES]
+        self._terms = sorted({t for f in self._incremental for t in INCREMENTAL_FEATURES[f][0]})
+        self._fe = FeatureExtractor()
+
+        self._sums: Dict[str, np.ndarray] = {}
+        # The previous window is history[end - window_size:end]. Samples are appended after it until the buffer is
+        # full, then the window is moved back to the start, so appending costs O(1) per sample on average
+        self._history: Optional[np.ndarray] = None
+        self._end = 0
+        self._updates = 0
+
+    @property
+    def incremental_features(self):
+        return self._incremental
+
+    @property
+    def fallback_features(self):
+        return self._fallback
+
+    def reset(self):
+        """Forgets the running state. The next window is computed from scratch."""
+        self._sums = {}
+        self._history = None
+        self._end = 0
+        self._updates = 0
+
+    def extract(self, window: np.ndarray, shift: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Extracts the features of a window.
+
+        Args:
+            window: The window as a (window_size x channels) array, oldest sample first
+            shift: Number of samples the window moved by since the previous call. If it is unknown, does not match the
+                   data, or is at least the window size, the features are computed from scratch.
+
+        Returns:
+            A dictionary of features in the same format as libemg's FeatureExtractor.extract_features() for a single
+            window, i.e. each value has shape (1, channels)
+        """
+        window = np.asarray(window)
+        if window.shape[0] != self._window_size:
+            raise ValueError(f"Expected a window of {self._window_size} samples, got {window.shape[0]}")
+
+        if self._updates < self._resync_interval and self._can_update(window, shift):
+            self._update(window, shift)
+            self._updates += 1
+        else:
+            self._recompute(window)
+            self._updates = 0
+
+        features = {}
+        if self._fallback or self._windowed:
+            full = np.asarray(window, dtype=np.float64)
+            if self._fallback:
+                # libemg expects windows x channels x samples
+                features.update(self._fe.extract_features(self._fallback, full.T[np.newaxis], self._feature_params))
+            for f in self._windowed:
+                features[f] = WINDOW_FEATURES[f](full)[np.newaxis]
+        for f in self._incremental:
+            features[f] = np.asarray(INCREMENTAL_FEATURES[f][1](self._sums, self._window_size))[np.newaxis]
+        return {f: features[f] for f in self._feature_list if f in features}
+
+    def _term(self, name: str, segment: np.ndarray) -> np.ndarray:
+        return TERMS[name][1](segment, self._feature_params)
+
+    def _recompute(self, window: np.ndarray):
+        samples = np.asarray(window, dtype=np.float64)
+        self._sums = {name: self._term(name, samples).sum(axis=0) for name in self._terms}
+        # Kept in the type of the windows, so that comparing them with it needs no conversion
+        if self._history is None or self._history.dtype != window.dtype or self._history.shape[1:] != window.shape[1:]:
+            self._history = np.empty((2 * self._window_size,) + window.shape[1:], dtype=window.dtype)
+        self._history[:self._window_size] = window
+        self._end = self._window_size
+
+    def _can_update(self, window: np.ndarray, shift: Optional[int]) -> bool:
+        if shift is None or self._history is None or not self._sums or not 0 < shift < self._window_size:
+            return False
+        # Every sample the windows share must line up. Checking a few of them is not enough: on a flat or clipped
+        # signal, a wrong shift would pass and corrupt the sums until the next resync
+        start = self._end - self._window_size
+        return np.array_equal(self._history[start + shift:self._end], window[:self._window_size - shift])
+
+    def _update(self, window: np.ndarray, shift: int):
+        start = self._end - self._window_size
+        # The terms of the entering samples also need the order - 1 samples before them, which are in the history
+        reach = max(TERMS[name][0] for name in self._terms) - 1 if self._terms else 0
+        entering = window[max(self._window_size - shift - reach, 0):]
+        added_samples = np.asarray(entering, dtype=np.float64)
+        removed_samples = np.asarray(self._history[start:min(start + shift + reach, self._end)], dtype=np.float64)
+        for name in self._terms:
+            order = TERMS[name][0]
+            # The first `shift` terms of the previous window left, the last `shift` terms of this window entered. A
+            # window has only window_size - order + 1 terms, so a shift close to the window size replaces all of them
+            removed = self._term(name, removed_samples[:shift + order - 1]).sum(axis=0)
+            added = self._term(name, added_samples[max(len(added_samples) - shift - order + 1, 0):]).sum(axis=0)
+            self._sums[name] = self._sums[name] - removed + added
+
+        if self._end + shift > len(self._history):
+            kept = self._window_size - shift
+            self._history[:kept] = self._history[self._end - kept:self._end]
+            self._end = kept
+        self._history[self._end:self._end + shift] = entering[len(entering) - shift:]
+        self._end += shift
+
+
+def get_feature_list(feature_set: str | List[str]) -> List[str]:
+    """Returns the list of features of a predefined libemg feature group, or the given list of features"""
+    if isinstance(feature_set, str):
+        return FeatureExtractor().get_feature_groups()[feature_set]
+    return list(feature_set)
+
@@ -0,0 +1,155 @@
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from trpc.model import LinearModel
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Maximum number of windows classified in one call, e.g. when the classifier falls behind the stream
+MAX_BATCH = 32
+
+
+def _logistic(x: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # As LinearModel.predict_proba() computes it for two classes
+    np.negative(x, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1, out=out)
+    return np.divide(1, out, out=out)
+
+
+class LinearInferenceEngine:
+    """Classifies feature vectors with a linear model without going through scikit-learn or libemg. The weights are
+    copied into contiguous arrays once, and every step (scaling, projection, probabilities, rejection) runs in
+    preallocated buffers, vectorized over up to `max_batch` windows. The operations are the ones scikit-learn performs,
+    in the same order and precision, so the probabilities and decisions are identical to those of the EMGClassifier.
+
+    Use from_classifier() to create an engine from a trained EMGClassifier.
+
+        Args:
+            coef: The weights, of shape (classes, features), or (1, features) for two classes
+            intercept: The biases, of shape (classes,), or (1,) for two classes
+            rejection_threshold: Predictions with a probability at or below this are rejected (-1). None disables
+                                 rejection
+            mean: Feature means to subtract before the projection, as a StandardScaler does. None skips centering
+            scale: Feature scales to divide by before the projection, as a StandardScaler does. None skips scaling
+            logistic: The logistic function used for two classes, writing to `out`. Defaults to scipy's expit, as used
+                      by scikit-learn
+            max_batch: Maximum number of windows per call
+    """
+
+    def __init__(self, coef: np.ndarray, intercept: np.ndarray, rejection_threshold: Optional[float] = None,
+                 mean: Optional[np.ndarray] = None, scale: Optional[np.ndarray] = None,
+                 logistic: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None, max_batch: int = MAX_BATCH):
+        if max_batch < 1:
+            raise ValueError(f"Invalid max_batch: {max_batch}")
+        self._coef = np.ascontiguousarray(np.atleast_2d(coef), dtype=np.float64)
+        self._intercept = np.ascontiguousarray(np.atleast_1d(intercept), dtype=np.float64)
+        if self._intercept.shape != (self._coef.shape[0],):
+            raise ValueError(f"Invalid intercept shape: {self._intercept.shape}")
+        self._rejection_threshold = rejection_threshold
+        self._mean = np.ascontiguousarray(mean, dtype=np.float64) if mean is not None else None
+        self._scale = np.ascontiguousarray(scale, dtype=np.float64) if scale is not None else None
+        if logistic is None:
+            from scipy.special import expit
+            logistic = expit
+        self._logistic = logistic
+        self._max_batch = max_batch
+
+        features = self._coef.shape[1]
+        classes = max(self._coef.shape[0], 2)
+        self._input = np.empty((max_batch, features))
+        self._scores = np.empty((max_batch, self._coef.shape[0]))
+        self._probabilities = np.empty((max_batch, classes))
+        self._row = np.empty((max_batch, 1))
+        self._predictions = np.empty(max_batch, dtype=np.int64)
+        self._confidence = np.empty(max_batch)
+        self._rejected = np.empty(max_batch, dtype=bool)
+
+    @classmethod
+    def from_classifier(cls, emg_classifier, max_batch: int = MAX_BATCH) -> "LinearInferenceEngine":
+        """Extracts the weights and rejection threshold of a trained EMGClassifier (or CompactClassifier) whose model is
+        linear, e.g. LDA, optionally preceded by a StandardScaler in a scikit-learn Pipeline"""
+        model = emg_classifier.classifier
+        mean = scale = None
+        if hasattr(model, "steps"):
+            *transforms, (_, model) = model.steps
+            for _, transform in transforms:
+                if type(transform).__name__ != "StandardScaler" or mean is not None or scale is not None:
+                    raise ValueError(f"Invalid pipeline step for the linear inference engine: "
+                                     f"{type(transform).__name__}")
+                mean, scale = transform.mean_, transform.scale_
+        if not all(hasattr(model, attribute) for attribute in ("coef_", "intercept_", "classes_")):
+            raise ValueError(f"Invalid model for the linear inference engine: {type(model).__name__}")
+        if emg_classifier.velocity:
+            raise ValueError("The linear inference engine does not support velocity control")
+
+        return cls(model.coef_, model.intercept_,
+                   rejection_threshold=emg_classifier.rejection_threshold if emg_classifier.rejection else None,
+                   mean=mean, scale=scale, logistic=_logistic if isinstance(model, LinearModel) else None,
+                   max_batch=max_batch)
+
+    @property
+    def features(self):
+        return self._coef.shape[1]
+
+    @property
+    def max_batch(self):
+        return self._max_batch
+
+    @property
+    def rejection_threshold(self):
+        return self._rejection_threshold
+
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Returns the probability of each class for each row of features, shaped (windows, features). The result is a
+        view of a buffer that the next call overwrites."""
+        rows = len(features)
+        if not 0 < rows <= self._max_batch:
+            raise ValueError(f"Invalid number of windows: {rows}")
+
+        x = self._input[:rows]
+        np.copyto(x, features)
+        if self._mean is not None:
+            np.subtract(x, self._mean, out=x)
+        if self._scale is not None:
+            np.divide(x, self._scale, out=x)
+
+        scores = self._scores[:rows]
+        np.matmul(x, self._coef.T, out=scores)
+        np.add(scores, self._intercept, out=scores)
+
+        probabilities = self._probabilities[:rows]
+        if scores.shape[1] == 1:
+            self._logistic(scores[:, 0], out=probabilities[:, 1])
+            np.subtract(1, probabilities[:, 1], out=probabilities[:, 0])
+            return probabilities
+
+        # The softmax of scikit-learn, in place
+        row = self._row[:rows]
+        np.max(scores, axis=1, out=row[:, 0])
+        np.subtract(scores, row, out=probabilities)
+        np.exp(probabilities, out=probabilities)
+        np.sum(probabilities, axis=1, out=row[:, 0])
+        np.divide(probabilities, row, out=probabilities)
+        return probabilities
+
+    def classify(self, features: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Classifies each row of features, shaped (windows, features)
+
+            Returns:
+                The index of the predicted class of each window, or -1 if it is rejected, and the probabilities of the
+                classes, as views of buffers that the next call overwrites
+        """
+        probabilities = self.predict_proba(features)
+        rows = len(probabilities)
+        predictions = self._predictions[:rows]
+        np.argmax(probabilities, axis=1, out=predictions)
+        if self._rejection_threshold is not None:
+            confidence = self._confidence[:rows]
+            rejected = self._rejected[:rows]
+            np.max(probabilities, axis=1, out=confidence)
+            np.less_equal(confidence, self._rejection_threshold, out=rejected)
+            np.copyto(predictions, -1, where=rejected)
+        return predictions, probabilities
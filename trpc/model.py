@@ -0,0 +1,167 @@
+import json
+from typing import Dict, Optional
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+MODEL_ARTIFACT_SUFFIX = ".npz"
+MODEL_ARTIFACT_VERSION = 1
+# Suffix of the JSON file saved next to a classifier with the processor parameters it was trained with
+CONFIGURATION_SUFFIX = ".json"
+CONFIGURATION_KEYS = ("model", "window_size", "window_increment", "feature_set")
+
+
+class LinearModel:
+    """A linear classifier evaluated with NumPy only. It exposes the parts of the scikit-learn classifier interface used
+    by libemg, and reproduces predict_proba() of LinearDiscriminantAnalysis and LogisticRegression.
+
+        Args:
+            coef: The weights, of shape (classes, features), or (1, features) for two classes
+            intercept: The biases, of shape (classes,), or (1,) for two classes
+            classes: The class labels
+    """
+
+    def __init__(self, coef: np.ndarray, intercept: np.ndarray, classes: np.ndarray):
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = np.asarray(intercept, dtype=np.float64)
+        self.classes_ = np.asarray(classes)
+
+    def decision_function(self, X: np.ndarray) -> np.ndarray:
+        scores = np.asarray(X, dtype=np.float64) @ self.coef_.T + self.intercept_
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            positive = 1 / (1 + np.exp(-scores))
+            return np.stack([1 - positive, positive], axis=1)
+        scores = scores - scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+class CompactClassifier:
+    """Stand-in for a trained libemg EMGClassifier, loaded from a compact artifact. It has the attributes and helpers
+    that online classification uses, without importing libemg or scikit-learn. This only makes loading it fast (see
+    scripts/bench_startup.py): a Processor still imports libemg for its data handler and online classifier.
+
+        Args:
+            model: The LinearModel
+            rejection_threshold: The rejection confidence threshold, or None to disable rejection
+            majority_vote: The number of predictions in the majority vote, or None to disable it
+            feature_params: The feature parameters the classifier was trained with
+    """
+
+    def __init__(self, model: LinearModel, rejection_threshold: Optional[float] = None,
+                 majority_vote: Optional[int] = None, feature_params: Optional[Dict] = None):
+        self.classifier = model
+        self.rejection = rejection_threshold is not None
+        self.rejection_threshold = rejection_threshold
+        self.majority_vote = majority_vote
+        self.velocity = False
+        self.feature_params = feature_params if feature_params is not None else {}
+
+    def _prediction_helper(self, probabilities: np.ndarray):
+        probabilities = np.asarray(probabilities)
+        predictions = np.argmax(probabilities, axis=1)
+        return predictions, probabilities[np.arange(len(predictions)), predictions]
+
+    def _rejection_helper(self, prediction: int, probability: float) -> int:
+        if self.rejection and probability <= self.rejection_threshold:
+            return -1
+        return prediction
+
+
+def save_compact(emg_classifier, path: str):
+    """Saves the weights and post-processing settings of a trained linear EMGClassifier (e.g. LDA) to an .npz file.
+    Loading it only needs NumPy, while unpickling an EMGClassifier imports libemg and scikit-learn.
+
+    Args:
+        emg_classifier: The trained EMGClassifier
+        path: The path of the artifact, ending in .npz
+    """
+    model = emg_classifier.classifier
+    if not all(hasattr(model, attribute) for attribute in ("coef_", "intercept_", "classes_")):
+        raise ValueError(f"Invalid model for a compact artifact: {type(model).__name__}")
+    if emg_classifier.velocity:
+        raise ValueError("Compact artifacts do not support velocity control")
+
+    np.savez(
+        path,
+        version=MODEL_ARTIFACT_VERSION,
+        model=type(model).__name__,
+        coef=model.coef_,
+        intercept=np.atleast_1d(model.intercept_),
+        classes=model.classes_,
+        rejection=bool(emg_classifier.rejection),
+        rejection_threshold=getattr(emg_classifier, "rejection_threshold", 0.0),
+        majority_vote=emg_classifier.majority_vote if emg_classifier.majority_vote is not None else 0,
+        feature_params=json.dumps(emg_classifier.feature_params),
+    )
+
+
+def load_compact(path: str) -> CompactClassifier:
+    """Loads an artifact written by save_compact()
+
+    Args:
+        path: The path of the artifact
+    """
+    with np.load(path, allow_pickle=False) as artifact:
+        version = int(artifact["version"])
+        if version != MODEL_ARTIFACT_VERSION:
+            raise ValueError(f"Invalid model artifact version: {version}")
+
+        model = LinearModel(artifact["coef"], artifact["intercept"], artifact["classes"])
+        return CompactClassifier(
+            model,
+            rejection_threshold=float(artifact["rejection_threshold"]) if bool(artifact["rejection"]) else None,
+            majority_vote=int(artifact["majority_vote"]) or None,
+            feature_params=json.loads(str(artifact["feature_params"])),
+        )
+
+
+def load_classifier(path: str):
+    """Loads a classifier saved either as a compact artifact (.npz) or as a libemg pickle"""
+    if path.endswith(MODEL_ARTIFACT_SUFFIX):
+        return load_compact(path)
+
+    from libemg.emg_classifier import EMGClassifier
+    return EMGClassifier.from_file(path)
+
+
+def save_classifier(emg_classifier, path: str):
+    """Saves a classifier as a compact artifact if the path ends in .npz, or as a libemg pickle otherwise"""
+    if path.endswith(MODEL_ARTIFACT_SUFFIX):
+        save_compact(emg_classifier, path)
+    else:
+        emg_classifier.save(path)
+
+
+def save_configuration(path: str, configuration: Dict):
+    """Saves the processor parameters a classifier was trained with next to it, see CONFIGURATION_KEYS
+
+    Args:
+        path: The path of the classifier
+        configuration: The parameters. Other keys are ignored
+    """
+    with open(path + CONFIGURATION_SUFFIX, "w") as f:
+        json.dump({key: configuration[key] for key in CONFIGURATION_KEYS}, f, indent=2)
+
+
+def load_configuration(path: str) -> Optional[Dict]:
+    """Loads the parameters saved with save_configuration(), or returns None for a classifier saved without them
+
+    Args:
+        path: The path of the classifier
+    """
+    try:
+        with open(path + CONFIGURATION_SUFFIX) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,310 @@
+import math
+import multiprocessing
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from libemg.emg_classifier import OnlineEMGClassifier
+from libemg.feature_extractor import FeatureExtractor
+from libemg.utils import get_windows
+
+from trpc.data_handler import RingBufferRawData
+from trpc.features import StreamingFeatureExtractor
+from trpc.inference import LinearInferenceEngine
+from trpc.model import LinearModel
+from trpc.utils.logger import get_logger
+from trpc.utils.metrics import get_registry
+
+logger = get_logger(__name__)
+
+# Weight of the newest measurement in the running averages of the decision cost and sampling rate
+LOAD_SMOOTHING = 0.1
+# Fraction of the time between decisions that is left idle when the increment adapts to the load
+LOAD_HEADROOM = 0.25
+# Reasons for skipping a window: the classifier fell behind the stream, or the window was older than the deadline
+SKIP_REASONS = ("backlog", "stale")
+
+
+class TRPCOnlineClassifier(OnlineEMGClassifier):
+    """OnlineEMGClassifier with a classification loop that TRPC can extend. It behaves like libemg's loop and streams
+    the same messages, but can extract features incrementally with a StreamingFeatureExtractor instead of recomputing
+    them over every window, and classify with a LinearInferenceEngine instead of scikit-learn.
+
+    With the inference engine, a classifier that falls behind the stream classifies every window it missed in one
+    batch, so the majority vote and the decision stream see every window, rather than only the newest one.
+
+    With a deadline, the classifier is latency-bounded instead: it only ever classifies the newest window, skips a
+    window whose newest sample is older than the deadline, and raises its increment while classification can not keep
+    up with the stream, down to window_increment again once it can. Skipped windows (see skipped_windows) and the
+    current increment are exported as metrics.
+
+    A linear model can be replaced while the classifier runs, in this or its classification process, with
+    swap_model(). The new weights are passed through shared memory and picked up before the next window.
+
+        Args:
+            offline_classifier: The trained EMGClassifier
+            window_size: Number of samples in a window
+            window_increment: Number of samples between windows
+            online_data_handler: The data handler providing the raw data
+            features: The list of features the classifier was trained on
+            incremental_features: If True, features are extracted with a StreamingFeatureExtractor
+            trace: If True, the acquisition and receipt time of the newest sample and the time the window was picked up
+                   are appended to each decision, for latency tracing (see trpc.utils.tracing). Only applies to the
+                   "predictions" output format over UDP.
+            fast_inference: If True, decisions are made by a LinearInferenceEngine, which gives the same results as the
+                            EMGClassifier at a fraction of the cost. Requires a linear model, e.g. LDA
+            deadline: Maximum age in seconds of the newest sample of a window when it is picked up. The age is only
+                      known with a data handler that reports sample times, i.e. with a binary wire format or the "shm"
+                      transport. None disables the latency-bounded mode
+            kwargs: Any other arguments of libemg's OnlineEMGClassifier
+    """
+
+    def __init__(self, offline_classifier, window_size: int, window_increment: int, online_data_handler,
+                 features: Optional[List[str]], incremental_features: bool = False, trace: bool = False,
+                 fast_inference: bool = False, deadline: Optional[float] = None, **kwargs):
+        if deadline is not None and deadline <= 0:
+            raise ValueError(f"Invalid deadline: {deadline}")
+        super().__init__(offline_classifier, window_size, window_increment, online_data_handler, features, **kwargs)
+        self.incremental_features = incremental_features
+        self.trace = trace
+        self.deadline = deadline
+        self._engine = LinearInferenceEngine.from_classifier(offline_classifier) if fast_inference else None
+        self._get_sample_times = getattr(online_data_handler, "get_sample_times", None)
+
+        # Created here so that the classification process, which is started later, updates them in shared memory
+        registry = get_registry()
+        self._decisions_metric = registry.counter("trpc_classifier_decisions_total", "Decisions sent by the classifier")
+        self._rejections_metric = registry.counter("trpc_classifier_rejections_total",
+                                                   "Decisions rejected for low confidence")
+        self._inference_metric = registry.histogram("trpc_classifier_inference_seconds",
+                                                    "Time to extract the features of a window and classify it")
+        self._skipped_metrics = {reason: registry.counter("trpc_classifier_skipped_windows_total",
+                                                          "Windows skipped without a decision, by reason",
+                                                          labels={"reason": reason})
+                                 for reason in SKIP_REASONS}
+        self._increment_metric = registry.gauge("trpc_classifier_increment",
+                                                "Number of samples the classifier currently waits for between windows")
+        self._swaps_metric = registry.counter("trpc_classifier_model_swaps_total", "Models swapped in while running")
+
+        # Shared with the classification process, so that swap_model() reaches it. Only linear models can be swapped
+        model = self.classifier.classifier
+        model = model.steps[-1][1] if hasattr(model, "steps") else model
+        self._model_shape = np.atleast_2d(model.coef_).shape if hasattr(model, "coef_") else None
+        self._model_classes = getattr(model, "classes_", None)
+        self._model_version = multiprocessing.RawValue("L", 0)
+        self._model_lock = multiprocessing.Lock()
+        if self._model_shape is not None:
+            self._model_weights = multiprocessing.RawArray("d", self._model_shape[0] * (self._model_shape[1] + 1))
+
+    @property
+    def skipped_windows(self) -> Dict[str, int]:
+        """Number of windows skipped because the classifier fell behind ("backlog"), or because their newest sample was
+        older than the deadline ("stale")"""
+        return {reason: int(metric.value) for reason, metric in self._skipped_metrics.items()}
+
+    @property
+    def increment(self) -> int:
+        """The current increment, which only differs from window_increment in the latency-bounded mode"""
+        return int(self._increment_metric.value)
+
+    @property
+    def model_version(self) -> int:
+        """Number of models swapped in with swap_model()"""
+        return self._model_version.value
+
+    def swap_model(self, model: LinearModel):
+        """Replaces the linear model of the classifier, without stopping it. The classification loop switches to the
+        new model before its next window, and keeps the rejection threshold, majority vote and feature extraction.
+
+            Args:
+                model: The new model. It must have the classes and number of features of the current one
+        """
+        coef = np.atleast_2d(model.coef_)
+        if self._model_shape is None:
+            raise ValueError(f"Invalid model for swapping: {type(self.classifier.classifier).__name__}")
+        if coef.shape != self._model_shape or not np.array_equal(model.classes_, self._model_classes):
+            raise ValueError(f"Invalid model shape for swapping: {coef.shape}, expected {self._model_shape}")
+
+        weights = np.frombuffer(self._model_weights, dtype=np.float64)
+        with self._model_lock:
+            np.copyto(weights[:coef.size], coef.ravel())
+            np.copyto(weights[coef.size:], np.atleast_1d(model.intercept_))
+            self._model_version.value += 1
+        logger.info(f"Swapped in model {self._model_version.value}")
+
+    def _load_swapped_model(self) -> int:
+        rows, features = self._model_shape
+        with self._model_lock:
+            weights = np.frombuffer(self._model_weights, dtype=np.float64).copy()
+            version = self._model_version.value
+        self.classifier.classifier = LinearModel(weights[:rows * features].reshape(rows, features),
+                                                 weights[rows * features:], self._model_classes)
+        if self._engine is not None:
+            self._engine = LinearInferenceEngine.from_classifier(self.classifier, self._engine.max_batch)
+        self._swaps_metric.inc()
+        return version
+
+    def _run_helper(self):
+        fe = FeatureExtractor()
+        streaming = None
+        if self.features and self.incremental_features:
+            streaming = StreamingFeatureExtractor(self.features, self.window_size, self.classifier.feature_params)
+
+        self.raw_data.reset_emg()
+        increment = self.window_increment
+        self._increment_metric.set(increment)
+        cost = rate = 0.0
+        ready = None
+        model_version = 0
+        while True:
+            if self._model_version.value != model_version:
+                model_version = self._load_swapped_model()
+
+            data = self.raw_data.get_emg()
+            if len(data) < self.window_size:
+                continue
+            trace = self._trace_window() if self.trace else None
+            started = time.perf_counter()
+
+            data = np.array(data)
+            if self.filters is not None:
+                try:
+                    data = self.filters.filter(data)
+                except Exception:
+                    pass
+            if self.channels is not None:
+                data = data[:, self.channels]
+
+            # The raw data keeps the last window minus the increment, so anything beyond a full window is new data
+            # that arrived while the previous window was being classified. A ring buffer may leave out the oldest of it
+            shift = increment + len(data) - self.window_size
+            if isinstance(self.raw_data, RingBufferRawData):
+                shift += self.raw_data.skipped
+            samples = data[-self.window_size:]
+            if ready is not None and started > ready:
+                rate += LOAD_SMOOTHING * (shift / (started - ready) - rate)
+            ready = started
+
+            # Windows that were due since the previous decision, besides the newest one
+            missed = max(shift // self.window_increment - 1, 0)
+            batch = 0
+            if self._engine is not None and self.features and self.deadline is None:
+                batch = min(missed, self._engine.max_batch - 1, (len(data) - self.window_size) // self.window_increment)
+            if missed > batch:
+                self._skipped_metrics["backlog"].inc(missed - batch)
+
+            if self.deadline is not None and self._window_age() > self.deadline:
+                # Acting on it would be worse than waiting for fresh data
+                self._skipped_metrics["stale"].inc()
+                self.raw_data.adjust_increment(self.window_size, increment)
+                continue
+
+            if batch:
+                # Every window that fits in the backlog, ending with the newest one
+                start = len(data) - self.window_size - batch * self.window_increment
+                windows = get_windows(data[start:], self.window_size, self.window_increment)
+                features = fe.extract_features(self.features, windows, self.classifier.feature_params)
+                if streaming is not None:
+                    streaming.reset()
+            elif streaming is not None:
+                features = streaming.extract(samples, shift)
+            elif self.features:
+                window = get_windows(samples, self.window_size, self.window_size)
+                features = fe.extract_features(self.features, window, self.classifier.feature_params)
+            else:
+                features = None
+
+            # If extracted features has an error - give error message
+            if features is not None and fe.check_features(features) != 0:
+                self.raw_data.adjust_increment(self.window_size, increment)
+                continue
+
+            if features is not None:
+                classifier_input = self._format_data_sample(features)
+            else:
+                classifier_input = get_windows(samples, self.window_size, self.window_size)
+
+            self._classify(classifier_input, samples, trace)
+            elapsed = time.perf_counter() - started
+            self._inference_metric.observe(elapsed)
+
+            if self.deadline is not None:
+                # Wait for as many samples as arrive while a window is classified, plus some headroom, so that the
+                # classifier does not fall behind and the data handler and streamer keep some CPU time
+                cost += LOAD_SMOOTHING * (elapsed - cost)
+                increment = min(max(math.ceil(cost * rate / (1 - LOAD_HEADROOM)), self.window_increment),
+                                self.window_size)
+                self._increment_metric.set(increment)
+            self.raw_data.adjust_increment(self.window_size, increment)
+
+    def _window_age(self) -> float:
+        sample_time = self._get_sample_times()[0] if self._get_sample_times else math.nan
+        return time.time() - sample_time
+
+    def _trace_window(self) -> Tuple[float, float, float]:
+        window_time = time.time()
+        sample_time, received_time = self._get_sample_times() if self._get_sample_times else (math.nan, math.nan)
+        return sample_time, received_time, window_time
+
+    def _classify(self, classifier_input: np.ndarray, samples: np.ndarray,
+                  trace: Optional[Tuple[float, float, float]] = None):
+        if self._engine is not None:
+            # Rejection is applied by the engine
+            predictions, probabilities = self._engine.classify(classifier_input)
+            for i, prediction in enumerate(predictions):
+                # Only the newest window is traced
+                self._decide(prediction, probabilities[i], samples, trace if i == len(predictions) - 1 else None)
+            return
+
+        probabilities = self.classifier.classifier.predict_proba(classifier_input)
+        prediction, probability = self.classifier._prediction_helper(probabilities)
+        prediction = prediction[0]
+        probability = probability[0]
+
+        # Check for rejection
+        if self.classifier.rejection:
+            prediction = self.classifier._rejection_helper(prediction, probability)
+        self._decide(prediction, probabilities[0], samples, trace)
+
+    def _decide(self, prediction: int, probabilities: np.ndarray, samples: np.ndarray,
+                trace: Optional[Tuple[float, float, float]] = None):
+        if prediction == -1:
+            self._rejections_metric.inc()
+        self.previous_predictions.append(prediction)
+
+        # Check for majority vote
+        if self.classifier.majority_vote:
+            values, counts = np.unique(list(self.previous_predictions), return_counts=True)
+            prediction = values[np.argmax(counts)]
+
+        # Check for velocity based control
+        calculated_velocity = ""
+        if self.classifier.velocity:
+            calculated_velocity = " 0"
+            # Dont check if rejected
+            if prediction >= 0:
+                window = get_windows(samples, self.window_size, self.window_size)
+                calculated_velocity = " " + str(self.classifier._get_velocity(window, prediction))
+
+        self._write_output(prediction, probabilities, calculated_velocity, trace)
+        self._decisions_metric.inc()
+
+    def _write_output(self, prediction: int, probabilities: np.ndarray, calculated_velocity: str,
+                      trace: Optional[Tuple[float, float, float]] = None):
+        time_stamp = time.time()
+        if self.output_format == "probabilities":
+            message = ' '.join([f'{i:.2f}' for i in probabilities]) + calculated_velocity + " " + str(time_stamp)
+        elif not self.tcp:
+            message = str(prediction) + calculated_velocity + " " + str(time_stamp)
+            if trace is not None:
+                message += " " + " ".join(repr(t) for t in trace)
+        else:
+            message = str(prediction) + calculated_velocity + '\n'
+
+        if not self.tcp:
+            self.sock.sendto(bytes(message, "utf-8"), (self.ip, self.port))
+        else:
+            self.conn.sendall(str.encode(message))
+
+        if self.std_out:
+            print(message)
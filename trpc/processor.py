@@ -1,14 +1,18 @@
+import threading
 from abc import ABC, abstractmethod
 from os import makedirs
 from os.path import dirname, exists
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from libemg.data_handler import OnlineDataHandler, OfflineDataHandler
-from libemg.emg_classifier import EMGClassifier, OnlineEMGClassifier
-from libemg.feature_extractor import FeatureExtractor
-from libemg.utils import make_regex
+import numpy as np
 
+from trpc.adaptation import ADAPTATION_SUFFIX, LDAStatistics
+from trpc.feature_cache import DATA_DIR, FEATURE_CACHE_DIR, TRAIN_REPS, FeatureCache, load_features
+from trpc.inference import MAX_BATCH
+from trpc.model import load_classifier, load_configuration, save_classifier, save_configuration
+from trpc.ring_buffer import TRANSPORTS
 from trpc.utils.logger import get_logger
+from trpc.utils.metrics import get_registry
 
 logger = get_logger(__name__)
 
@@ -23,25 +27,72 @@ class Processor(ABC):
                          get_feature_groups() function for predefined groups.
             model: Model to use for the classifier
             classifier_path: Path to the classifier file. If the file does not exist, the classifier will be trained
-                             from scratch and saved to this path.
+                             from scratch and saved to this path, along with the window size, window increment, feature
+                             set and model it was trained with. A classifier saved with different ones is rejected.
+            wire_format: The wire format used by the streamer. One of "pickle", "float32" or "int16"
+            transport: "udp" to receive samples over UDP, or "shm" to read them from a shared memory ring buffer
+                       written by a streamer on the same machine
+            channels: Number of channels per sample. Only needed by the "shm" transport
+            incremental_features: If True, features are updated incrementally as the window slides instead of being
+                                  recomputed over every window (see StreamingFeatureExtractor)
+            feature_cache_dir: Directory to cache extracted training features in, so that retraining on the same data
+                               skips feature extraction. None disables the cache.
+            defer_setup: If True, the data handler and classifier are set up in a background thread, so that the
+                         constructor returns immediately and e.g. the streamer can start in the meantime. Accessing
+                         odh or classifier, or calling run(), waits for the setup to finish. Setting up imports
+                         libemg, which takes seconds even with a compact classifier artifact.
+            trace: If True, decisions carry the timestamps needed for latency tracing (see trpc.utils.tracing)
+            data_path: Training data, as a folder of CSV recordings or a dataset store created by
+                       trpc.dataset.convert_dataset(), which loads much faster
+            fast_inference: If True, decisions are made by a LinearInferenceEngine (see trpc.inference) instead of
+                            scikit-learn, with identical results. Requires a linear model, e.g. LDA
+            deadline: If set, the classifier is latency-bounded: windows whose newest sample is older than this many
+                      seconds are skipped, and the increment grows while classification can not keep up (see
+                      TRPCOnlineClassifier)
     """
 
     def __init__(self, window_size: int, window_increment: int, feature_set: str | List[str] = "LS9",
-                 model: str = "LDA", classifier_path: Optional[str] = None):
+                 model: str = "LDA", classifier_path: Optional[str] = None, wire_format: str = "pickle",
+                 transport: str = "udp", channels: int = 4, incremental_features: bool = False,
+                 feature_cache_dir: Optional[str] = FEATURE_CACHE_DIR, defer_setup: bool = False,
+                 trace: bool = False, data_path: str = DATA_DIR, fast_inference: bool = False,
+                 deadline: Optional[float] = None):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Invalid transport: {transport}")
+
         self.__window_size = window_size
         self.__window_increment = window_increment
         self._feature_set = feature_set
         self._model = model
+        self._incremental_features = incremental_features
+        self._trace = trace
+        self._data_path = data_path
+        self._fast_inference = fast_inference
+        self._deadline = deadline
+        self._feature_cache = FeatureCache(feature_cache_dir) if feature_cache_dir is not None else None
         if classifier_path is None:
             self._classifier_path = f"classifiers/{model.lower()}.pickle"
         else:
             self._classifier_path = classifier_path
 
-        # The handler listens to UDP port 12345 by default, with ip address 127.0.0.1.
-        # No need to specify these parameters unless we need to change them.
-        self._odh = OnlineDataHandler()
-        self._odh.start_listening()
-        self._classifier = self._set_up_classifier()
+        if exists(self._classifier_path):
+            self._check_configuration()
+
+        self._wire_format = wire_format
+        self._transport = transport
+        self._channels = channels
+
+        self._odh = None
+        self._classifier = None
+        self._statistics = None
+        self._adapt_lock = threading.Lock()
+        self._setup_error: Optional[BaseException] = None
+        self._setup_thread: Optional[threading.Thread] = None
+        if defer_setup:
+            self._setup_thread = threading.Thread(target=self._deferred_set_up, name="processor-setup", daemon=True)
+            self._setup_thread.start()
+        else:
+            self._set_up()
 
     # Not providing a setter for any of the properties because they are not meant to be changed after initialization
     @property
@@ -60,68 +111,194 @@ class Processor(ABC):
     def model(self):
         return self._model
 
+    @property
+    def deadline(self):
+        return self._deadline
+
     @property
     def odh(self):
+        self.wait_until_ready()
         return self._odh
 
     @property
     def classifier(self):
+        self.wait_until_ready()
         return self._classifier
 
+    @property
+    def pids(self) -> List[int]:
+        """The ids of the data handler, RawData manager and classification processes that are running"""
+        processes = [*getattr(self.odh, "processes", ()), getattr(self.classifier, "process", None)]
+        return [process.pid for process in processes if process is not None and process.is_alive()]
+
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Waits for a deferred setup to finish, and re-raises any error it failed with.
+
+            Args:
+                timeout: Maximum time to wait in seconds. None waits forever
+
+            Returns:
+                True if the processor is set up, False if the timeout expired first
+        """
+        if self._setup_thread is not None:
+            self._setup_thread.join(timeout)
+            if self._setup_thread.is_alive():
+                return False
+        if self._setup_error is not None:
+            raise self._setup_error
+        return True
+
+    def _set_up(self):
+        # libemg takes seconds to import, so it is only imported here rather than with the module. The data handler and
+        # online classifier subclass libemg's, so setting up imports it whichever classifier artifact is loaded, and
+        # only defer_setup takes it off the startup path
+        from trpc.data_handler import SharedMemoryDataHandler, TRPCDataHandler
+
+        # The handler listens to UDP port 12345 by default, with ip address 127.0.0.1.
+        # No need to specify these parameters unless we need to change them.
+        if self._transport == "shm":
+            # The inference engine classifies the windows it missed in one batch, so reads include them
+            max_backlog = (MAX_BATCH - 1) * self.__window_increment if self._fast_inference else 0
+            self._odh = SharedMemoryDataHandler(window_size=self.__window_size, channels=self._channels,
+                                                max_backlog=max_backlog)
+        else:
+            self._odh = TRPCDataHandler(wire_format=self._wire_format)
+        self._odh.start_listening()
+        self._register_metrics()
+        self._classifier = self._set_up_classifier()
+
+    def _configuration(self) -> Dict:
+        return {"model": self._model, "window_size": self.__window_size, "window_increment": self.__window_increment,
+                "feature_set": self._feature_set}
+
+    def _check_configuration(self):
+        # A classifier fed features of another windowing or feature set would still classify, but wrongly
+        saved = load_configuration(self._classifier_path)
+        if saved is None:
+            return
+        mismatched = {key: value for key, value in saved.items() if self._configuration().get(key) != value}
+        if mismatched:
+            raise ValueError(f"Invalid processor parameters for {self._classifier_path}, it was trained with "
+                             f"{mismatched}")
+
+    def _register_metrics(self):
+        # The data handler counts in its listener process, so its statistics are read when the metrics are collected
+        registry = get_registry()
+        for stat in self._odh.get_stream_stats():
+            registry.counter(f"trpc_processor_{stat}_total", f"Stream statistic '{stat}' of the data handler") \
+                .set_function(lambda stat=stat: self._odh.get_stream_stats()[stat])
+
+    def _deferred_set_up(self):
+        try:
+            self._set_up()
+            logger.info("Processor set up")
+        except BaseException as e:
+            self._setup_error = e
+
     def _set_up_classifier(self):
         """Creates the feature classifier for the processor."""
-        fe = FeatureExtractor()
-        feature_list = fe.get_feature_groups()[self._feature_set] if isinstance(self._feature_set, str) \
-            else self._feature_set
+        from trpc.features import get_feature_list
+        from trpc.online_classifier import TRPCOnlineClassifier
+        from trpc.training import evaluate_classifier, fit_classifier, format_features
+
+        feature_list = get_feature_list(self._feature_set)
 
         try:
-            emg = EMGClassifier.from_file(self._classifier_path)
+            emg = load_classifier(self._classifier_path)
             logger.info("Loaded classifier from file")
         except FileNotFoundError:
             logger.info("Classifier not found. Training classifier from scratch...")
-            # Step 1: Parse training data
-            classes_values = ["0", "1", "2"]
-            classes_regex = make_regex(left_bound="_C_", right_bound="_EMG.csv", values=classes_values)
-            reps_values = ["0", "1", "2", "3", "4", "5", "6", "7"]
-            reps_regex = make_regex(left_bound="R_", right_bound="_C_", values=reps_values)
-            dic = {
-                "reps": reps_values,
-                "reps_regex": reps_regex,
-                "classes": classes_values,
-                "classes_regex": classes_regex
-            }
-
-            odh = OfflineDataHandler()
-            odh.get_data(folder_location='data/', filename_dic=dic, delimiter=',')
-            train_data = odh.isolate_data("reps", [0, 1, 2, 3, 4])
-            test_data = odh.isolate_data("reps", [5, 6, 7])
-
-            train_windows, train_meta = train_data.parse_windows(self.__window_size, self.__window_increment)
-            test_windows, test_meta = test_data.parse_windows(self.__window_size, self.__window_increment)
-
-            # Step 2: Extract features from training data
-            training_features = fe.extract_feature_group(self._feature_set, train_windows)
-            test_features = fe.extract_feature_group(self._feature_set, test_windows)
-
-            # Step 3: Create training data set
-            data_set = {'training_features': training_features, 'training_labels': train_meta['classes']}
-
-            # Step 4: Train the classifier on the training data
-            emg = EMGClassifier()
-            emg.add_rejection(0.8)
-            emg.fit(model=self._model, feature_dictionary=data_set)
+            # Steps 1 and 2: Parse training data and extract features, or load them from the feature cache
+            splits = load_features(self.__window_size, self.__window_increment, feature_list, folder=self._data_path,
+                                   cache=self._feature_cache)
+            training_features, train_meta = splits["train"]
+            test_features, test_meta = splits["test"]
+
+            # Steps 3 and 4: Train the classifier on the training data and score it on the held-out reps
+            emg = fit_classifier(training_features, train_meta['classes'], self._model)
+            if self._model == "LDA":
+                # Kept so that adapt() can fold new data into the model without going through the training data again
+                self._statistics = LDAStatistics.from_features(format_features(training_features),
+                                                               train_meta['classes'], emg.classifier.classes_)
+            scores = evaluate_classifier(emg, test_features, test_meta['classes'])
+            logger.info(f"Held-out accuracy {scores['accuracy']:.3f}, rejection rate {scores['rejection_rate']:.3f}")
 
             if not exists(self._classifier_path):
                 makedirs(dirname(self._classifier_path), exist_ok=True)
-            emg.save(self._classifier_path)
+            save_classifier(emg, self._classifier_path)
+            save_configuration(self._classifier_path, self._configuration())
+            if self._statistics is not None:
+                self._statistics.save(self._classifier_path + ADAPTATION_SUFFIX)
 
             # fe.visualize_feature_space(feature_dic=training_features, projection="PCA", classes=train_meta['classes'],
             #                            savedir="data/figs/", normalize=True, test_feature_dic=test_features,
             #                            t_classes=test_meta['classes'])
 
-        return OnlineEMGClassifier(offline_classifier=emg, window_size=self.__window_size,
-                                   window_increment=self.__window_increment, online_data_handler=self._odh,
-                                   features=feature_list)
+        return TRPCOnlineClassifier(offline_classifier=emg, window_size=self.__window_size,
+                                    window_increment=self.__window_increment, online_data_handler=self._odh,
+                                    features=feature_list, incremental_features=self._incremental_features,
+                                    trace=self._trace, fast_inference=self._fast_inference,
+                                    deadline=self._deadline)
+
+    def adapt(self, windows: np.ndarray, labels: np.ndarray, decay: float = 1.0, save: bool = False):
+        """Recalibrates an LDA classifier on newly labeled windows, e.g. from a short session after the electrodes
+        shifted, and swaps the updated model into the running classifier. The windows are folded into the statistics
+        of the data the model was trained on (see trpc.adaptation.LDAStatistics), at a cost proportional to their
+        number, rather than retraining on all of it.
+
+        The statistics are saved next to the classifier file when it is trained. For a classifier trained before, they
+        are computed from the training data on the first call.
+
+            Args:
+                windows: The new windows, shaped (windows, channels, samples)
+                labels: The class of each window
+                decay: Weight of the data seen so far relative to the new windows. Below 1, older data is gradually
+                       forgotten
+                save: If True, the updated classifier and statistics replace those saved at classifier_path, so that
+                      the recalibration survives a restart
+
+            Returns:
+                The updated model
+        """
+        from libemg.feature_extractor import FeatureExtractor
+
+        from trpc.features import get_feature_list
+        from trpc.training import format_features
+
+        if self._model != "LDA":
+            raise ValueError(f"Invalid model for adaptation: {self._model}")
+        classifier = self.classifier
+        feature_list = get_feature_list(self._feature_set)
+        features = FeatureExtractor().extract_features(feature_list, windows, classifier.classifier.feature_params)
+
+        with self._adapt_lock:
+            statistics = self._load_statistics(feature_list)
+            statistics.update(format_features(features), labels, decay)
+            model = statistics.to_model()
+            classifier.swap_model(model)
+            logger.info(f"Adapted the classifier to {len(windows)} windows")
+
+            if save:
+                classifier.classifier.classifier = model
+                save_classifier(classifier.classifier, self._classifier_path)
+                statistics.save(self._classifier_path + ADAPTATION_SUFFIX)
+        return model
+
+    def _load_statistics(self, feature_list: List[str]) -> LDAStatistics:
+        from trpc.training import format_features
+
+        if self._statistics is not None:
+            return self._statistics
+        try:
+            self._statistics = LDAStatistics.load(self._classifier_path + ADAPTATION_SUFFIX)
+        except FileNotFoundError:
+            logger.info("Computing adaptation statistics from the training data...")
+            features, meta = load_features(self.__window_size, self.__window_increment, feature_list,
+                                           splits={"train": TRAIN_REPS}, folder=self._data_path,
+                                           cache=self._feature_cache)["train"]
+            self._statistics = LDAStatistics.from_features(format_features(features), meta["classes"],
+                                                           self.classifier.classifier.classifier.classes_)
+        return self._statistics
 
     @abstractmethod
     def run(self, block: bool = False):
@@ -149,16 +326,43 @@ class TRPCProcessor(Processor):
                          get_feature_groups() function for predefined groups.
             model: Model to use for the classifier
             classifier_path: Path to the classifier file. If the file does not exist, the classifier will be trained
-                             from scratch and saved to this path.
+                             from scratch and saved to this path, along with the window size, window increment, feature
+                             set and model it was trained with. A classifier saved with different ones is rejected.
+            wire_format: The wire format used by the streamer. One of "pickle", "float32" or "int16"
+            transport: "udp" to receive samples over UDP, or "shm" to read them from a shared memory ring buffer
+                       written by a streamer on the same machine
+            channels: Number of channels per sample. Only needed by the "shm" transport
+            incremental_features: If True, features are updated incrementally as the window slides instead of being
+                                  recomputed over every window (see StreamingFeatureExtractor)
+            feature_cache_dir: Directory to cache extracted training features in, so that retraining on the same data
+                               skips feature extraction. None disables the cache.
+            defer_setup: If True, the data handler and classifier are set up in a background thread, so that the
+                         constructor returns immediately and e.g. the streamer can start in the meantime. Accessing
+                         odh or classifier, or calling run(), waits for the setup to finish. Setting up imports
+                         libemg, which takes seconds even with a compact classifier artifact.
+            trace: If True, decisions carry the timestamps needed for latency tracing (see trpc.utils.tracing)
+            data_path: Training data, as a folder of CSV recordings or a dataset store created by
+                       trpc.dataset.convert_dataset(), which loads much faster
+            fast_inference: If True, decisions are made by a LinearInferenceEngine (see trpc.inference) instead of
+                            scikit-learn, with identical results. Requires a linear model, e.g. LDA
+            deadline: If set, the classifier is latency-bounded: windows whose newest sample is older than this many
+                      seconds are skipped, and the increment grows while classification can not keep up (see
+                      TRPCOnlineClassifier)
     """
 
     def __init__(self, window_size: int = 250, window_increment: int = 10, feature_set: str | List[str] = "LS9",
-                 model: str = "LDA", classifier_path: Optional[str] = None):
-        super().__init__(window_size, window_increment, feature_set, model, classifier_path)
+                 model: str = "LDA", classifier_path: Optional[str] = None, wire_format: str = "pickle",
+                 transport: str = "udp", channels: int = 4, incremental_features: bool = False,
+                 feature_cache_dir: Optional[str] = FEATURE_CACHE_DIR, defer_setup: bool = False,
+                 trace: bool = False, data_path: str = DATA_DIR, fast_inference: bool = False,
+                 deadline: Optional[float] = None):
+        super().__init__(window_size, window_increment, feature_set, model, classifier_path, wire_format, transport,
+                         channels, incremental_features, feature_cache_dir, defer_setup, trace, data_path,
+                         fast_inference, deadline)
 
     def run(self, block: bool = False):
-        self._classifier.run(block=block)
+        self.classifier.run(block=block)
 
     def close(self):
         self.odh.stop_listening()
-        self._classifier.stop_running()
+        self.classifier.stop_running()
@@ -0,0 +1,388 @@
+import collections
+import json
+import math
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SESSION_VERSION = 1
+SESSION_MANIFEST = "session.json"
+EMG_STREAM = "emg"
+DECISIONS_STREAM = "decisions"
+# Fields of a recorded decision besides its gesture, as trace points of the controller (see parse_decision())
+DECISION_FIELDS = ("decided", "classified", "sample", "received", "window")
+DECISION_DTYPE = np.dtype([("gesture", "<i4")] + [(field, "<f8") for field in DECISION_FIELDS])
+# Rows per segment file. An EMG segment of 4 channels holds about 20 minutes at 860 samples per second
+EMG_SEGMENT_ROWS = 2 ** 20
+DECISION_SEGMENT_ROWS = 2 ** 16
+# Seconds between two writes of the background thread. Up to this much is lost if a recording process is killed
+FLUSH_INTERVAL = 0.5
+# Maximum number of rows waiting for the background thread. Rows beyond it are dropped rather than buffered
+MAX_PENDING = 2 ** 16
+
+
+def emg_dtype(channels: int) -> np.dtype:
+    """Returns the row type of the EMG stream: the acquisition time and the value of each channel"""
+    return np.dtype([("time", "<f8"), ("emg", "<f4", (channels,))])
+
+
+def is_session(path: str) -> bool:
+    """Returns True if the path is a session recorded by a SessionRecorder"""
+    return os.path.isfile(os.path.join(path, SESSION_MANIFEST))
+
+
+class SegmentWriter:
+    """Appends rows to a stream of preallocated, memory-mapped .npy segment files. Rows are queued by append() and
+    written by a background thread, so appending costs no more than a deque append. When a segment is full, the next
+    one is created. The index of the stream (<stream>.json) lists the segments and the rows written to each, and is
+    replaced atomically after every write, so a session can be read while it is recorded or after a crash.
+
+    If the stream already has an index, e.g. because the process recording it was restarted, the writer resumes it:
+    rows are appended after the indexed rows of its last segment, and new segments continue its numbering. Rows that
+    the previous writer had not indexed yet are lost.
+
+        Args:
+            directory: Directory of the session
+            stream: Name of the stream, used for the index and segment file names
+            dtype: The row type
+            segment_rows: Number of rows per segment file
+            time_field: The field of the row type that holds its time, used for the time range of each segment
+            flush_interval: Seconds between two writes of the background thread
+            max_pending: Maximum number of rows waiting for the background thread
+    """
+
+    def __init__(self, directory: str, stream: str, dtype: np.dtype, segment_rows: int, time_field: str = "time",
+                 flush_interval: float = FLUSH_INTERVAL, max_pending: int = MAX_PENDING):
+        if segment_rows < 1:
+            raise ValueError(f"Invalid segment_rows: {segment_rows}")
+        if flush_interval <= 0:
+            raise ValueError(f"Invalid flush_interval: {flush_interval}")
+
+        self._directory = directory
+        self._stream = stream
+        self._dtype = np.dtype(dtype)
+        self._segment_rows = segment_rows
+        self._time_field = time_field
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._pending: Deque[tuple] = collections.deque()
+        self._segments: List[Dict] = self._read_index()
+        self._segment: Optional[np.memmap] = None
+        self._rows = sum(segment["rows"] for segment in self._segments)
+        self._dropped = 0
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"recorder-{stream}", daemon=True)
+        self._thread.start()
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @property
+    def rows(self):
+        """Number of rows written to the segment files, including those of an earlier writer that this one resumed"""
+        return self._rows
+
+    @property
+    def dropped(self):
+        """Number of rows dropped because the background thread fell behind"""
+        return self._dropped
+
+    def append(self, row: tuple):
+        """Queues a row, as a tuple of the fields of the row type"""
+        if len(self._pending) >= self._max_pending:
+            self._dropped += 1
+            return
+        self._pending.append(row)
+
+    def close(self):
+        """Writes the queued rows and the index, and stops the background thread"""
+        self._closing.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            closing = self._closing.wait(self._flush_interval)
+            try:
+                self._write()
+            except Exception as e:
+                logger.error(f"Error recording {self._stream} to {self._directory}: {e}")
+            if closing:
+                break
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment = None
+
+    def _write(self):
+        count = len(self._pending)
+        if not count:
+            return
+        rows = np.array([self._pending.popleft() for _ in range(count)], dtype=self._dtype)
+        while len(rows):
+            if self._segment is None or self._segments[-1]["rows"] == len(self._segment):
+                self._open_segment()
+            segment = self._segments[-1]
+            written = segment["rows"]
+            chunk = rows[:len(self._segment) - written]
+            self._segment[written:written + len(chunk)] = chunk
+            if written == 0:
+                segment["start"] = float(chunk[self._time_field][0])
+            segment["stop"] = float(chunk[self._time_field][-1])
+            segment["rows"] = written + len(chunk)
+            self._rows += len(chunk)
+            rows = rows[len(chunk):]
+        self._segment.flush()
+        self._write_index()
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.flush()
+        elif self._segments:
+            # Resume the last segment of the previous writer, unless it is full
+            segment = np.lib.format.open_memmap(os.path.join(self._directory, self._segments[-1]["file"]), mode="r+")
+            if self._segments[-1]["rows"] < len(segment):
+                self._segment = segment
+                return
+        file = f"{self._stream}-{len(self._segments):05d}.npy"
+        path = os.path.join(self._directory, file)
+        self._segment = np.lib.format.open_memmap(path, mode="w+", dtype=self._dtype, shape=(self._segment_rows,))
+        if hasattr(os, "posix_fallocate"):
+            # Reserve the blocks now, so that the file system does not allocate them one page at a time
+            with open(path, "rb+") as f:
+                os.posix_fallocate(f.fileno(), 0, os.path.getsize(path))
+        self._segments.append({"file": file, "rows": 0, "start": math.nan, "stop": math.nan})
+
+    def _read_index(self) -> List[Dict]:
+        path = os.path.join(self._directory, f"{self._stream}.json")
+        if not os.path.isfile(path):
+            return []
+        with open(path) as f:
+            index = json.load(f)
+        # Compared as it is stored, since JSON turns the tuples of the description into lists
+        if index["dtype"] != json.loads(json.dumps(np.lib.format.dtype_to_descr(self._dtype))):
+            raise ValueError(f"Invalid dtype for the {self._stream} stream, it was recorded with {index['dtype']}")
+        return index["segments"]
+
+    def _write_index(self):
+        path = os.path.join(self._directory, f"{self._stream}.json")
+        staging = f"{path}.tmp"
+        with open(staging, "w") as f:
+            json.dump({"dtype": np.lib.format.dtype_to_descr(self._dtype), "segments": self._segments}, f, indent=2)
+        os.replace(staging, path)
+
+
+class SessionRecorder:
+    """Records a session of the pipeline for later retraining and debugging: the raw EMG written by the streamer and the
+    decisions received by the controller. Pass it to the Controller, which taps both. Each stream is written from a
+    background thread of the process that records it (see SegmentWriter), so recording adds no I/O to the signal path.
+
+    The recorder can be created in one process and used in processes forked from it: the writer of a stream is created
+    on its first row, in the process that records it, and a forked process starts without the writers of its parent.
+    A process that takes over a stream, e.g. a streamer restarted by a StreamerSupervisor, appends to what was recorded
+    before it. Use Session to read a recorded session.
+
+        Args:
+            path: Directory of the session. It is created if needed, and must not hold another session
+            emg_segment_rows: Number of samples per EMG segment file
+            decision_segment_rows: Number of decisions per decision segment file
+            flush_interval: Seconds between two writes of the background threads
+    """
+
+    def __init__(self, path: str, emg_segment_rows: int = EMG_SEGMENT_ROWS,
+                 decision_segment_rows: int = DECISION_SEGMENT_ROWS, flush_interval: float = FLUSH_INTERVAL):
+        if is_session(path):
+            raise ValueError(f"Invalid session path, a session was already recorded there: {path}")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, SESSION_MANIFEST), "w") as f:
+            json.dump({"version": SESSION_VERSION, "created": time.time()}, f, indent=2)
+
+        self._path = path
+        self._emg_segment_rows = emg_segment_rows
+        self._decision_segment_rows = decision_segment_rows
+        self._flush_interval = flush_interval
+        self._writers: Dict[str, SegmentWriter] = {}
+        if hasattr(os, "register_at_fork"):
+            # Writers inherited from the parent process have no thread in the child
+            os.register_at_fork(after_in_child=self._writers.clear)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def dropped(self) -> Dict[str, int]:
+        """Number of rows of each stream recorded by this process that were dropped"""
+        return {stream: writer.dropped for stream, writer in self._writers.items()}
+
+    def record_emg(self, emg: Sequence[float], timestamp: float):
+        """Records one sample, as written by Streamer.write_emg()"""
+        writer = self._writers.get(EMG_STREAM)
+        if writer is None:
+            writer = self._writers[EMG_STREAM] = SegmentWriter(self._path, EMG_STREAM, emg_dtype(len(emg)),
+                                                               self._emg_segment_rows, "time", self._flush_interval)
+        writer.append((timestamp, emg))
+
+    def record_decision(self, gesture_class: int, trace: Dict[str, float]):
+        """Records one decision, with the trace points of the controller. Missing trace points are recorded as NaN"""
+        writer = self._writers.get(DECISIONS_STREAM)
+        if writer is None:
+            writer = self._writers[DECISIONS_STREAM] = SegmentWriter(self._path, DECISIONS_STREAM, DECISION_DTYPE,
+                                                                     self._decision_segment_rows, "decided",
+                                                                     self._flush_interval)
+        writer.append((gesture_class,) + tuple(trace.get(field, math.nan) for field in DECISION_FIELDS))
+
+    def close(self):
+        """Writes what is left of the streams recorded by this process"""
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+class Session:
+    """A session recorded by a SessionRecorder. Segments are memory-mapped, so opening a session is instant and only
+    the rows that are used are read from disk. A session can also be opened while it is being recorded.
+
+        Args:
+            path: Directory of the session
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, SESSION_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != SESSION_VERSION:
+            raise ValueError(f"Invalid session version: {manifest.get('version')}")
+        self._path = path
+        self._manifest = manifest
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def created(self) -> float:
+        return self._manifest["created"]
+
+    @property
+    def streams(self) -> List[str]:
+        return [stream for stream in (EMG_STREAM, DECISIONS_STREAM)
+                if os.path.isfile(os.path.join(self._path, f"{stream}.json"))]
+
+    def segments(self, stream: str) -> List[np.ndarray]:
+        """Returns the rows written to each segment of a stream, as views of the memory-mapped files"""
+        index_path = os.path.join(self._path, f"{stream}.json")
+        if not os.path.isfile(index_path):
+            return []
+        with open(index_path) as f:
+            index = json.load(f)
+        return [np.load(os.path.join(self._path, segment["file"]), mmap_mode="r")[:segment["rows"]]
+                for segment in index["segments"] if segment["rows"]]
+
+    def read(self, stream: str) -> np.ndarray:
+        """Returns the rows of a stream. This is a view of the memory map if the stream has one segment, and a copy
+        otherwise."""
+        segments = self.segments(stream)
+        if not segments:
+            dtype = DECISION_DTYPE if stream == DECISIONS_STREAM else emg_dtype(0)
+            return np.empty(0, dtype=dtype)
+        return segments[0] if len(segments) == 1 else np.concatenate(segments)
+
+    def emg(self) -> np.ndarray:
+        """Returns the recorded samples, shaped (samples, channels)"""
+        return self.read(EMG_STREAM)["emg"]
+
+    def timestamps(self) -> np.ndarray:
+        """Returns the acquisition time of each recorded sample"""
+        return self.read(EMG_STREAM)["time"]
+
+    def decisions(self) -> np.ndarray:
+        """Returns the recorded decisions, with the fields of DECISION_DTYPE"""
+        return self.read(DECISIONS_STREAM)
+
+    def sampling_rate(self) -> float:
+        """Estimates the sampling rate of the recorded samples from their timestamps"""
+        timestamps = self.timestamps()
+        if len(timestamps) < 2:
+            return math.nan
+        return 1 / float(np.median(np.diff(timestamps)))
+
+    def labels(self) -> np.ndarray:
+        """Labels each recorded sample with the gesture of the first decision whose window ended at or after it, i.e.
+        of the first decision it contributed to. Samples after the last decision are labelled -1, as are the samples
+        of rejected decisions.
+
+        Decisions recorded without trace points are matched by the time they were classified instead.
+        """
+        decisions = self.decisions()
+        timestamps = self.timestamps()
+        if not len(decisions):
+            return np.full(len(timestamps), -1, dtype=np.int32)
+        times = np.where(np.isnan(decisions["sample"]), decisions["classified"], decisions["sample"])
+        order = np.argsort(times, kind="stable")
+        times, gestures = times[order], decisions["gesture"][order]
+        following = np.searchsorted(times, timestamps, side="left")
+        return np.where(following < len(times), gestures[np.minimum(following, len(times) - 1)], -1).astype(np.int32)
+
+
+def convert_session(session_path: str, path: str, labels: Optional[np.ndarray] = None,
+                    values: Optional[Dict[str, List[str]]] = None, min_samples: int = 1, use_decisions: bool = False):
+    """Packs a recorded session into a dataset store (see trpc.dataset), so it can be used as the processor's
+    data_path. Each run of consecutive samples with the same label becomes one recording, and the runs of each class
+    are spread over the reps in turn, so that every rep, and therefore the train and test splits, gets some of each
+    class.
+
+    Args:
+        session_path: Directory of the session
+        path: Directory to create the dataset store in. An existing store is replaced
+        labels: The class (as an index into the class values) of each sample, -1 to leave a sample out, e.g. from the
+                prompts shown during the session. Required unless use_decisions is set
+        values: The values of each metadata key. Defaults to those of the recorded training data
+        min_samples: Runs shorter than this are left out, e.g. the window size, as they yield no windows
+        use_decisions: Labels the samples with the decisions made during the session (see Session.labels()) when no
+                       labels are given. A model trained on them learns the classifier's own output, mistakes and
+                       rejections included, so only use it for debugging or when the decisions were supervised
+    """
+    from trpc.dataset import METADATA_KEYS, write_dataset
+    from trpc.feature_cache import CLASSES_VALUES, REPS_VALUES
+
+    if labels is None and not use_decisions:
+        raise ValueError("Invalid labels, pass the labels of the samples or set use_decisions")
+    session = Session(session_path)
+    emg = session.emg()
+    if labels is None:
+        labels = session.labels()
+    labels = np.asarray(labels)
+    if not len(emg):
+        raise ValueError(f"Invalid session, no samples recorded: {session_path}")
+    if len(labels) != len(emg):
+        raise ValueError(f"Invalid labels, expected {len(emg)} but got {len(labels)}")
+    if values is None:
+        values = {"classes": list(CLASSES_VALUES), "reps": list(REPS_VALUES)}
+
+    # Boundaries of the runs of equal labels
+    boundaries = np.flatnonzero(np.diff(labels)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(labels)]))
+    runs = collections.Counter()
+    recordings = []
+    for start, stop in zip(starts, stops):
+        label = int(labels[start])
+        if label < 0 or stop - start < min_samples:
+            continue
+        if label >= len(values["classes"]):
+            raise ValueError(f"Invalid label: {label}")
+        rep = runs[label] % len(values["reps"])
+        runs[label] += 1
+        recordings.append(((label, rep), np.asarray(emg[start:stop], dtype=np.float32), f"{start}:{stop}"))
+    if not recordings:
+        raise ValueError(f"Invalid session, no labelled samples: {session_path}")
+
+    write_dataset(path, recordings, {key: values[key] for key in METADATA_KEYS})
+    logger.info(f"Converted {len(recordings)} runs of {session_path} to {path}")
@@ -0,0 +1,197 @@
+import math
+import multiprocessing
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from trpc.recorder import Session, is_session
+from trpc.ring_buffer import DEFAULT_RING_BUFFER_NAME
+from trpc.streamer import Streamer
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Replays as fast as the transport allows
+AS_FAST_AS_POSSIBLE = math.inf
+# time.sleep() can overshoot by this much, so sleep until this long before a deadline and spin the rest of the way
+SPIN_THRESHOLD = 500e-6
+# Number of samples sent per iteration when replaying as fast as possible
+UNPACED_CHUNK = 256
+
+
+def convert_recording(csv_path: str, npy_path: Optional[str] = None, delimiter: str = ",") -> str:
+    """Converts a CSV recording (one row per sample, one column per channel) to a float32 .npy file that can be
+    memory-mapped. The conversion is skipped if the .npy file is newer than the CSV file.
+
+    Args:
+        csv_path: Path of the CSV recording
+        npy_path: Path of the .npy file. Defaults to the CSV path with a .npy extension
+        delimiter: Column delimiter of the CSV file
+
+    Returns:
+        The path of the .npy file
+    """
+    if npy_path is None:
+        npy_path = os.path.splitext(csv_path)[0] + ".npy"
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(csv_path):
+        logger.info(f"Converting {csv_path} to {npy_path}...")
+        np.save(npy_path, np.loadtxt(csv_path, delimiter=delimiter, ndmin=2, dtype=np.float32))
+    return npy_path
+
+
+def load_recording(path: str) -> np.ndarray:
+    """Memory-maps a .npy recording. A CSV recording is converted to .npy first (see convert_recording()), and the
+    samples of a session recorded by a SessionRecorder are read from its segments."""
+    if is_session(path):
+        return Session(path).emg()
+    if not path.endswith(".npy"):
+        path = convert_recording(path)
+    recording = np.load(path, mmap_mode="r")
+    if recording.ndim != 2:
+        raise ValueError(f"Invalid recording shape: {recording.shape}")
+    return recording
+
+
+class ReplayStreamer(Streamer):
+    """Streamer that replays a recording instead of reading an ADC. The recording is memory-mapped, so hours of data
+    start instantly and only the pages being replayed are kept in memory.
+
+    Samples are paced on an absolute schedule against time.monotonic(), so timing errors do not accumulate. The
+    replayer sleeps until just before the next deadline and spins the rest of the way. Samples due within the same
+    `tick` are sent together, so at high rates it wakes up once per tick instead of once per sample. Each sample is
+    timestamped with its scheduled time, which is what latency tracing uses as its acquisition time.
+
+        Args:
+            recording: Path of the recording, as .npy (memory-mapped), CSV (converted to .npy on first use) or a
+                       recorded session
+            sampling_rate: The sampling rate of the recording in samples per second
+            speed: Replay speed relative to real time, e.g. 10 for ten times real time. AS_FAST_AS_POSSIBLE disables
+                   pacing.
+            channels: Number of channels (columns) to replay. Defaults to all of them
+            repeat: If True, the recording is replayed in a loop
+            duration: Stop after this many seconds. None replays until the recording ends (or forever, if repeat)
+            tick: Samples due within this many seconds are sent together. 0 paces every sample individually
+            report_interval: Seconds between progress reports in the log. None disables them
+            port: Port number for the socket
+            ip_address: IP address for the socket
+            wire_format: "pickle" or "float32"
+            batch_size: Number of samples to pack into one datagram
+            batch_timeout_ms: Maximum age of a partial batch before it is sent
+            transport: "udp" or "shm"
+            ring_buffer_name: Name of the shared memory ring buffer used by the "shm" transport
+    """
+
+    def __init__(self, recording: str, sampling_rate: float, speed: float = 1.0, channels: Optional[int] = None,
+                 repeat: bool = True, duration: Optional[float] = None, tick: float = 1e-3,
+                 report_interval: Optional[float] = 60.0, port: int = 12345, ip_address: str = "127.0.0.1",
+                 wire_format: str = "float32", batch_size: int = 1, batch_timeout_ms: Optional[float] = None,
+                 transport: str = "udp", ring_buffer_name: str = DEFAULT_RING_BUFFER_NAME):
+        if wire_format == "int16":
+            raise ValueError(f"Invalid wire_format for a replay: {wire_format}")
+        if sampling_rate <= 0:
+            raise ValueError(f"Invalid sampling_rate: {sampling_rate}")
+        if speed <= 0:
+            raise ValueError(f"Invalid speed: {speed}")
+        super().__init__(port, ip_address, wire_format, batch_size, batch_timeout_ms, transport, ring_buffer_name)
+
+        self._recording = recording
+        self._sampling_rate = sampling_rate
+        self._speed = speed
+        self._channels = channels
+        self._repeat = repeat
+        self._duration = duration
+        self._tick = tick
+        self._report_interval = report_interval
+
+        self._samples_sent = 0
+        self._max_lag = 0.0
+
+    @property
+    def recording(self):
+        return self._recording
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @property
+    def samples_sent(self):
+        return self._samples_sent
+
+    @property
+    def max_lag(self):
+        """The furthest (in seconds) the replay has fallen behind its schedule"""
+        return self._max_lag
+
+    def read_emg(self):
+        data = load_recording(self._recording)
+        if self._channels is not None:
+            data = data[:, :self._channels]
+        length = len(data)
+        end = math.inf if self._repeat else length
+        period = 0.0 if math.isinf(self._speed) else 1 / (self._sampling_rate * self._speed)
+        if self._duration is not None:
+            end = min(end, math.inf if period == 0 else math.ceil(self._duration / period))
+
+        start = time.monotonic()
+        wall_start = time.time()
+        deadline = start + self._duration if self._duration is not None else math.inf
+        next_report = start + self._report_interval if self._report_interval is not None else math.inf
+        index = 0
+        try:
+            while index < end and time.monotonic() < deadline:
+                if period:
+                    due = start + index * period
+                    self._wait_until(due)
+                    now = time.monotonic()
+                    self._max_lag = max(self._max_lag, now - due)
+                    # Everything due before the end of this tick goes out now
+                    stop = min(end, max(index + 1, math.floor((now + self._tick - start) / period) + 1))
+                else:
+                    now = time.monotonic()
+                    stop = min(end, index + UNPACED_CHUNK)
+
+                for i in range(index, int(stop)):
+                    timestamp = wall_start + i * period if period else time.time()
+                    self.write_emg(data[i % length].tolist(), timestamp)
+                self._samples_sent += int(stop) - index
+                index = int(stop)
+
+                if now >= next_report:
+                    self._report(now - start)
+                    next_report += self._report_interval
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user. Closing socket and exiting...")
+        finally:
+            self._report(time.monotonic() - start)
+            self.close_socket()
+
+    def _wait_until(self, due: float):
+        remaining = due - time.monotonic()
+        if remaining > SPIN_THRESHOLD:
+            time.sleep(remaining - SPIN_THRESHOLD)
+        while time.monotonic() < due:
+            pass
+
+    def _report(self, elapsed: float):
+        rate = self._samples_sent / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Replayed {self._samples_sent} samples of {self._recording} to port {self._port} in "
+                    f"{elapsed:.1f} s ({rate:.1f} samples/s), max lag {self._max_lag * 1000:.2f} ms")
+
+
+def start_replays(streamers: List[Streamer]) -> List[multiprocessing.Process]:
+    """Starts each streamer in its own process, e.g. one ReplayStreamer per simulated device
+
+    Args:
+        streamers: The streamers to start. Each should send to its own port or ring buffer, which also labels its
+                   metrics
+
+    Returns:
+        The started processes
+    """
+    processes = [multiprocessing.Process(target=streamer.read_emg, daemon=True) for streamer in streamers]
+    for process in processes:
+        process.start()
+    return processes
@@ -0,0 +1,267 @@
+import fcntl
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+TRANSPORTS = ("udp", "shm")
+DEFAULT_RING_BUFFER_NAME = "trpc_emg"
+
+# Header slots (int64) at the start of the shared memory block
+WRITE_INDEX = 0
+READ_INDEX = 1
+OVERRUNS = 2
+CAPACITY = 3
+CHANNELS = 4
+MAX_WINDOW = 5
+# float64 slots: acquisition and write time of the newest samples, for latency tracing
+SAMPLE_TIME = 6
+WRITE_TIME = 7
+# Number of unread samples the producer overwrote
+OVERWRITTEN = 8
+HEADER_SLOTS = 9
+HEADER_SIZE = HEADER_SLOTS * 8
+
+# How long a blocked reader sleeps between checks for new samples
+POLL_INTERVAL = 200e-6
+
+
+class SharedRingBuffer:
+    """Single-producer/single-consumer ring buffer of float32 samples in shared memory.
+
+    The producer appends samples with write() and the consumer reads windows of the most recent samples as copies of
+    the shared memory. The first max_window rows of the buffer are mirrored past its end, so every window of up to
+    max_window samples is a single contiguous copy.
+
+    The write and read positions are monotonically increasing 64-bit sample counts stored in the header, and each is
+    written by one side only. Storing samples and publishing the write position, and reading the write position and
+    copying a window, each hold an flock() of the shared memory block. Besides keeping the producer from overwriting a
+    window while it is copied, the lock orders the memory accesses of the two processes: without it, a weakly ordered
+    CPU (e.g. the ARM cores of a Raspberry Pi) may show the consumer a write position before the samples it covers.
+    Locking and unlocking cost about a microsecond, and the lock is only held for a copy of a window. If the producer
+    gets so far ahead that it overwrites samples the consumer has not read yet, the producer counts the overwritten
+    samples (see overwritten) and the consumer counts an overrun (see overruns).
+
+        Args:
+            name: Name of the shared memory block
+            channels: Number of channels per sample
+            capacity: Number of samples the buffer holds
+            max_window: The largest window that will be read
+            create: If True, the block is created (and owned) by this instance. Otherwise an existing block is attached
+                    to, and channels, capacity and max_window are read from its header.
+    """
+
+    def __init__(self, name: str = DEFAULT_RING_BUFFER_NAME, channels: int = 4, capacity: int = 8192,
+                 max_window: int = 1024, create: bool = True):
+        if create:
+            if max_window > capacity:
+                raise ValueError(f"max_window ({max_window}) must not exceed capacity ({capacity})")
+            size = HEADER_SIZE + (capacity + max_window) * channels * 4
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left over from a process that did not shut down cleanly
+                logger.warning(f"Shared memory block {name} already exists. Replacing it...")
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        self._owner = create
+        self._header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=self._shm.buf)
+        self._times = np.ndarray((2,), dtype=np.float64, buffer=self._shm.buf, offset=SAMPLE_TIME * 8)
+        if create:
+            self._header[:] = 0
+            self._times[:] = np.nan
+            self._header[CAPACITY] = capacity
+            self._header[CHANNELS] = channels
+            self._header[MAX_WINDOW] = max_window
+
+        self._capacity = int(self._header[CAPACITY])
+        self._channels = int(self._header[CHANNELS])
+        self._max_window = int(self._header[MAX_WINDOW])
+        self._data = np.ndarray((self._capacity + self._max_window, self._channels), dtype=np.float32,
+                                buffer=self._shm.buf, offset=HEADER_SIZE)
+
+    def __getstate__(self):
+        # Attach by name in the receiving process rather than pickling the views
+        return {"name": self.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state["name"], create=False)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def max_window(self):
+        return self._max_window
+
+    @property
+    def write_index(self) -> int:
+        return int(self._header[WRITE_INDEX])
+
+    @property
+    def read_index(self) -> int:
+        return int(self._header[READ_INDEX])
+
+    @property
+    def overruns(self) -> int:
+        """Number of times the consumer found that samples it had not read were overwritten"""
+        return int(self._header[OVERRUNS])
+
+    @property
+    def overwritten(self) -> int:
+        """Number of samples the producer overwrote before the consumer read them"""
+        return int(self._header[OVERWRITTEN])
+
+    @property
+    def sample_times(self) -> Tuple[float, float]:
+        """The acquisition time of the newest samples, and the time they were written. NaN if unknown."""
+        return float(self._times[0]), float(self._times[1])
+
+    def write(self, samples, timestamp: Optional[float] = None) -> int:
+        """Appends samples to the buffer. Only one process may write.
+
+        Args:
+            samples: A single sample (one value per channel) or a 2D array of shape (samples, channels)
+            timestamp: Acquisition time of the samples, for latency tracing
+        """
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1, self._channels)
+        if len(samples) > self._capacity:
+            samples = samples[-self._capacity:]
+
+        count = len(samples)
+        # Locked without _locked(), whose generator costs as much again as the lock on this path
+        fcntl.flock(self._shm._fd, fcntl.LOCK_EX)
+        try:
+            write_index, read_index = self._header[WRITE_INDEX:READ_INDEX + 1].tolist()
+            unread = write_index + count - read_index - self._capacity
+            if unread > 0:
+                self._header[OVERWRITTEN] += min(unread, count)
+            position = write_index % self._capacity
+            first = min(count, self._capacity - position)
+            self._store(position, samples[:first])
+            if first < count:
+                self._store(0, samples[first:])
+
+            self._times[:] = (timestamp if timestamp is not None else np.nan, time.time())
+            self._header[WRITE_INDEX] = write_index + count
+        finally:
+            fcntl.flock(self._shm._fd, fcntl.LOCK_UN)
+        return count
+
+    def available(self) -> int:
+        """Returns the number of samples written but not yet consumed"""
+        return int(self._header[WRITE_INDEX]) - int(self._header[READ_INDEX])
+
+    def latest(self, size: int) -> np.ndarray:
+        """Returns a copy of the newest `size` samples (or fewer, if fewer have been written)"""
+        with self._locked():
+            end = int(self._header[WRITE_INDEX])
+            return self._copy(max(end - size, 0), end)
+
+    def read(self, size: int, increment: int = 0, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """Blocks until a full window is available and returns a copy of it, then moves the read position to
+        `increment` samples past the start of the window. The window is the newest `size` samples, so a consumer that
+        falls behind always catches up to the present.
+
+        Args:
+            size: Number of samples in the window. Must not exceed max_window
+            increment: Number of samples to advance after this window
+            timeout: Maximum time to wait in seconds. None waits forever
+
+        Returns:
+            The window, or None if the timeout expired first
+        """
+        if size > self._max_window:
+            raise ValueError(f"Window size {size} exceeds max_window {self._max_window}")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Checked without the lock first, so that waiting for samples does not hold up the producer
+            if int(self._header[WRITE_INDEX]) - int(self._header[READ_INDEX]) >= size:
+                with self._locked():
+                    end = int(self._header[WRITE_INDEX])
+                    if end - int(self._header[READ_INDEX]) > self._capacity:
+                        # The producer overwrote samples that were never read
+                        self._header[OVERRUNS] += 1
+                    window = self._copy(end - size, end)
+                    self._header[READ_INDEX] = end - size + increment
+                    return window
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def window(self, start: int, end: int) -> np.ndarray:
+        """Returns a copy of the samples from write position `start` up to `end`, e.g. a window returned by read()
+        extended back to earlier samples"""
+        if not 0 <= end - start <= self._max_window:
+            raise ValueError(f"Invalid window: {start} to {end}")
+        with self._locked():
+            write_index = int(self._header[WRITE_INDEX])
+            if end > write_index:
+                raise ValueError(f"Invalid window, samples up to {end} were not written yet")
+            if start < write_index - self._capacity:
+                raise ValueError(f"Invalid window, samples from {start} were overwritten")
+            return self._copy(start, end)
+
+    def advance(self, count: int):
+        """Moves the read position forward by `count` samples. Only the consumer may advance."""
+        with self._locked():
+            self._header[READ_INDEX] += count
+
+    def reset(self):
+        """Discards all unread samples. Only the consumer may reset."""
+        with self._locked():
+            self._header[READ_INDEX] = self._header[WRITE_INDEX]
+
+    def close(self):
+        """Detaches from the shared memory block, and removes it if this instance created it"""
+        self._header = None
+        self._times = None
+        self._data = None
+        self._shm.close()
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _store(self, position: int, rows: np.ndarray):
+        self._data[position:position + len(rows)] = rows
+        # Mirror the start of the buffer past its end, so windows that wrap around are still contiguous
+        mirrored = min(len(rows), self._max_window - position)
+        if mirrored > 0:
+            self._data[self._capacity + position:self._capacity + position + mirrored] = rows[:mirrored]
+
+    @contextmanager
+    def _locked(self):
+        # Each instance opened the block itself, so the producer's and consumer's locks exclude each other even within
+        # one process
+        fcntl.flock(self._shm._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._shm._fd, fcntl.LOCK_UN)
+
+    def _copy(self, start: int, end: int) -> np.ndarray:
+        position = start % self._capacity
+        return self._data[position:position + end - start].copy()
@@ -0,0 +1,193 @@
+import os
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from trpc.utils.logger import get_logger
+from trpc.utils.metrics import get_registry
+from trpc.utils.tracing import LatencyHistogram
+
+logger = get_logger(__name__)
+
+# Stages of the pipeline that are placed separately: the streamer process, the data handler, RawData manager and
+# classification processes of the processor, and the controller process with the driver's servo workers
+STAGES = ("streamer", "processor", "controller")
+# Seconds between two readings of the run-queue delay of the stages
+JITTER_INTERVAL = 0.1
+
+
+class StagePolicy(NamedTuple):
+    """Where and how the threads of a stage are scheduled. Any field left at None is not changed.
+
+        Args:
+            cores: The cores the stage may run on
+            priority: SCHED_FIFO priority (1-99). Only use it for stages that block while idle, since a real-time task
+                      that spins keeps everything else off its cores
+            nice: Niceness under the normal scheduler, from -20 (highest priority) to 19. Ignored with a priority
+    """
+    cores: Optional[Tuple[int, ...]] = None
+    priority: Optional[int] = None
+    nice: Optional[int] = None
+
+
+def list_threads(pids: Sequence[int]) -> List[int]:
+    """Returns the thread ids of the processes, skipping processes that exited"""
+    threads = []
+    for pid in pids:
+        try:
+            threads.extend(int(tid) for tid in os.listdir(f"/proc/{pid}/task"))
+        except FileNotFoundError:
+            continue
+    return threads
+
+
+def read_run_delay(threads: Sequence[int]) -> Tuple[float, int]:
+    """Returns the total time the threads spent runnable but waiting for a core, in seconds, and the number of times
+    they were scheduled, from /proc/<tid>/schedstat"""
+    waiting, slices = 0, 0
+    for tid in threads:
+        try:
+            with open(f"/proc/{tid}/schedstat") as f:
+                _, wait_ns, timeslices = f.read().split()
+        except (FileNotFoundError, ProcessLookupError, ValueError):
+            continue
+        waiting += int(wait_ns)
+        slices += int(timeslices)
+    return waiting / 1e9, slices
+
+
+class PlacementPolicy:
+    """Pins each stage of the pipeline to its own cores and optionally raises its scheduling priority, so that other
+    processes on the board do not show up as sampling gaps and latency spikes. Priorities that are not permitted, e.g.
+    SCHED_FIFO without CAP_SYS_NICE or a matching RLIMIT_RTPRIO, are logged and skipped rather than failing.
+
+    The controller applies the policy once every stage is running (see Controller.start()), and then measures the
+    scheduling jitter of each stage: the mean time its threads waited for a core each time they were scheduled, over
+    every JITTER_INTERVAL. See jitter() and the trpc_stage_run_delay_seconds metric.
+
+        Args:
+            streamer: The policy of the streamer process
+            processor: The policy of the data handler, RawData manager and classification processes
+            controller: The policy of the controller process, including the driver's servo workers
+            interval: Seconds between two measurements of the run-queue delay. None disables the measurement
+    """
+
+    def __init__(self, streamer: Optional[StagePolicy] = None, processor: Optional[StagePolicy] = None,
+                 controller: Optional[StagePolicy] = None, interval: Optional[float] = JITTER_INTERVAL):
+        self._policies = {"streamer": streamer or StagePolicy(), "processor": processor or StagePolicy(),
+                          "controller": controller or StagePolicy()}
+        available = os.sched_getaffinity(0)
+        for stage, policy in self._policies.items():
+            if policy.cores is not None and (not policy.cores or not set(policy.cores) <= available):
+                raise ValueError(f"Invalid cores for the {stage}: {policy.cores}")
+            if policy.priority is not None and not 1 <= policy.priority <= 99:
+                raise ValueError(f"Invalid priority for the {stage}: {policy.priority}")
+            if policy.nice is not None and not -20 <= policy.nice <= 19:
+                raise ValueError(f"Invalid nice for the {stage}: {policy.nice}")
+        if interval is not None and interval <= 0:
+            raise ValueError(f"Invalid interval: {interval}")
+        self._interval = interval
+
+        self._jitter = {stage: LatencyHistogram() for stage in STAGES}
+        self._lock = threading.Lock()
+        self._monitor: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        registry = get_registry()
+        self._jitter_metrics = {stage: registry.histogram("trpc_stage_run_delay_seconds",
+                                                          "Mean time the threads of a stage waited for a core per "
+                                                          "scheduling, over each measurement interval",
+                                                          labels={"stage": stage})
+                                for stage in STAGES}
+
+    @classmethod
+    def four_core(cls, realtime: bool = False) -> "PlacementPolicy":
+        """The placement for a 4-core board: core 0 is left to the OS and interrupts, and the streamer, processor and
+        controller get cores 1, 2 and 3. With realtime, the streamer and controller run under SCHED_FIFO, the
+        streamer first. The classifier polls for data without blocking, so the processor only gets a lower niceness."""
+        return cls(streamer=StagePolicy(cores=(1,), priority=80 if realtime else None, nice=-10),
+                   processor=StagePolicy(cores=(2,), nice=-5 if realtime else None),
+                   controller=StagePolicy(cores=(3,), priority=70 if realtime else None, nice=-5))
+
+    @property
+    def policies(self) -> Dict[str, StagePolicy]:
+        return self._policies
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def apply(self, stage: str, pids: Sequence[int]) -> Dict[str, bool]:
+        """Applies the policy of a stage to every thread of its processes. Threads they create later inherit it.
+
+            Returns:
+                Whether the affinity, priority and niceness were applied, for those that the policy sets
+        """
+        if stage not in self._policies:
+            raise ValueError(f"Invalid stage: {stage}")
+        policy = self._policies[stage]
+        threads = list_threads(pids)
+        applied = {}
+        if policy.cores is not None:
+            applied["affinity"] = self._apply(stage, "affinity",
+                                              lambda tid: os.sched_setaffinity(tid, policy.cores), threads)
+        if policy.priority is not None:
+            param = os.sched_param(policy.priority)
+            applied["priority"] = self._apply(stage, "SCHED_FIFO",
+                                              lambda tid: os.sched_setscheduler(tid, os.SCHED_FIFO, param), threads)
+        elif policy.nice is not None:
+            applied["nice"] = self._apply(stage, "nice",
+                                          lambda tid: os.setpriority(os.PRIO_PROCESS, tid, policy.nice), threads)
+        logger.info(f"Placed the {stage} ({len(threads)} threads): {policy._asdict()}, applied {applied}")
+        return applied
+
+    def start_monitor(self, stages: Dict[str, Callable[[], Sequence[int]]]):
+        """Starts measuring the scheduling jitter of the stages in a background thread
+
+            Args:
+                stages: For each stage, a function returning the ids of its processes
+        """
+        if self._interval is None or self._monitor is not None:
+            return
+        if not os.path.exists(f"/proc/{os.getpid()}/schedstat"):
+            logger.warning("The kernel does not report scheduler statistics, scheduling jitter is not measured")
+            return
+        self._stop.clear()
+        self._monitor = threading.Thread(target=self._measure, args=(stages,), name="scheduling-monitor",
+                                         daemon=True)
+        self._monitor.start()
+
+    def stop_monitor(self):
+        if self._monitor is None:
+            return
+        self._stop.set()
+        self._monitor.join()
+        self._monitor = None
+
+    def jitter(self) -> Dict[str, Dict[str, float]]:
+        """Returns the summary (see LatencyHistogram.summary()) of the run-queue delay of every measured stage"""
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._jitter.items() if histogram.count}
+
+    def _apply(self, stage: str, what: str, function: Callable[[int], None], threads: Sequence[int]) -> bool:
+        for tid in threads:
+            try:
+                function(tid)
+            except ProcessLookupError:
+                # The thread exited meanwhile, the others are still placed
+                continue
+            except PermissionError:
+                logger.warning(f"Not permitted to set the {what} of the {stage}, leaving it unchanged")
+                return False
+        return True
+
+    def _measure(self, stages: Dict[str, Callable[[], Sequence[int]]]):
+        previous = {}
+        while not self._stop.wait(self._interval):
+            for stage, pids in stages.items():
+                waiting, slices = read_run_delay(list_threads(pids()))
+                if stage in previous and slices > previous[stage][1]:
+                    # Threads that exited take their counts with them, so only growing totals are measured
+                    delay = max(waiting - previous[stage][0], 0.0) / (slices - previous[stage][1])
+                    with self._lock:
+                        self._jitter[stage].record(delay)
+                    self._jitter_metrics[stage].observe(delay)
+                previous[stage] = waiting, slices
@@ -0,0 +1,225 @@
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+import numpy as np
+from gpiozero import Device
+from gpiozero.pins import Factory
+
+# Data rate register values of the ADS111x and the corresponding samples per second
+DATA_RATES = {0: 8, 1: 16, 2: 32, 3: 64, 4: 128, 5: 250, 6: 475, 7: 860}
+# Gain register values and the corresponding full scale range in volts
+FULL_SCALE_RANGES = {0: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+
+def sine_source(frequencies=(50.0, 80.0, 120.0, 160.0), amplitude: float = 0.5) -> Callable[[int, float], float]:
+    """Returns a signal source that produces a sine wave with a different frequency on each channel"""
+    def source(channel: int, t: float) -> float:
+        return amplitude * math.sin(2 * math.pi * frequencies[channel % len(frequencies)] * t)
+    return source
+
+
+def array_source(data: np.ndarray, sampling_rate: float) -> Callable[[int, float], float]:
+    """Returns a signal source that replays recorded data (samples x channels) in a loop at the given rate"""
+    def source(channel: int, t: float) -> float:
+        return float(data[int(t * sampling_rate) % len(data), channel % data.shape[1]])
+    return source
+
+
+def csv_source(file_path: str, sampling_rate: float, delimiter: str = ",") -> Callable[[int, float], float]:
+    """Returns a signal source that replays a recording (one row per sample, one column per channel, in volts) in a
+    loop at the given rate"""
+    return array_source(np.loadtxt(file_path, delimiter=delimiter, ndmin=2), sampling_rate)
+
+
+class SimulatedADS1115:
+    """Stand-in for ADS1x15.ADS1115 that can be used off-device. It implements the subset of the ADS1115 API used by
+    the streamers, including the timing of single-shot and continuous conversions at the configured data rate, and can
+    drive a simulated ALERT/RDY pin through a gpiozero pin factory (e.g. gpiozero's MockFactory).
+
+        Args:
+            busId: I2C bus of the device. Only kept for parity with ADS1115
+            address: I2C address of the device. Only kept for parity with ADS1115
+            source: Callable that returns the voltage of a channel at a given time (in seconds since creation)
+            alert_pin: GPIO pin number of the simulated ALERT/RDY pin, if any
+            pin_factory: The gpiozero pin factory providing the ALERT/RDY pin. Defaults to Device.pin_factory
+    """
+
+    INPUT_SINGLE_0 = 4
+
+    PGA_6_144V = 0
+    PGA_4_096V = 1
+    PGA_2_048V = 2
+    PGA_1_024V = 4
+    PGA_0_512V = 8
+    PGA_0_256V = 16
+
+    MODE_CONTINUOUS = 0
+    MODE_SINGLE = 1
+
+    DR_ADS111X_8 = 0
+    DR_ADS111X_16 = 1
+    DR_ADS111X_32 = 2
+    DR_ADS111X_64 = 3
+    DR_ADS111X_128 = 4
+    DR_ADS111X_250 = 5
+    DR_ADS111X_475 = 6
+    DR_ADS111X_860 = 7
+
+    COMP_QUE_1_CONV = 0
+    COMP_QUE_NONE = 3
+
+    def __init__(self, busId: int = 1, address: int = 0x48, source: Optional[Callable[[int, float], float]] = None,
+                 alert_pin: Optional[int] = None, pin_factory: Optional[Factory] = None):
+        self.bus_id = busId
+        self.address = address
+        self._source = source if source is not None else sine_source()
+        self._epoch = time.monotonic()
+
+        self._mode = self.MODE_SINGLE
+        self._data_rate = self.DR_ADS111X_128
+        self._gain = self.PGA_2_048V
+        self._input = self.INPUT_SINGLE_0
+        self._comparator_queue = self.COMP_QUE_NONE
+        self._threshold_low = -32768
+        self._threshold_high = 32767
+
+        # Start and end time of the current conversion. In continuous mode, the end of the first conversion after
+        # the last configuration change.
+        self._conversion_start = -math.inf
+        self._conversion_end = -math.inf
+
+        self._alert_pin = None
+        self._alert_timer: Optional[threading.Timer] = None
+        if alert_pin is not None:
+            factory = pin_factory if pin_factory is not None else Device.pin_factory
+            self._alert_pin = factory.pin(alert_pin)
+            self._alert_pin.drive_high()
+
+        # Number of register reads and writes, as a proxy for I2C bus traffic
+        self.register_reads = 0
+        self.register_writes = 0
+
+    @property
+    def conversion_time(self) -> float:
+        return 1 / DATA_RATES[self._data_rate]
+
+    def setDataRate(self, dataRate: int):
+        self.register_writes += 1
+        self._data_rate = dataRate if dataRate in DATA_RATES else self.DR_ADS111X_128
+
+    def getDataRate(self) -> int:
+        return self._data_rate
+
+    def setGain(self, gain: int):
+        self.register_writes += 1
+        self._gain = gain if gain in FULL_SCALE_RANGES else self.PGA_2_048V
+
+    def getGain(self) -> int:
+        return self._gain
+
+    def setMode(self, mode: int):
+        self.register_writes += 1
+        self._mode = self.MODE_CONTINUOUS if mode == 0 else self.MODE_SINGLE
+        if self._mode == self.MODE_CONTINUOUS:
+            self._start_conversion()
+
+    def getMode(self) -> int:
+        return self._mode
+
+    def setInput(self, input: int):
+        self.register_writes += 1
+        self._input = input if 0 <= input <= 7 else 0
+        # Writing the config register restarts the conversion in continuous mode
+        if self._mode == self.MODE_CONTINUOUS:
+            self._start_conversion()
+
+    def getInput(self) -> int:
+        return self._input
+
+    def setComparatorQueue(self, comparatorQueue: int):
+        self.register_writes += 1
+        self._comparator_queue = comparatorQueue
+
+    def setComparatorThresholdLow(self, threshold: float):
+        self.register_writes += 1
+        self._threshold_low = round(threshold)
+
+    def setComparatorThresholdHigh(self, threshold: float):
+        self.register_writes += 1
+        self._threshold_high = round(threshold)
+
+    def isReady(self) -> bool:
+        self.register_reads += 1
+        # Like the real device, the OS bit never reports ready while converting continuously
+        return self._mode == self.MODE_SINGLE and time.monotonic() >= self._conversion_end
+
+    def isBusy(self) -> bool:
+        return not self.isReady()
+
+    def requestADC(self, pin: int):
+        if pin < 0 or pin > 3:
+            return
+        self.setInput(pin + 4)
+        if self._mode == self.MODE_SINGLE:
+            self.register_writes += 1
+            self._start_conversion()
+
+    def getValue(self) -> int:
+        self.register_reads += 1
+        completed = self._last_completed(time.monotonic())
+        channel = self._input - 4 if self._input >= 4 else 0
+        volts = self._source(channel, completed - self._epoch)
+        return max(-32768, min(32767, round(volts / self.toVoltage(1))))
+
+    def readADC(self, pin: int) -> int:
+        if pin < 0 or pin > 3:
+            return 0
+        self.requestADC(pin)
+        time.sleep(max(self._conversion_end - time.monotonic(), 0))
+        return self.getValue()
+
+    def getMaxVoltage(self) -> float:
+        return FULL_SCALE_RANGES[self._gain]
+
+    def toVoltage(self, value: int = 1) -> float:
+        return self.getMaxVoltage() * value / 32767
+
+    def close(self):
+        if self._alert_timer is not None:
+            self._alert_timer.cancel()
+
+    def _alert_enabled(self) -> bool:
+        # The ALERT/RDY pin acts as a conversion ready signal when the MSB of the high threshold is set, the MSB of the
+        # low threshold is cleared and the comparator is enabled
+        return self._alert_pin is not None and self._comparator_queue != self.COMP_QUE_NONE and \
+            self._threshold_high & 0x8000 and not self._threshold_low & 0x8000
+
+    def _last_completed(self, now: float) -> float:
+        """Returns the end time of the most recently completed conversion"""
+        if self._mode == self.MODE_SINGLE or now < self._conversion_end:
+            return self._conversion_end
+        period = self.conversion_time
+        return self._conversion_end + math.floor((now - self._conversion_end) / period) * period
+
+    def _start_conversion(self):
+        self._conversion_start = time.monotonic()
+        self._conversion_end = self._conversion_start + self.conversion_time
+        if self._alert_enabled():
+            self._alert_pin.drive_high()
+            self._schedule_alert(self._conversion_end)
+
+    def _schedule_alert(self, at: float):
+        if self._alert_timer is not None:
+            self._alert_timer.cancel()
+        self._alert_timer = threading.Timer(max(at - time.monotonic(), 0), self._on_conversion_complete, args=(at,))
+        self._alert_timer.daemon = True
+        self._alert_timer.start()
+
+    def _on_conversion_complete(self, at: float):
+        self._alert_pin.drive_low()
+        if self._mode == self.MODE_CONTINUOUS:
+            # In continuous mode the pin only pulses at the end of each conversion
+            self._alert_pin.drive_high()
+            self._schedule_alert(at + self.conversion_time)
@@ -1,43 +1,217 @@
 import pickle
+import queue
 import socket
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List
-
-from ADS1x15 import ADS1115
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence
 
+from trpc.acquisition import ADS111X_DATA_RATES, CONVERSION_TOLERANCE, Board, ConversionScheduler, FrameAligner
+from trpc.ring_buffer import DEFAULT_RING_BUFFER_NAME, TRANSPORTS, SharedRingBuffer
 from trpc.utils.logger import get_logger
+from trpc.utils.metrics import get_registry
+from trpc.wire import WIRE_FORMATS, encode_frame
+
+if TYPE_CHECKING:
+    from ADS1x15 import ADS1115
+
+    from trpc.recorder import SessionRecorder
 
 logger = get_logger(__name__)
 
+# Default alignment tolerance of MultiBoardStreamer, as a fraction of the time a board takes for one reading
+ALIGNMENT_TOLERANCE = 0.75
+
 
 class Streamer(ABC):
-    """Abstract Streamer class for sending data from device to LibEMG pipeline"""
+    """Abstract Streamer class for sending data from device to LibEMG pipeline
+
+        Args:
+            port: Port number for the socket
+            ip_address: IP address for the socket
+            wire_format: Encoding of each datagram. "pickle" is understood by libemg's OnlineDataHandler, while
+                         "float32" and "int16" send compact binary frames (see trpc.wire) that must be received by a
+                         TRPCDataHandler.
+            batch_size: Number of samples to pack into one datagram. Batching requires a binary wire format.
+            batch_timeout_ms: If set, a partial batch is sent once its oldest sample is this many milliseconds old. The
+                              timeout is checked whenever a new sample is written.
+            transport: "udp" to send datagrams to the port, or "shm" to write samples into the shared memory ring
+                       buffer of a processor running on the same machine (see SharedMemoryDataHandler)
+            ring_buffer_name: Name of the shared memory ring buffer used by the "shm" transport
+    """
+
+    def __init__(self, port: int = 12345, ip_address: str = "127.0.0.1", wire_format: str = "pickle",
+                 batch_size: int = 1, batch_timeout_ms: Optional[float] = None, transport: str = "udp",
+                 ring_buffer_name: str = DEFAULT_RING_BUFFER_NAME) -> None:
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Invalid transport: {transport}")
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"Invalid wire_format: {wire_format}")
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch_size: {batch_size}")
+        if wire_format == "pickle" and (batch_size > 1 or batch_timeout_ms is not None):
+            raise ValueError("Batching requires a binary wire_format (float32 or int16)")
 
-    def __init__(self, port: int = 12345, ip_address: str = "127.0.0.1") -> None:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._port = port
         self._ip_address = ip_address
+        self._wire_format = wire_format
+        self._sequence = 0
+        # Volts per count. Only used by the int16 wire format, where raw ADC counts are sent instead of voltages.
+        self._scale = 1.0
+
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout_ms / 1000 if batch_timeout_ms is not None else None
+        self._batch: List[List[float | int]] = []
+        self._batch_timestamp = 0.0
+        self._batch_started = 0.0
+
+        self._transport = transport
+        self._ring_buffer_name = ring_buffer_name
+        # Attached on the first write, so that it happens in the streamer process
+        self._ring_buffer: Optional[SharedRingBuffer] = None
+        self._recorder: Optional["SessionRecorder"] = None
+
+        # Labeled with the destination, so that streamers running in separate processes, e.g. replays of several
+        # devices, never update the same metric
+        stream = ring_buffer_name if transport == "shm" else f"{ip_address}:{port}"
+        registry = get_registry()
+        self._samples_metric = registry.counter("trpc_streamer_samples_total", "Samples written by the streamer",
+                                                labels={"stream": stream})
+        self._datagrams_metric = registry.counter("trpc_streamer_datagrams_total", "Datagrams sent by the streamer",
+                                                  labels={"stream": stream})
+        # Counted by earlier streamers to the same destination in this process
+        self._samples_before = int(self._samples_metric.value)
+        self._datagrams_before = int(self._datagrams_metric.value)
 
     @property
     def socket(self):
         return self._socket
-    
+
+    @property
+    def wire_format(self):
+        return self._wire_format
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def samples_written(self) -> int:
+        """Samples written so far by every process of this streamer, e.g. the streamer process"""
+        return int(self._samples_metric.value) - self._samples_before
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def recorder(self):
+        return self._recorder
+
+    def set_recorder(self, recorder: Optional["SessionRecorder"]):
+        """Records every sample written from now on to a SessionRecorder, as voltages. Set it before the streamer
+        process is started."""
+        self._recorder = recorder
+
     @abstractmethod
     def read_emg(self):
         """Reads EMG data from the device"""
         pass
 
-    def write_to_socket(self, emg: List[float | int]):
-        """Writes data to socket. On every sample, we pickle the data and send it to the socket.
-        
+    def write_emg(self, emg: List[float | int], timestamp: Optional[float] = None):
+        """Writes a sample to the configured transport.
+
         Args:
-            emg: EMG data to write. This should be a list of voltage values read from each channel
+            emg: EMG data to write. This should be a list of voltage values read from each channel, or raw ADC counts
+                 when using the int16 wire format
+            timestamp: Acquisition time of the sample. Defaults to the current time
         """
-        self._socket.sendto(pickle.dumps(emg), (self._ip_address, self._port))
+        self._samples_metric.inc()
+        if self._recorder is not None:
+            voltages = [value * self._scale for value in emg] if self._wire_format == "int16" else emg
+            self._recorder.record_emg(voltages, timestamp if timestamp is not None else time.time())
+        if self._transport == "shm":
+            self.write_to_ring_buffer(emg, timestamp)
+        else:
+            self.write_to_socket(emg, timestamp)
+
+    def write_to_ring_buffer(self, emg: List[float | int], timestamp: Optional[float] = None):
+        """Writes a sample to the shared memory ring buffer. The ring buffer must have been created by the processor.
+
+        Args:
+            emg: EMG data to write. Raw ADC counts are converted to voltages when using the int16 wire format
+            timestamp: Acquisition time of the sample. Defaults to the current time
+        """
+        if self._ring_buffer is None:
+            self._ring_buffer = SharedRingBuffer(name=self._ring_buffer_name, create=False)
+        if self._wire_format == "int16":
+            emg = [value * self._scale for value in emg]
+        self._ring_buffer.write(emg, timestamp if timestamp is not None else time.time())
+
+    def write_to_socket(self, emg: List[float | int], timestamp: Optional[float] = None):
+        """Writes data to socket. Samples are encoded in the configured wire format and sent to the socket once a full
+        batch (or a batch that has timed out) has been collected. Without batching, every sample is sent immediately.
+
+        Args:
+            emg: EMG data to write. This should be a list of voltage values read from each channel, or raw ADC counts
+                 when using the int16 wire format
+            timestamp: Acquisition time of the sample. Defaults to the current time
+        """
+        if self._wire_format == "pickle":
+            self._socket.sendto(pickle.dumps(emg), (self._ip_address, self._port))
+            self._datagrams_metric.inc()
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+        if self._batch_size == 1 and self._batch_timeout is None:
+            self._send_frame(emg, timestamp)
+            return
+
+        now = time.monotonic()
+        if not self._batch:
+            self._batch_timestamp = timestamp
+            self._batch_started = now
+        self._batch.append(emg)
+
+        if len(self._batch) >= self._batch_size or \
+                (self._batch_timeout is not None and now - self._batch_started >= self._batch_timeout):
+            self.flush()
+
+    def flush(self):
+        """Sends any samples of a partially filled batch"""
+        if self._batch:
+            self._send_frame(self._batch, self._batch_timestamp)
+            self._batch = []
+
+    def prepare_restart(self):
+        """Prepares the streamer to run in a new process after its process died, e.g. when a StreamerSupervisor
+        restarts it. The sequence numbers continue from the datagrams sent so far, so that the processor does not
+        mistake the frames of the new process for reordered ones."""
+        self._sequence = int(self._datagrams_metric.value) - self._datagrams_before
+        self._batch = []
 
     def close_socket(self):
-        """Closes the socket"""
+        """Sends any pending samples and closes the socket, and detaches from the ring buffer if one is used"""
+        if self._socket.fileno() != -1:
+            self.flush()
         self._socket.close()
+        if self._ring_buffer is not None:
+            self._ring_buffer.close()
+            self._ring_buffer = None
+        if self._recorder is not None:
+            self._recorder.close()
+
+    def _send_frame(self, samples: List[float | int] | List[List[float | int]], timestamp: float):
+        frame = encode_frame(samples, self._sequence, timestamp, self._wire_format, self._scale)
+        self._socket.sendto(frame, (self._ip_address, self._port))
+        self._sequence += 1
+        self._datagrams_metric.inc()
 
 
 class TRPCStreamer(Streamer):
@@ -46,32 +220,196 @@ class TRPCStreamer(Streamer):
         Args:
             port: Port number for the socket
             ip_address: IP address for the socket
+            wire_format: Encoding of each datagram. One of "pickle", "float32" or "int16"
+            batch_size: Number of samples to pack into one datagram
+            batch_timeout_ms: Maximum age of a partial batch before it is sent
+            acquisition_mode: "single" for pipelined single-shot conversions or "continuous". See ConversionScheduler
+            wait: How to wait for conversions. One of "poll", "sleep" or "alert"
+            alert_pin: GPIO pin connected to the ADS1115 ALERT/RDY pin. Required when wait is "alert"
+            adc_factory: Callable that creates the ADC inside the streamer process. Defaults to ADS1115 on I2C bus 1.
+                         Pass a SimulatedADS1115 factory to run off-device.
+            transport: "udp" or "shm"
+            ring_buffer_name: Name of the shared memory ring buffer used by the "shm" transport
+            channels: Number of single-ended inputs to read, starting at A0 (1 to 4)
     """
 
-    def __init__(self, port: int = 12345, ip_address: str = "127.0.0.1"):
-        super().__init__(port, ip_address)
+    def __init__(self, port: int = 12345, ip_address: str = "127.0.0.1", wire_format: str = "pickle",
+                 batch_size: int = 1, batch_timeout_ms: Optional[float] = None, acquisition_mode: str = "single",
+                 wait: str = "sleep", alert_pin: Optional[int] = None,
+                 adc_factory: Optional[Callable[[], "ADS1115"]] = None, transport: str = "udp",
+                 ring_buffer_name: str = DEFAULT_RING_BUFFER_NAME, channels: int = 4):
+        super().__init__(port, ip_address, wire_format, batch_size, batch_timeout_ms, transport, ring_buffer_name)
+        if not 1 <= channels <= 4:
+            raise ValueError(f"Invalid channels: {channels}")
 
         self._adc = None
+        self._scheduler = None
+        self._acquisition_mode = acquisition_mode
+        self._wait = wait
+        self._alert_pin = alert_pin
+        self._adc_factory = adc_factory
+        self._channels = channels
 
-    def read_emg(self):
-        self._adc = ADS1115(1)
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def scheduler(self):
+        return self._scheduler
 
-        # set the gain and data rate (samples/second)
-        self._adc.setDataRate(ADS1115.DR_ADS111X_860)
-        self._adc.setGain(ADS1115.PGA_4_096V)
+    def read_emg(self):
+        if self._adc_factory is not None:
+            self._adc = self._adc_factory()
+        else:
+            # Imported here because ADS1x15 opens the I2C bus on import, which only the streamer process needs
+            from ADS1x15 import ADS1115
+            self._adc = ADS1115(1)
 
-        # set the mode to single shot
-        self._adc.setMode(ADS1115.MODE_SINGLE)
+        # The scheduler sets the gain and data rate (samples/second) and keeps the next conversion in flight while
+        # each sample is sent
+        self._scheduler = ConversionScheduler(self._adc, channels=range(self._channels), mode=self._acquisition_mode,
+                                              wait=self._wait, data_rate=self._adc.DR_ADS111X_860,
+                                              gain=self._adc.PGA_4_096V, alert_pin=self._alert_pin)
+        self._scheduler.start()
+        self._scale = self._adc.toVoltage(1)
 
-        self._adc.requestADC(0)
         try:
             while True:
-                if self._adc.isReady():
-                    voltages = [self._adc.toVoltage(self._adc.readADC(i)) for i in range(4)]
-                    self.write_to_socket(voltages)
+                values, timestamps = self._scheduler.read()
+                if self._wire_format == "int16":
+                    self.write_emg(values, timestamps[0])
+                else:
+                    self.write_emg([value * self._scale for value in values], timestamps[0])
         except KeyboardInterrupt:
             logger.info("Interrupted by user. Closing socket and exiting...")
+            self._scheduler.stop()
             self.close_socket()
             exit(0)
         except SystemExit:
+            self._scheduler.stop()
+            self.close_socket()
+
+
+class MultiBoardStreamer(Streamer):
+    """Streamer that reads several ADS1115 boards, at different I2C addresses or on different buses, and merges them
+    into one multi-channel sample stream. Each board is read by its own worker thread with its own ConversionScheduler,
+    so the boards convert in parallel, and the readings are aligned by their timestamps (see FrameAligner). Each sample
+    holds the channels of every board, in the order of the boards, and is timestamped with its earliest reading.
+
+        Args:
+            boards: The boards to read. Defaults to a single board at address 0x48 on bus 1
+            port: Port number for the socket
+            ip_address: IP address for the socket
+            wire_format: Encoding of each datagram. One of "pickle", "float32" or "int16"
+            batch_size: Number of samples to pack into one datagram
+            batch_timeout_ms: Maximum age of a partial batch before it is sent
+            acquisition_mode: "single" for pipelined single-shot conversions or "continuous". See ConversionScheduler
+            wait: How to wait for conversions. One of "poll", "sleep" or "alert". "alert" requires every board to have
+                  an alert_pin
+            adc_factory: Callable that creates the ADC of a board from its bus and address, inside the streamer
+                         process. Defaults to ADS1115. Pass a factory of SimulatedADS1115s to run off-device.
+            transport: "udp" or "shm"
+            ring_buffer_name: Name of the shared memory ring buffer used by the "shm" transport
+            alignment_tolerance: Maximum difference in seconds between the timestamps of the readings merged into one
+                                 sample. Defaults to ALIGNMENT_TOLERANCE times the time the slowest board takes for one
+                                 reading
+    """
+
+    def __init__(self, boards: Optional[Sequence[Board]] = None, port: int = 12345, ip_address: str = "127.0.0.1",
+                 wire_format: str = "pickle", batch_size: int = 1, batch_timeout_ms: Optional[float] = None,
+                 acquisition_mode: str = "single", wait: str = "sleep",
+                 adc_factory: Optional[Callable[[int, int], "ADS1115"]] = None, transport: str = "udp",
+                 ring_buffer_name: str = DEFAULT_RING_BUFFER_NAME, alignment_tolerance: Optional[float] = None):
+        super().__init__(port, ip_address, wire_format, batch_size, batch_timeout_ms, transport, ring_buffer_name)
+        boards = list(boards) if boards is not None else [Board()]
+        if not boards:
+            raise ValueError("At least one board is required")
+        for board in boards:
+            if not board.channels or not all(0 <= channel <= 3 for channel in board.channels):
+                raise ValueError(f"Invalid channels: {board.channels}")
+        if len({(board.bus, board.address) for board in boards}) != len(boards):
+            raise ValueError(f"Invalid boards, the same bus and address is used twice: {boards}")
+
+        self._boards = boards
+        self._acquisition_mode = acquisition_mode
+        self._wait = wait
+        self._adc_factory = adc_factory
+        if alignment_tolerance is None:
+            # The boards are not synchronized, so the nearest reading of another board can be up to half a reading
+            # time away, plus jitter. Readings that are a whole reading time apart must not be merged.
+            reading_time = max(len(board.channels) for board in boards) / ADS111X_DATA_RATES[7]
+            alignment_tolerance = reading_time * (1 + CONVERSION_TOLERANCE) * ALIGNMENT_TOLERANCE
+        self._alignment_tolerance = alignment_tolerance
+
+        self._stopping = threading.Event()
+        self._aligner: Optional[FrameAligner] = None
+
+    @property
+    def boards(self):
+        return self._boards
+
+    @property
+    def channels(self):
+        """Total number of channels of every sample"""
+        return sum(len(board.channels) for board in self._boards)
+
+    @property
+    def aligner(self):
+        return self._aligner
+
+    def read_emg(self):
+        readings = queue.Queue()
+        self._aligner = FrameAligner(len(self._boards), self._alignment_tolerance)
+        workers = [threading.Thread(target=self._read_board, args=(index, board, readings), name=f"board-{index}",
+                                    daemon=True)
+                   for index, board in enumerate(self._boards)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while not self._stopping.is_set():
+                try:
+                    index, reading = readings.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                for values, timestamp in self._aligner.add(index, reading):
+                    if self._wire_format == "int16":
+                        self.write_emg(values, timestamp)
+                    else:
+                        self.write_emg([value * self._scale for value in values], timestamp)
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user. Closing socket and exiting...")
+        finally:
+            self._stopping.set()
+            for worker in workers:
+                worker.join(timeout=1.0)
+            logger.info(f"Readings dropped during alignment, per board: {self._aligner.dropped}")
             self.close_socket()
+
+    def stop(self):
+        """Makes read_emg() return"""
+        self._stopping.set()
+
+    def _read_board(self, index: int, board: Board, readings: queue.Queue):
+        scheduler = None
+        try:
+            if self._adc_factory is not None:
+                adc = self._adc_factory(board.bus, board.address)
+            else:
+                from ADS1x15 import ADS1115
+                adc = ADS1115(board.bus, board.address)
+            scheduler = ConversionScheduler(adc, channels=board.channels, mode=self._acquisition_mode,
+                                            wait=self._wait, data_rate=adc.DR_ADS111X_860, gain=adc.PGA_4_096V,
+                                            alert_pin=board.alert_pin)
+            scheduler.start()
+            # Every board uses the same gain, so any board's scale converts the merged counts to volts
+            self._scale = adc.toVoltage(1)
+            while not self._stopping.is_set():
+                readings.put((index, scheduler.read()))
+        except Exception as e:
+            logger.error(f"Error reading board {index} (bus {board.bus}, address {board.address:#x}): {e}")
+            self._stopping.set()
+        finally:
+            if scheduler is not None:
+                scheduler.stop()
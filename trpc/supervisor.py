@@ -0,0 +1,276 @@
+import json
+import multiprocessing
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, List, NamedTuple, Optional
+
+from trpc.utils.logger import get_logger
+from trpc.utils.metrics import get_registry
+
+if TYPE_CHECKING:
+    from trpc.streamer import Streamer
+
+logger = get_logger(__name__)
+
+# Reasons for restarting the streamer: its process exited, it wrote no samples for stall_timeout, or it wrote fewer
+# than min_rate samples per second
+RESTART_REASONS = ("exited", "stalled", "slow")
+# Seconds to wait for a terminated streamer process before killing it
+TERMINATE_TIMEOUT = 1.0
+
+
+class Gap(NamedTuple):
+    """A period in which the streamer wrote no samples. Times are time.time() timestamps, accurate to the supervisor's
+    check interval.
+
+        Args:
+            start: When the last sample before the gap was seen
+            end: When samples were seen again
+            reason: Why the streamer was restarted during the gap, if it was, e.g. "exited" (see RESTART_REASONS)
+            restarts: Number of times the streamer was restarted before it recovered
+    """
+    start: float
+    end: float
+    reason: str
+    restarts: int
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class StreamerSupervisor:
+    """Watches the streamer process of a Controller and restarts it when it fails, e.g. after an I2C error, so that
+    acquisition does not stop silently. The number of samples the streamer has written serves as its heartbeat: the
+    streamer is restarted if its process exits, if it writes no sample for stall_timeout seconds, or if it writes
+    fewer than min_rate samples per second over that time. Restarts start a new process, which initializes the ADC
+    again, and leave the processor running. Consecutive restarts are spaced by an exponential backoff, which resets once
+    the streamer has run for stable_after seconds.
+
+    The checks run in a background thread, but the new process is started by poll(), which the owner calls from its
+    main thread, so that the process is not forked from a thread while other threads may hold locks.
+
+    Every gap in acquisition is recorded (see gaps) with its duration and cause, logged, counted in the
+    trpc_streamer_gaps_total and trpc_streamer_gap_seconds_total metrics, and optionally appended to a JSON Lines file.
+
+        Args:
+            stall_timeout: Seconds without a new sample after which the streamer is considered stalled
+            min_rate: Minimum samples per second, measured over stall_timeout. None disables the rate check
+            interval: Seconds between two checks
+            backoff: Seconds to wait before the first restart. Doubles with every consecutive restart
+            max_backoff: Maximum seconds to wait before a restart
+            stable_after: Seconds the streamer has to run after a restart for the backoff to reset
+            max_restarts: Number of consecutive restarts after which the supervisor gives up (see failed). None
+                          restarts forever
+            gap_path: If set, each gap is appended to this JSON Lines file once it ends
+    """
+
+    def __init__(self, stall_timeout: float = 2.0, min_rate: Optional[float] = None, interval: float = 0.25,
+                 backoff: float = 0.5, max_backoff: float = 30.0, stable_after: float = 10.0,
+                 max_restarts: Optional[int] = None, gap_path: Optional[str] = None):
+        if stall_timeout <= 0:
+            raise ValueError(f"Invalid stall_timeout: {stall_timeout}")
+        if min_rate is not None and min_rate <= 0:
+            raise ValueError(f"Invalid min_rate: {min_rate}")
+        if not 0 < interval <= stall_timeout:
+            raise ValueError(f"Invalid interval: {interval}")
+        if backoff < 0 or max_backoff < backoff:
+            raise ValueError(f"Invalid backoff: {backoff} to {max_backoff}")
+        if max_restarts is not None and max_restarts < 0:
+            raise ValueError(f"Invalid max_restarts: {max_restarts}")
+
+        self._stall_timeout = stall_timeout
+        self._min_rate = min_rate
+        self._interval = interval
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._stable_after = stable_after
+        self._max_restarts = max_restarts
+        self._gap_path = gap_path
+
+        self._streamer: Optional["Streamer"] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self._respawn: Optional[Callable[[], multiprocessing.Process]] = None
+        self._gaps: List[Gap] = []
+        self._gaps_lock = threading.Lock()
+        self._restarts = 0
+        self._failed = False
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Set by the background thread when the streamer is to be restarted, and by poll() once it was
+        self._respawn_requested = threading.Event()
+        self._respawned = threading.Event()
+
+        registry = get_registry()
+        self._restart_metrics = {reason: registry.counter("trpc_streamer_restarts_total",
+                                                          "Restarts of the streamer process, by reason",
+                                                          labels={"reason": reason})
+                                 for reason in RESTART_REASONS}
+        self._gaps_metric = registry.counter("trpc_streamer_gaps_total", "Gaps in acquisition")
+        self._gap_seconds_metric = registry.counter("trpc_streamer_gap_seconds_total",
+                                                    "Total duration of the gaps in acquisition")
+        self._up_metric = registry.gauge("trpc_streamer_up", "1 while the streamer writes samples, 0 during a gap")
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def process(self):
+        """The current streamer process"""
+        return self._process
+
+    @property
+    def restarts(self):
+        """Number of times the streamer was restarted"""
+        return self._restarts
+
+    @property
+    def failed(self):
+        """True once max_restarts consecutive restarts failed and the supervisor gave up"""
+        return self._failed
+
+    @property
+    def gaps(self) -> List[Gap]:
+        """The gaps in acquisition that ended so far"""
+        with self._gaps_lock:
+            return list(self._gaps)
+
+    def downtime(self) -> float:
+        """Total duration of the gaps in seconds"""
+        return sum(gap.duration for gap in self.gaps)
+
+    def start(self, streamer: "Streamer", process: multiprocessing.Process,
+              respawn: Callable[[], multiprocessing.Process]):
+        """Starts supervising a streamer in a background thread. poll() must then be called regularly
+
+            Args:
+                streamer: The streamer
+                process: Its running process
+                respawn: Starts the streamer in a new process and returns it. Called by poll()
+        """
+        if self._thread is not None:
+            return
+        self._streamer, self._process, self._respawn = streamer, process, respawn
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._supervise, name="streamer-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops supervising, without stopping the streamer"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._respawn_requested.clear()
+
+    def poll(self) -> bool:
+        """Restarts the streamer if the background thread decided to. Call it from the main thread, at least every
+        interval seconds while supervising, e.g. from the loop that receives the decisions.
+
+            Returns:
+                True if the streamer was restarted
+        """
+        if not self._respawn_requested.is_set():
+            return False
+        self._streamer.prepare_restart()
+        self._process = self._respawn()
+        self._respawn_requested.clear()
+        self._respawned.set()
+        return True
+
+    def _supervise(self):
+        samples = self._streamer.samples_written
+        # Time (monotonic and wall clock) the last new sample was seen
+        progress, progress_wall = time.monotonic(), time.time()
+        # Samples at each check over the last stall_timeout, for the rate check
+        history = [(progress, samples)]
+        started = progress
+        consecutive = 0
+        gap_start, gap_reason, gap_restarts = None, None, 0
+        self._up_metric.set(1)
+
+        while not self._stop.wait(self._interval):
+            now = time.monotonic()
+            current = self._streamer.samples_written
+            if current > samples:
+                samples, progress, progress_wall = current, now, time.time()
+                if gap_reason is not None:
+                    self._end_gap(gap_start, gap_reason, gap_restarts)
+                    gap_start, gap_reason, gap_restarts = None, None, 0
+            if consecutive and now - started >= self._stable_after and gap_reason is None:
+                consecutive = 0
+
+            history.append((now, current))
+            while len(history) > 1 and history[1][0] <= now - self._stall_timeout:
+                history.pop(0)
+
+            reason = None
+            if not self._process.is_alive():
+                reason = "exited"
+            elif now - progress >= self._stall_timeout:
+                reason = "stalled"
+            elif self._min_rate is not None and now - history[0][0] >= self._stall_timeout and \
+                    (current - history[0][1]) / (now - history[0][0]) < self._min_rate:
+                reason = "slow"
+            if reason is None:
+                continue
+
+            if gap_reason is None:
+                # A slow streamer still wrote samples until now
+                gap_start, gap_reason = progress_wall if reason != "slow" else time.time(), reason
+                self._up_metric.set(0)
+            if self._max_restarts is not None and consecutive >= self._max_restarts:
+                if not self._failed:
+                    logger.error(f"Streamer {reason} after {consecutive} restarts, giving up")
+                    self._failed = True
+                continue
+
+            delay = min(self._backoff * 2 ** consecutive, self._max_backoff)
+            logger.warning(f"Streamer {reason} (exit code {self._process.exitcode}), restarting in {delay:.1f} s")
+            self._terminate()
+            if self._stop.wait(delay) or not self._request_respawn():
+                break
+            self._restarts += 1
+            consecutive += 1
+            gap_restarts += 1
+            self._restart_metrics[reason].inc()
+            started = progress = time.monotonic()
+            samples = self._streamer.samples_written
+            history = [(progress, samples)]
+
+        if gap_reason is not None:
+            self._end_gap(gap_start, gap_reason, gap_restarts)
+
+    def _request_respawn(self) -> bool:
+        # Waits for poll() to start the new process. Returns False if supervising stopped before it did
+        self._respawned.clear()
+        self._respawn_requested.set()
+        while not self._respawned.wait(self._interval):
+            if self._stop.is_set():
+                # poll() may have started it just before
+                return self._respawned.is_set()
+        return True
+
+    def _terminate(self):
+        if not self._process.is_alive():
+            return
+        self._process.terminate()
+        self._process.join(TERMINATE_TIMEOUT)
+        if self._process.is_alive():
+            # Stuck, e.g. in a driver call that ignores SIGTERM
+            self._process.kill()
+            self._process.join()
+
+    def _end_gap(self, start: float, reason: str, restarts: int):
+        gap = Gap(start, time.time(), reason, restarts)
+        with self._gaps_lock:
+            self._gaps.append(gap)
+        self._gaps_metric.inc()
+        self._gap_seconds_metric.inc(gap.duration)
+        self._up_metric.set(1)
+        logger.warning(f"Acquisition gap of {gap.duration:.2f} s ({reason}, {restarts} restarts)")
+        if self._gap_path is not None:
+            with open(self._gap_path, "a") as f:
+                f.write(json.dumps(dict(gap._asdict(), duration=gap.duration)) + "\n")
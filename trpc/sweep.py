@@ -0,0 +1,141 @@
+import itertools
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from trpc.dataset import EMGDataset, convert_dataset, is_dataset
+from trpc.feature_cache import DATA_DIR, FEATURE_CACHE_DIR, TEST_REPS, FeatureCache, load_features
+from trpc.model import save_classifier, save_configuration
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Processor parameters that can be swept, and their defaults
+SWEEP_PARAMETERS = {
+    "model": ["LDA"],
+    "window_size": [250],
+    "window_increment": [10],
+    "feature_set": ["LS9"],
+}
+# Conversions per second of the streamer's ADS1115, which it multiplexes over the channels, so a sample of every
+# channel arrives at ADC_DATA_RATE / channels per second. A decision is due every window_increment samples
+ADC_DATA_RATE = 860
+# Number of held-out windows to time when measuring the cost of a decision
+COST_WINDOWS = 200
+
+
+def _evaluate_windowing(data_path: str, window_size: int, window_increment: int, feature_set: str, models: List[str],
+                        cache_dir: Optional[str]) -> List[tuple]:
+    """Extracts the features of one windowing and feature set once, and trains and scores every model on them"""
+    from trpc.features import get_feature_list
+    from trpc.training import evaluate_classifier, fit_classifier
+
+    cache = FeatureCache(cache_dir) if cache_dir is not None else None
+    splits = load_features(window_size, window_increment, get_feature_list(feature_set), folder=data_path, cache=cache)
+    training_features, train_meta = splits["train"]
+    test_features, test_meta = splits["test"]
+
+    results = []
+    for model in models:
+        emg = fit_classifier(training_features, train_meta["classes"], model)
+        result = {"model": model, "window_size": window_size, "window_increment": window_increment,
+                  "feature_set": feature_set}
+        result.update(evaluate_classifier(emg, test_features, test_meta["classes"]))
+        results.append((result, emg))
+    return results
+
+
+def sweep(grid: Dict[str, List], data_path: str = DATA_DIR, classifier_path: Optional[str] = None,
+          processes: Optional[int] = None, feature_cache_dir: Optional[str] = FEATURE_CACHE_DIR,
+          max_load: Optional[float] = None, sampling_rate: Optional[float] = None) -> List[Dict]:
+    """Trains the processor's classifier for every combination of the grid, scores each on the held-out reps
+    (TEST_REPS) for accuracy and for the CPU cost of a decision, and ranks them.
+
+    Each combination of window size, window increment and feature set is evaluated in a worker process, which extracts
+    its features once and fits every model on them. The workers share the recordings through one memory-mapped dataset
+    store (see trpc.dataset), and a folder of CSV recordings is converted to a temporary store first. Decision costs
+    are measured afterwards in this process, one configuration at a time, so that they are not skewed by the workers
+    competing for the CPU.
+
+    Args:
+        grid: Values to try for each of the keys of SWEEP_PARAMETERS. Missing keys use the defaults
+        data_path: Training data, as a folder of CSV recordings or a dataset store
+        classifier_path: If set, the best classifier is saved to this path, with its configuration next to it (see
+                         trpc.model.save_configuration()) so that a Processor loading it uses the same one
+        processes: Number of worker processes. Defaults to the number of CPUs
+        feature_cache_dir: Directory of the feature cache, shared by the workers. None disables it
+        max_load: Fraction of a CPU that a configuration may spend on decisions, e.g. 0.5. Configurations over it are
+                  ranked after all the ones within it. None ranks by accuracy only
+        sampling_rate: Samples per second the streamer delivers, used to convert the cost of a decision to a CPU
+                       load. Defaults to ADC_DATA_RATE divided by the number of channels of the data
+
+    Returns:
+        One result per configuration, best first, with its parameters, the scores of evaluate_classifier(), the
+        median CPU time of a decision in milliseconds ("decision_ms") and the resulting CPU load ("cpu_load")
+    """
+    from trpc.features import get_feature_list
+    from trpc.training import measure_decision_cost
+
+    unknown = set(grid) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Invalid sweep parameters: {sorted(unknown)}")
+    grid = {key: list(grid.get(key, default)) for key, default in SWEEP_PARAMETERS.items()}
+
+    with tempfile.TemporaryDirectory() as directory:
+        if not is_dataset(data_path):
+            store = os.path.join(directory, "dataset")
+            convert_dataset(data_path, store)
+            data_path = store
+
+        windowings = list(itertools.product(grid["window_size"], grid["window_increment"], grid["feature_set"]))
+        logger.info(f"Evaluating {len(windowings) * len(grid['model'])} configurations in {len(windowings)} jobs...")
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            jobs = [executor.submit(_evaluate_windowing, data_path, window_size, window_increment, feature_set,
+                                    grid["model"], feature_cache_dir)
+                    for window_size, window_increment, feature_set in windowings]
+            evaluated = [result for job in jobs for result in job.result()]
+
+        test_data = EMGDataset(data_path).isolate_data("reps", TEST_REPS)
+        if sampling_rate is None:
+            sampling_rate = ADC_DATA_RATE / test_data.channels
+        windows = {}
+        for result, emg in evaluated:
+            window_size = result["window_size"]
+            if window_size not in windows:
+                windows[window_size] = test_data.parse_windows(window_size, window_size)[0][:COST_WINDOWS]
+            cost = measure_decision_cost(emg, get_feature_list(result["feature_set"]), windows[window_size])
+            result["decision_ms"] = cost * 1000
+            result["cpu_load"] = cost * sampling_rate / result["window_increment"]
+
+    def rank(item):
+        result = item[0]
+        over_budget = max_load is not None and not result["cpu_load"] <= max_load
+        return over_budget, -result["accuracy"], result["decision_ms"]
+
+    evaluated.sort(key=rank)
+    if classifier_path is not None and evaluated:
+        best, emg = evaluated[0]
+        os.makedirs(os.path.dirname(classifier_path) or ".", exist_ok=True)
+        save_classifier(emg, classifier_path)
+        save_configuration(classifier_path, best)
+        logger.info(f"Saved the best classifier ({format_configuration(best)}) to {classifier_path}")
+    return [result for result, _ in evaluated]
+
+
+def format_configuration(result: Dict) -> str:
+    return f"{result['model']} w{result['window_size']} i{result['window_increment']} {result['feature_set']}"
+
+
+def format_report(results: List[Dict], max_load: Optional[float] = None) -> str:
+    """Formats the results of sweep() as a ranked table"""
+    lines = [f"{'rank':>4}  {'configuration':<28} {'accuracy':>8} {'rejected':>8} {'accepted':>8} "
+             f"{'decision':>10} {'cpu load':>8}"]
+    for rank, result in enumerate(results, start=1):
+        over_budget = max_load is not None and not result["cpu_load"] <= max_load
+        accepted = "-" if math.isnan(result["accepted_accuracy"]) else f"{result['accepted_accuracy']:.3f}"
+        lines.append(f"{rank:>4}  {format_configuration(result):<28} {result['accuracy']:>8.3f} "
+                     f"{result['rejection_rate']:>8.3f} {accepted:>8} {result['decision_ms']:>7.3f} ms "
+                     f"{result['cpu_load']:>7.1%}" + (" (over budget)" if over_budget else ""))
+    return "\n".join(lines)
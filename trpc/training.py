@@ -0,0 +1,81 @@
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Predictions with a lower probability than this are rejected (reported as -1)
+REJECTION_THRESHOLD = 0.8
+
+
+def format_features(features: Dict[str, np.ndarray]) -> np.ndarray:
+    """Stacks a feature dictionary into a (windows, features) matrix, in the order the classifier expects"""
+    return np.hstack([np.asarray(values) for values in features.values()])
+
+
+def fit_classifier(features: Dict[str, np.ndarray], labels: np.ndarray, model: str = "LDA"):
+    """Trains a libemg EMGClassifier with rejection, as used by the processor
+
+    Args:
+        features: The training features, as returned by load_features()
+        labels: The class of each training window
+        model: The scikit-learn model to fit, as accepted by EMGClassifier.fit()
+    """
+    from libemg.emg_classifier import EMGClassifier
+
+    emg = EMGClassifier()
+    emg.add_rejection(REJECTION_THRESHOLD)
+    emg.fit(model=model, feature_dictionary={"training_features": features, "training_labels": labels})
+    return emg
+
+
+def evaluate_classifier(emg, features: Dict[str, np.ndarray], labels: np.ndarray) -> Dict[str, float]:
+    """Scores a trained classifier on held-out windows
+
+    Args:
+        emg: The trained EMGClassifier
+        features: The held-out features
+        labels: The class of each held-out window
+
+    Returns:
+        accuracy: Fraction of windows whose most probable class is correct, ignoring rejection
+        rejection_rate: Fraction of windows that are rejected
+        accepted_accuracy: Fraction of the windows that are not rejected whose class is correct
+    """
+    probabilities = emg.classifier.predict_proba(format_features(features))
+    predictions, confidence = emg._prediction_helper(probabilities)
+    correct = predictions == np.asarray(labels)
+    accepted = confidence > emg.rejection_threshold if emg.rejection else np.ones(len(correct), dtype=bool)
+    return {
+        "accuracy": float(np.mean(correct)),
+        "rejection_rate": float(1 - np.mean(accepted)),
+        "accepted_accuracy": float(np.mean(correct[accepted])) if accepted.any() else float("nan"),
+    }
+
+
+def measure_decision_cost(emg, feature_list: List[str], windows: np.ndarray) -> float:
+    """Measures the CPU time of one online decision: extracting the features of a single window and classifying it, as
+    TRPCOnlineClassifier does without incremental features
+
+    Args:
+        emg: The trained EMGClassifier
+        feature_list: The features the classifier was trained on
+        windows: Windows to time, shaped (windows, channels, samples)
+
+    Returns:
+        The median CPU time per decision in seconds
+    """
+    from libemg.feature_extractor import FeatureExtractor
+
+    fe = FeatureExtractor()
+    costs = []
+    for window in windows:
+        start = time.process_time()
+        features = fe.extract_features(feature_list, window[np.newaxis], emg.feature_params)
+        probabilities = emg.classifier.predict_proba(format_features(features))
+        emg._prediction_helper(probabilities)
+        costs.append(time.process_time() - start)
+    return float(np.median(costs)) if costs else float("nan")
@@ -1,9 +1,243 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional, TextIO, Tuple
 
 LOGGER_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
+# Maximum number of records waiting for the listener thread. Records that do not fit are dropped rather than blocking
+LOG_QUEUE_SIZE = 10000
+# Seconds between two messages from the same line of the signal path, see get_hot_logger()
+RATE_LIMIT_INTERVAL = 1.0
 
-def get_logger(name: str, log_level: int = logging.INFO) -> logging.Logger:
-    """Returns a logger with the specified name and log level."""
-    logging.basicConfig(level=log_level, format=LOGGER_FORMAT)
+_configured = False
+_log_queue: Optional[multiprocessing.Queue] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(name: str, log_level: int = logging.INFO, rate_limit: Optional[float] = None,
+               sample_every: Optional[int] = None) -> logging.Logger:
+    """Returns a logger with the specified name and log level. The root logger is configured on the first call only,
+    so later calls do not touch the handlers, e.g. the queue handler installed by start_queue_logging().
+
+    Messages logged for every sample or decision should go to a logger with a rate limit or sampling, so that a burst
+    of them (e.g. a run of malformed datagrams) can not flood the output, see get_hot_logger().
+
+        Args:
+            name: The logger name
+            log_level: The log level of the root logger, set on the first call
+            rate_limit: If set, each line of code that logs to this logger is logged at most once every `rate_limit`
+                        seconds, and the next message that gets through reports how many were suppressed
+            sample_every: If set, only every `sample_every`-th message of each line of code is logged
+    """
+    global _configured
+    if not _configured:
+        logging.basicConfig(level=log_level, format=LOGGER_FORMAT)
+        _configured = True
     logger = logging.getLogger(name)
-    return logger
\ No newline at end of file
+    if rate_limit is not None and not any(isinstance(f, RateLimitFilter) for f in logger.filters):
+        logger.addFilter(RateLimitFilter(rate_limit))
+    if sample_every is not None and not any(isinstance(f, SampleFilter) for f in logger.filters):
+        logger.addFilter(SampleFilter(sample_every))
+    return logger
+
+
+def get_hot_logger(name: str) -> logging.Logger:
+    """Returns the logger for the messages of a module that are logged per sample or per decision, i.e. on the signal
+    path. It is a child of the module's logger, named "<name>.hot", and logs each line of code at most once every
+    RATE_LIMIT_INTERVAL seconds, so that a burst of such messages can not flood the output or stall the pipeline.
+
+        Args:
+            name: The name of the module's logger, usually __name__
+    """
+    return get_logger(f"{name}.hot", rate_limit=RATE_LIMIT_INTERVAL)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most one record every `interval` seconds from each line of code (pathname and line number), and
+    notes the number of records suppressed since on the next one that passes.
+
+        Args:
+            interval: Minimum seconds between two records from the same line
+    """
+
+    def __init__(self, interval: float = RATE_LIMIT_INTERVAL):
+        super().__init__()
+        if interval <= 0:
+            raise ValueError(f"Invalid interval: {interval}")
+        self._interval = interval
+        self._state: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._state.get(key, (-self._interval, 0))
+            if now - last < self._interval:
+                self._state[key] = (last, suppressed + 1)
+                return False
+            self._state[key] = (now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            record.suppressed = suppressed
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Lets through the first and then every `every`-th record from each line of code
+
+        Args:
+            every: Number of records per record logged
+    """
+
+    def __init__(self, every: int):
+        super().__init__()
+        if every < 1:
+            raise ValueError(f"Invalid sampling: {every}")
+        self._every = every
+        self._counts: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def every(self):
+        return self._every
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % self._every:
+            return False
+        record.sampled = self._every
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one compact JSON object, i.e. JSON Lines"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "message": record.getMessage(),
+        }
+        for key in ("suppressed", "sampled"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"))
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener of start_queue_logging() without formatting them and without ever blocking. The
+    multiprocessing queue pickles and sends records from a background thread, and records that do not fit in the queue
+    are counted and dropped."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self._dropped = 0
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the arguments into the message so that the record can be pickled. The listener formats it
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._dropped += 1
+
+
+def start_queue_logging(stream: Optional[TextIO] = None, path: Optional[str] = None, json_lines: bool = False,
+                        log_level: int = logging.INFO,
+                        queue_size: int = LOG_QUEUE_SIZE) -> multiprocessing.Queue:
+    """Sends all logging through a queue to a single listener thread, which does the I/O, so that a slow console or
+    SD card never stalls the sampling loop or the controller. Processes forked afterwards inherit the queue handler.
+    Processes started with another start method should call attach_queue() first, e.g. through run_with_log_queue().
+
+        Args:
+            stream: The stream the listener writes to. Defaults to stderr
+            path: If set, the listener appends to this file instead of writing to the stream
+            json_lines: Write one compact JSON object per record instead of the plain format
+            log_level: The log level of the root logger
+            queue_size: Maximum number of records waiting for the listener
+
+        Returns:
+            The log queue, to be passed to attach_queue() in processes that do not inherit it
+    """
+    global _log_queue, _listener
+    if _listener is not None:
+        return _log_queue
+
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(LOGGER_FORMAT))
+    _log_queue = multiprocessing.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(_log_queue, handler)
+    _listener.start()
+    attach_queue(_log_queue, log_level)
+    atexit.register(stop_queue_logging)
+    return _log_queue
+
+
+def stop_queue_logging():
+    """Writes the records left in the queue, stops the listener thread and logs directly to its output again"""
+    global _log_queue, _listener
+    if _listener is None:
+        return
+    listener, _listener, _log_queue = _listener, None, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+def get_log_queue() -> Optional[multiprocessing.Queue]:
+    """Returns the queue of start_queue_logging(), or None if queue logging is not used"""
+    return _log_queue
+
+
+def attach_queue(log_queue: multiprocessing.Queue, log_level: int = logging.INFO):
+    """Replaces the handlers of the root logger of this process with a handler that sends to the log queue"""
+    global _configured
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    root.setLevel(log_level)
+    _configured = True
+
+
+def run_with_log_queue(log_queue: Optional[multiprocessing.Queue], target: Callable, *args):
+    """Target for child processes that sends their logging to the log queue, if there is one, before running target"""
+    if log_queue is not None:
+        attach_queue(log_queue, logging.getLogger().level if _configured else logging.INFO)
+    return target(*args)
@@ -0,0 +1,288 @@
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_PORT = 9464
+# Buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# A sample of a metric: the name, labels and value
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class Metric:
+    """Base class of the metrics. Values are kept in shared memory, so a metric created before a process is started
+    (e.g. in the constructor of a streamer) can be updated by that process and read by the parent. Updates hold a lock
+    that is shared the same way, so a metric can be updated from several threads and processes at once, e.g. a latency
+    histogram from every servo worker. An uncontended update costs about a microsecond.
+
+        Args:
+            name: The metric name
+            help: Description of the metric
+            labels: Constant labels, e.g. {"servo": "Servo 1"}
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help = help
+        self.labels = {key: str(value) for key, value in (labels or {}).items()}
+        self._value = multiprocessing.RawValue("d", 0.0)
+        self._lock = multiprocessing.Lock()
+        self._function: Optional[Callable[[], float]] = None
+
+    @property
+    def value(self) -> float:
+        return float(self._function()) if self._function is not None else self._value.value
+
+    def set_function(self, function: Callable[[], float]):
+        """Reads the value from a function when the metric is collected, e.g. from a component's own statistics. The
+        function is called in the process that collects the metrics."""
+        self._function = function
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, self.labels, self.value)]
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of samples read"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value.value += amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. a queue depth"""
+
+    type = "gauge"
+
+    def set(self, value: float):
+        with self._lock:
+            self._value.value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self._value.value -= amount
+
+
+class Histogram(Metric):
+    """Counts observations, e.g. latencies, in fixed buckets
+
+        Args:
+            name: The metric name
+            help: Description of the metric
+            buckets: Upper bounds of the buckets, in increasing order. A bucket for everything above is added
+            labels: Constant labels
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labels: Optional[Dict[str, str]] = None):
+        super().__init__(name, help, labels)
+        if list(buckets) != sorted(buckets) or not buckets:
+            raise ValueError(f"Invalid buckets: {buckets}")
+        self._buckets = tuple(buckets)
+        self._counts = multiprocessing.RawArray("q", len(self._buckets) + 1)
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            return sum(self._counts)
+
+    @property
+    def sum(self) -> float:
+        return self._value.value
+
+    def observe(self, value: float):
+        bucket = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[bucket] += 1
+            self._value.value += value
+
+    def samples(self) -> List[Sample]:
+        # Read under the lock, so that the buckets, sum and count are of the same observations
+        with self._lock:
+            counts, total = self._counts[:], self._value.value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((f"{self.name}_bucket", {**self.labels, "le": le}, cumulative))
+        samples.append((f"{self.name}_sum", self.labels, total))
+        samples.append((f"{self.name}_count", self.labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Holds the metrics of a process and exposes them in the Prometheus text format, over HTTP with serve() or as
+    periodic JSON snapshots with start_snapshots()"""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Tuple], Metric] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._snapshot_stop: Optional[threading.Event] = None
+
+    def counter(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        """Returns the counter with this name and labels, creating it if needed"""
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        """Returns the gauge with this name and labels, creating it if needed"""
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labels: Optional[Dict[str, str]] = None) -> Histogram:
+        """Returns the histogram with this name and labels, creating it if needed"""
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def collect(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for metric in sorted(self.collect(), key=lambda m: m.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.debug(f"Failed to collect {metric.name}: {e}")
+                continue
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        """Returns the time and the value of every sample, keyed by its name and labels"""
+        values = {}
+        for metric in self.collect():
+            try:
+                for name, labels, value in metric.samples():
+                    values[f"{name}{_format_labels(labels)}"] = value
+            except Exception as e:
+                logger.debug(f"Failed to collect {metric.name}: {e}")
+        return {"time": time.time(), "metrics": values}
+
+    def serve(self, port: int = METRICS_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serves the metrics at http://host:port/metrics from a background thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving metrics at http://{host}:{self._server.server_address[1]}/metrics")
+        return self._server
+
+    def start_snapshots(self, path: str, interval: float = 60.0):
+        """Writes a snapshot (see snapshot()) to a JSON file every `interval` seconds from a background thread. Each
+        snapshot replaces the previous one atomically, and includes the rate per second of every counter since the
+        previous snapshot."""
+        if interval <= 0:
+            raise ValueError(f"Invalid interval: {interval}")
+        self._snapshot_stop = threading.Event()
+        threading.Thread(target=self._write_snapshots, args=(path, interval, self._snapshot_stop),
+                         name="metrics-snapshot", daemon=True).start()
+
+    def stop(self):
+        """Stops serving and writing snapshots"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._snapshot_stop is not None:
+            self._snapshot_stop.set()
+            self._snapshot_stop = None
+
+    def _write_snapshots(self, path: str, interval: float, stop: threading.Event):
+        previous = None
+        while not stop.wait(interval):
+            snapshot = self.snapshot()
+            counters = {f"{metric.name}{_format_labels(metric.labels)}" for metric in self.collect()
+                        if metric.type == "counter"}
+            if previous is not None:
+                elapsed = snapshot["time"] - previous["time"]
+                snapshot["rates"] = {key: (value - previous["metrics"].get(key, 0.0)) / elapsed
+                                     for key, value in snapshot["metrics"].items() if key in counters}
+            previous = snapshot
+            try:
+                staging = f"{path}.tmp"
+                with open(staging, "w") as f:
+                    json.dump(snapshot, f, indent=2)
+                os.replace(staging, path)
+            except OSError as e:
+                logger.error(f"Failed to write metrics snapshot to {path}: {e}")
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Optional[Dict[str, str]], **kwargs):
+        key = (name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, labels=labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Invalid metric type for {name}: already registered as a {metric.type}")
+            return metric
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = {k: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+
+# The registry the TRPC components report to
+REGISTRY = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    return REGISTRY
@@ -0,0 +1,140 @@
+import json
+import math
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+# Points in the life of a decision, in order. Each is a time.time() timestamp:
+#   sample: acquisition of the newest sample the decision is based on (the first sample of its frame, if batched)
+#   received: receipt of that sample by the data handler
+#   window: the classifier picked up the window containing it
+#   classified: the classifier sent the decision
+#   decided: the controller received the decision
+#   actuated: the driver finished executing the command
+TRACE_POINTS = ("sample", "received", "window", "classified", "decided", "actuated")
+
+# Stages whose latency is recorded.
+#   name: (start point, end point)
+TRACE_STAGES = {
+    "transport": ("sample", "received"),
+    "buffering": ("received", "window"),
+    "inference": ("window", "classified"),
+    "delivery": ("classified", "decided"),
+    "actuation": ("decided", "actuated"),
+    # From the sample to the controller, whether or not the decision moved a servo
+    "decision": ("sample", "decided"),
+    "total": ("sample", "actuated"),
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """Histogram of latencies with logarithmically spaced buckets, so that percentiles have the same relative precision
+    for microseconds as for seconds. Latencies outside [min_latency, max_latency] are counted in the first or last
+    bucket.
+
+        Args:
+            min_latency: Smallest distinguishable latency in seconds
+            max_latency: Largest distinguishable latency in seconds
+            buckets_per_decade: Number of buckets per factor of 10. 50 buckets bound the error of a percentile to ~5%
+    """
+
+    def __init__(self, min_latency: float = 1e-6, max_latency: float = 10.0, buckets_per_decade: int = 50):
+        if not 0 < min_latency < max_latency:
+            raise ValueError(f"Invalid latency range: {min_latency} to {max_latency}")
+
+        self._min_latency = min_latency
+        self._buckets_per_decade = buckets_per_decade
+        buckets = math.ceil(math.log10(max_latency / min_latency) * buckets_per_decade) + 1
+        self._counts = np.zeros(buckets, dtype=np.int64)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count else math.nan
+
+    @property
+    def max(self):
+        return self._max if self._count else math.nan
+
+    def record(self, latency: float):
+        """Records a latency in seconds"""
+        bucket = math.floor(math.log10(max(latency, self._min_latency) / self._min_latency) * self._buckets_per_decade)
+        self._counts[min(bucket, len(self._counts) - 1)] += 1
+        self._count += 1
+        self._sum += latency
+        self._max = max(self._max, latency)
+
+    def percentile(self, q: float) -> float:
+        """Returns the q-th percentile in seconds, as the geometric center of the bucket it falls into"""
+        if not self._count:
+            return math.nan
+        bucket = int(np.searchsorted(np.cumsum(self._counts), math.ceil(q / 100 * self._count)))
+        return min(self._min_latency * 10 ** ((bucket + 0.5) / self._buckets_per_decade), self._max)
+
+    def summary(self) -> Dict[str, float]:
+        """Returns the count, and the mean, percentiles and maximum in milliseconds"""
+        summary = {"count": self._count, "mean": self.mean * 1000}
+        summary.update({f"p{q}": self.percentile(q) * 1000 for q in PERCENTILES})
+        summary["max"] = self.max * 1000
+        return summary
+
+
+class Tracer:
+    """Records the latency of each stage of a decision (see TRACE_STAGES) into histograms, and optionally writes every
+    trace to a JSON Lines file. Stages with a missing point, e.g. the sample time in pickle mode, are skipped.
+
+        Args:
+            trace_path: Path of the trace file. None disables it
+    """
+
+    def __init__(self, trace_path: Optional[str] = None):
+        self._histograms = {stage: LatencyHistogram() for stage in TRACE_STAGES}
+        self._trace_file = open(trace_path, "a") if trace_path is not None else None
+        # Traces may be recorded from the receive path and from a driver worker thread
+        self._lock = threading.Lock()
+
+    @property
+    def histograms(self):
+        return self._histograms
+
+    def record(self, trace: Dict[str, float]):
+        """Records a trace
+
+        Args:
+            trace: Timestamps of the points of a decision, keyed by point name (see TRACE_POINTS), plus any extra
+                   fields to write to the trace file, e.g. the gesture
+        """
+        with self._lock:
+            for stage, (start, end) in TRACE_STAGES.items():
+                latency = trace.get(end, math.nan) - trace.get(start, math.nan)
+                if not math.isnan(latency):
+                    self._histograms[stage].record(latency)
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps({k: v for k, v in trace.items()
+                                                   if not (isinstance(v, float) and math.isnan(v))}) + "\n")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Returns the summary (see LatencyHistogram.summary()) of every stage with at least one recorded latency"""
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._histograms.items() if histogram.count}
+
+    def export_summary(self, path: str):
+        """Writes the summary to a JSON file"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def close(self):
+        """Closes the trace file"""
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
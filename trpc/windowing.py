@@ -0,0 +1,160 @@
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from trpc.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Number of windows copied and passed to the feature extractor at once by extract_features_chunked(). A batch of 250
+# samples on 8 float64 channels takes 16 KB per window
+FEATURE_BATCH = 1024
+
+
+def window_view(recording: np.ndarray, window_size: int, window_increment: int) -> np.ndarray:
+    """Returns the windows of a recording as a read-only view of it, shaped (windows, channels, samples) like libemg's
+    get_windows(). No samples are copied, however much the windows overlap.
+
+        Args:
+            recording: The samples, shaped (samples, channels)
+            window_size: Number of samples in a window
+            window_increment: Number of samples between windows
+    """
+    if window_size < 1:
+        raise ValueError(f"Invalid window_size: {window_size}")
+    if window_increment < 1:
+        raise ValueError(f"Invalid window_increment: {window_increment}")
+    if recording.ndim != 2:
+        raise ValueError(f"Invalid recording shape: {recording.shape}")
+    if len(recording) < window_size:
+        windows = np.empty((0, recording.shape[1], window_size), dtype=recording.dtype)
+        windows.flags.writeable = False
+        return windows
+    return np.lib.stride_tricks.sliding_window_view(recording, window_size, axis=0)[::window_increment]
+
+
+class StridedWindows:
+    """The windows of several recordings, as read-only views of the recordings rather than one array of windows. With a
+    small increment, the windows of a recording overlap almost entirely, and materializing them takes
+    window_size / window_increment times the memory of the samples. Windows do not span recordings, and are ordered by
+    recording, like those of libemg's OfflineDataHandler.parse_windows().
+
+    Use batches() to process the windows in bounded memory, e.g. extract_features_chunked().
+
+        Args:
+            recordings: The samples of each recording, shaped (samples, channels)
+            window_size: Number of samples in a window
+            window_increment: Number of samples between windows
+            metadata: Per-recording values of each metadata key, e.g. {"classes": [...], "reps": [...]}, which
+                      metadata() repeats for each window of the recording
+    """
+
+    def __init__(self, recordings: Sequence[np.ndarray], window_size: int, window_increment: int,
+                 metadata: Optional[Dict[str, Sequence[int]]] = None):
+        if metadata is None:
+            metadata = {}
+        for key, values in metadata.items():
+            if len(values) != len(recordings):
+                raise ValueError(f"Invalid metadata for {key}: {len(values)} values for {len(recordings)} recordings")
+        channels = {recording.shape[1] for recording in recordings}
+        if len(channels) > 1:
+            raise ValueError(f"Invalid recordings, different numbers of channels: {sorted(channels)}")
+
+        self._window_size = window_size
+        self._window_increment = window_increment
+        self._views = [window_view(recording, window_size, window_increment) for recording in recordings]
+        self._metadata = {key: np.asarray(values, dtype=int) for key, values in metadata.items()}
+        self._channels = channels.pop() if channels else 0
+        self._dtype = np.result_type(*recordings) if len(recordings) else np.dtype(np.float64)
+
+    @property
+    def window_size(self):
+        return self._window_size
+
+    @property
+    def window_increment(self):
+        return self._window_increment
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def views(self) -> List[np.ndarray]:
+        """The windows of each recording, as read-only views shaped (windows, channels, samples)"""
+        return self._views
+
+    def __len__(self):
+        return sum(len(view) for view in self._views)
+
+    def metadata(self) -> Dict[str, np.ndarray]:
+        """Returns the value of each metadata key for each window"""
+        counts = [len(view) for view in self._views]
+        return {key: np.repeat(values, counts) for key, values in self._metadata.items()}
+
+    def batches(self, batch_size: int) -> Iterator[np.ndarray]:
+        """Yields the windows in order, in contiguous arrays of up to batch_size windows. The arrays are views of one
+        buffer that the next batch overwrites, so memory use is bounded by batch_size rather than the number of
+        windows."""
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch_size: {batch_size}")
+        buffer = np.empty((min(batch_size, len(self)), self._channels, self._window_size), dtype=self._dtype)
+        filled = 0
+        for view in self._views:
+            start = 0
+            while start < len(view):
+                count = min(len(view) - start, len(buffer) - filled)
+                buffer[filled:filled + count] = view[start:start + count]
+                filled += count
+                start += count
+                if filled == len(buffer):
+                    yield buffer
+                    filled = 0
+        if filled:
+            yield buffer[:filled]
+
+    def materialize(self) -> np.ndarray:
+        """Returns a copy of all windows as one C-contiguous array, shaped (windows, channels, samples), like libemg's
+        OfflineDataHandler.parse_windows()"""
+        windows = np.empty((len(self), self._channels, self._window_size), dtype=self._dtype)
+        if self._views:
+            np.concatenate(self._views, out=windows)
+        return windows
+
+
+def extract_features_chunked(feature_list: List[str], windows: StridedWindows, feature_params: Optional[Dict] = None,
+                             batch_size: int = FEATURE_BATCH) -> Dict[str, np.ndarray]:
+    """Extracts features like libemg's FeatureExtractor.extract_features(), batch_size windows at a time, so that only
+    one batch of windows is ever copied out of the recordings. The features of each batch are written into arrays
+    allocated once for all windows, and are identical to those extracted from all windows at once.
+
+        Args:
+            feature_list: The features to extract, in order
+            windows: The windows to extract features from
+            feature_params: Feature parameters, as accepted by libemg's FeatureExtractor
+            batch_size: Maximum number of windows per call to the feature extractor
+
+    Returns:
+        A dictionary of features, each shaped (windows, values)
+    """
+    from libemg.feature_extractor import FeatureExtractor
+
+    fe = FeatureExtractor()
+    total = len(windows)
+    features = {}
+    done = 0
+    for batch in windows.batches(batch_size):
+        extracted = fe.extract_features(feature_list, batch, feature_params or {})
+        for name, values in extracted.items():
+            if name not in features:
+                features[name] = np.empty((total,) + values.shape[1:], dtype=values.dtype)
+            features[name][done:done + len(batch)] = values
+        done += len(batch)
+    if not total:
+        # With the shapes the extractor gives for an empty array of windows
+        features = fe.extract_features(feature_list, windows.materialize(), feature_params or {})
+    return features
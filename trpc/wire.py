@@ -0,0 +1,123 @@
+import struct
+from typing import NamedTuple, Sequence
+
+import numpy as np
+
+# Frame layout (little-endian):
+#   magic (2s) | version (B) | dtype code (B) | channels (H) | samples (H) | sequence (I) | timestamp (d) | scale (f)
+# followed by a row-major (samples x channels) payload of float32 or int16 values.
+FRAME_MAGIC = b"TR"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<2sBBHHIdf")
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+
+WIRE_FORMATS = ("pickle", "float32", "int16")
+DTYPE_CODES = {"float32": 0, "int16": 1}
+CODE_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<i2")}
+
+SEQUENCE_MODULUS = 2 ** 32
+
+
+class Frame(NamedTuple):
+    """A decoded binary frame. `samples` is a read-only (samples x channels) view over the datagram buffer."""
+    sequence: int
+    timestamp: float
+    channels: int
+    samples: np.ndarray
+    scale: float
+
+    def to_voltage(self) -> np.ndarray:
+        """Returns the samples as float32 voltages. Float32 frames are returned as-is without copying."""
+        if self.samples.dtype.kind == "f":
+            return self.samples
+        return self.samples.astype(np.float32) * np.float32(self.scale)
+
+
+def is_frame(data: bytes) -> bool:
+    """Returns True if the datagram starts with the binary frame magic."""
+    return len(data) >= FRAME_HEADER_SIZE and data[:2] == FRAME_MAGIC
+
+
+def encode_frame(samples: Sequence[float | int] | np.ndarray, sequence: int, timestamp: float,
+                 wire_format: str = "float32", scale: float = 1.0) -> bytes:
+    """Packs one or more samples into a binary frame.
+
+    Args:
+        samples: A single sample (one value per channel) or a 2D array of shape (samples, channels)
+        sequence: Sequence number of the frame. Wraps around at 2**32
+        timestamp: Acquisition time of the first sample in the frame, in seconds
+        wire_format: Payload type, either "float32" or "int16"
+        scale: Volts per count for int16 payloads. Ignored by the receiver for float32 payloads
+    """
+    if wire_format not in DTYPE_CODES:
+        raise ValueError(f"Invalid wire format for a binary frame: {wire_format}")
+
+    dtype_code = DTYPE_CODES[wire_format]
+    payload = np.asarray(samples, dtype=CODE_DTYPES[dtype_code])
+    if payload.ndim == 1:
+        payload = payload.reshape(1, -1)
+    if payload.ndim != 2:
+        raise ValueError(f"Invalid sample shape: {payload.shape}")
+
+    num_samples, channels = payload.shape
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, dtype_code, channels, num_samples,
+                               sequence % SEQUENCE_MODULUS, timestamp, scale)
+    return header + payload.tobytes()
+
+
+def decode_frame(data: bytes | bytearray | memoryview) -> Frame:
+    """Decodes a binary frame without copying the payload.
+
+    Args:
+        data: The raw datagram
+    """
+    if len(data) < FRAME_HEADER_SIZE:
+        raise ValueError(f"Frame too short: {len(data)} bytes")
+
+    magic, version, dtype_code, channels, num_samples, sequence, timestamp, scale = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f"Invalid frame magic: {magic!r}")
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version: {version}")
+    if dtype_code not in CODE_DTYPES:
+        raise ValueError(f"Unsupported frame dtype code: {dtype_code}")
+
+    dtype = CODE_DTYPES[dtype_code]
+    expected = FRAME_HEADER_SIZE + num_samples * channels * dtype.itemsize
+    if len(data) != expected:
+        raise ValueError(f"Frame length mismatch: expected {expected} bytes, got {len(data)}")
+
+    samples = np.frombuffer(data, dtype=dtype, count=num_samples * channels, offset=FRAME_HEADER_SIZE)
+    return Frame(sequence, timestamp, channels, samples.reshape(num_samples, channels), scale)
+
+
+class SequenceTracker:
+    """Tracks the sequence numbers of received frames to count dropped and reordered datagrams. A frame that arrives
+    with a sequence number ahead of the expected one counts the skipped frames as dropped. A frame that arrives behind
+    the expected one is counted as reordered, and no longer as dropped."""
+
+    def __init__(self):
+        self._expected: int | None = None
+        self.received = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def update(self, sequence: int):
+        """Records a received sequence number.
+
+        Args:
+            sequence: The sequence number of the received frame
+        """
+        self.received += 1
+        if self._expected is None:
+            self._expected = (sequence + 1) % SEQUENCE_MODULUS
+            return
+
+        gap = (sequence - self._expected) % SEQUENCE_MODULUS
+        if gap < SEQUENCE_MODULUS // 2:
+            self.dropped += gap
+            self._expected = (sequence + 1) % SEQUENCE_MODULUS
+        else:
+            # A late frame that was previously counted as dropped
+            self.reordered += 1
+            self.dropped = max(self.dropped - 1, 0)